@@ -0,0 +1,420 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Benchmarks of the revocation checking code.
+Run as: python -m dslib.certs.benchmark [name ...] [size ...]
+'''
+
+# standard library imports
+import os
+import sys
+import random
+import inspect
+import pickle
+import tempfile
+import time
+import calendar
+import resource
+import multiprocessing
+from timeit import default_timer as timer
+
+# dslib imports
+from dslib.converters.bytes_converter import bytes_to_int
+from dslib.converters import time_converter
+
+# local imports
+import fast_rev_cert_parser
+from revoked_store import Revoked_store, FILTER_MIN_QUERIES
+import crl_store
+import crl_verifier
+from crl_generator import _der, _der_int, Test_CA
+
+
+def make_revoked_list(count, first_serial=1000, step=7):
+  '''
+  Builds DER encoded revokedCertificates list with count entries.
+  '''
+  entries = [_der(0x30, _der_int(first_serial + i * step) +
+                        _der(0x17, '120101%06dZ' % (i % 240000)))
+             for i in xrange(count)]
+  return _der(0x30, ''.join(entries))
+
+
+def _legacy_parse_all(substrate):
+  '''
+  The original slicing parser (before offset based parsing),
+  kept here as the reference for benchmarks.
+  '''
+  def decode_len(substrate):
+    first_byte = ord(substrate[0])
+    if first_byte < 128:
+      return first_byte, 1
+    size = first_byte & 0x7F
+    return bytes_to_int(substrate[1:size+1]), size
+
+  def parse_one(substrate):
+    object_len, size = decode_len(substrate[1:])
+    content_offset = 1 + size
+    next_start = content_offset + object_len
+    int_len, size = decode_len(substrate[content_offset+1:])
+    int_start = content_offset + size + 1
+    sn = bytes_to_int(substrate[int_start:int_start + int_len])
+    date_sub = substrate[int_start + int_len:]
+    date_len, size = decode_len(date_sub[1:])
+    date = date_sub[1 + size:1 + size + date_len]
+    return sn, date, substrate[next_start:]
+
+  object_len, size = decode_len(substrate[1:])
+  substrate = substrate[2+size:]
+  res = []
+  while len(substrate) != 0:
+    sn, rev_date, substrate = parse_one(substrate)
+    res.append([sn, rev_date])
+  return res
+
+
+def _time(func, *args):
+  start = timer()
+  func(*args)
+  return timer() - start
+
+def bench_parser(sizes=(1000, 4000, 16000, 64000, 256000), legacy_limit=64000):
+  '''
+  Compares scaling of the offset based parser with the legacy one.
+  Prints time per revoked entry - it should stay flat for linear scaling.
+  '''
+  sample = make_revoked_list(1000)
+  assert fast_rev_cert_parser.parse_all(sample) == _legacy_parse_all(sample)
+  print "%10s %14s %14s %14s" % ("entries", "legacy [s]", "offsets [s]",
+                                 "offsets [us/entry]")
+  for count in sizes:
+    rev_list = make_revoked_list(count)
+    if count <= legacy_limit:
+      legacy = "%14.3f" % _time(_legacy_parse_all, rev_list)
+    else:
+      legacy = "%14s" % "-"
+    new = _time(fast_rev_cert_parser.parse_all, rev_list)
+    print "%10d %s %14.3f %14.2f" % (count, legacy, new, new * 1e6 / count)
+
+
+def _dict_size(revoked):
+  '''
+  Memory used by the dict of revoked certificates including its items.
+  '''
+  size = sys.getsizeof(revoked)
+  for sn, date in revoked.iteritems():
+    size += sys.getsizeof(sn) + sys.getsizeof(date)
+  return size
+
+def bench_store(count=200000, serial_bits=(24, 128)):
+  '''
+  Compares memory per entry and lookup time of dict and Revoked_store
+  (of revoked and of not revoked serial numbers). Memory of the store
+  includes its lookup structures, built by the first lookup.
+  '''
+  print "%6s %10s %12s %12s %12s %12s %12s" % ("bits", "entries",
+                  "dict [B/e]", "store [B/e]", "dict [us]", "hit [us]",
+                  "miss [us]")
+  for bits in serial_bits:
+    rnd = random.Random(bits)
+    revoked = dict((rnd.getrandbits(bits), '120101%06dZ' % (i % 240000))
+                   for i in xrange(count))
+    store = Revoked_store(revoked.iteritems())
+    hits = revoked.keys()[:10000]
+    misses = [rnd.getrandbits(bits) for i in xrange(10000)]
+    store.get(misses[0])
+    dict_time = _time(lambda: [revoked.get(sn) for sn in hits + misses])
+    hit_time = _time(lambda: [store.get(sn) for sn in hits])
+    miss_time = _time(lambda: [store.get(sn) for sn in misses])
+    print "%6d %10d %12.1f %12.1f %12.2f %12.2f %12.2f" % (bits, len(store),
+                  float(_dict_size(revoked)) / len(revoked),
+                  float(sys.getsizeof(store)) / len(store),
+                  dict_time * 1e6 / (len(hits) + len(misses)),
+                  hit_time * 1e6 / len(hits), miss_time * 1e6 / len(misses))
+
+
+def _make_cache(issuers, count):
+  cache = crl_store.CRL_cache()
+  rnd = random.Random(count)
+  for i in xrange(issuers):
+    iss = cache.add_issuer("2.5.4.3 => Benchmark CA %d" % i)
+    dpoint = iss.add_dist_point("http://crl.example.com/ca%d.crl" % i)
+    dpoint.update_revoked("120101000000Z", "120102000000Z",
+                          ((rnd.getrandbits(128), "120101000000Z")
+                           for j in xrange(count)))
+  return cache
+
+def bench_restore(issuers=4, count=250000):
+  '''
+  Compares cold start (restore + first lookup) of pickled cache and
+  of the memory mapped index.
+  '''
+  cache = _make_cache(issuers, count)
+  tmp_dir = tempfile.mkdtemp()
+  pickle_path = os.path.join(tmp_dir, "crl_dump")
+  index_path = os.path.join(tmp_dir, "crl_index")
+  try:
+    def dump():
+      f = open(pickle_path, "wb")
+      pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+      f.close()
+    def load_pickle():
+      crl_store.CRL_cache.unpickle(pickle_path).issuers[-1].certificate_revoked(1)
+    def load_index():
+      crl_store.CRL_cache.load(index_path).issuers[-1].certificate_revoked(1)
+    print "%d issuers, %d revoked certificates each" % (issuers, count)
+    print "%-24s %10.4f s" % ("pickle store", _time(dump))
+    print "%-24s %10.4f s" % ("index store", _time(cache.save, index_path))
+    print "%-24s %10.4f s" % ("pickle restore+lookup", _time(load_pickle))
+    print "%-24s %10.4f s" % ("index restore+lookup", _time(load_index))
+  finally:
+    for name in os.listdir(tmp_dir):
+      os.remove(os.path.join(tmp_dir, name))
+    os.rmdir(tmp_dir)
+
+
+def bench_journal(issuers=4, count=250000, refreshes=20, added=10):
+  '''
+  Compares cost of storing small CRL refreshes into the journal
+  with rewriting the whole index.
+  '''
+  cache = _make_cache(issuers, count)
+  tmp_dir = tempfile.mkdtemp()
+  index_path = os.path.join(tmp_dir, "crl_index")
+  rnd = random.Random(added)
+  def refresh(compact):
+    for i in xrange(refreshes):
+      dpoint = cache.issuers[i % issuers].dist_points[0]
+      dpoint.update_revoked("1201%02d000000Z" % (i + 1), "1202%02d000000Z" % (i + 1),
+                            [(rnd.getrandbits(128), "120101000000Z")
+                             for j in xrange(added)])
+      cache.save(index_path, compact=compact)
+  try:
+    cache.save(index_path)
+    print "%d issuers, %d revoked certificates each, %d refreshes adding %d" % \
+          (issuers, count, refreshes, added)
+    print "%-24s %10.4f s" % ("index rewrite", _time(refresh, True))
+    print "%-24s %10.4f s" % ("journal append", _time(refresh, False))
+    print "%-24s %10.4f s" % ("load with journal", _time(crl_store.CRL_cache.load,
+                                                       index_path))
+  finally:
+    for name in os.listdir(tmp_dir):
+      os.remove(os.path.join(tmp_dir, name))
+    os.rmdir(tmp_dir)
+
+
+def make_crl(count):
+  '''
+  Builds DER encoded CRL with count revoked entries (the signature is
+  not valid).
+  '''
+  sig_alg = _der(0x30, _der(0x06, '\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b') +
+                 '\x05\x00')
+  issuer = _der(0x30, _der(0x31, _der(0x30, _der(0x06, '\x55\x04\x03') +
+                                      _der(0x0c, 'Benchmark CA'))))
+  tbs = _der(0x30, _der_int(1) + sig_alg + issuer +
+                   _der(0x17, '120101000000Z') + _der(0x17, '120102000000Z') +
+                   make_revoked_list(count))
+  return _der(0x30, tbs + sig_alg + _der(0x03, '\x00' + '\x01' * 256))
+
+def bench_tbs(sizes=(1000, 10000, 50000)):
+  '''
+  Compares digest of tbsCertList of decoded CRL computed from
+  the encoded tbsCertList and from the original bytes.
+  '''
+  from pyasn1.codec.der import decoder, encoder
+  from dslib.pkcs7.asn1_models.crl import RevCertificateList
+  from dslib.pkcs7.digest import calculate_digest, SHA256_NAME
+  import crl_verifier
+  print "%10s %14s %14s" % ("entries", "re-encode [s]", "original [s]")
+  for count in sizes:
+    der = make_crl(count)
+    crl = decoder.decode(der, asn1Spec=RevCertificateList())[0]
+    def encoded():
+      return calculate_digest(encoder.encode(crl.getComponentByName("tbsCertList")),
+                              SHA256_NAME)
+    def original():
+      return calculate_digest(crl_verifier.get_tbs_bytes(der), SHA256_NAME)
+    assert encoded() == original()
+    print "%10d %14.4f %14.4f" % (count, _time(encoded), _time(original))
+
+
+def bench_check_many(count=250000, queries=(1000, 20000, 200000), revoked=0.1,
+                     repeat=3):
+  '''
+  Compares CRL_cache.check_many with certificate_rev_date called for
+  each certificate (the best of repeat runs).
+  '''
+  cache = _make_cache(1, count)
+  iss = cache.issuers[0]
+  serials = [sn for sn, date in iss.revoked_view()]
+  # other seed than _make_cache, its serials would be checked again
+  rnd = random.Random(count + 1)
+  print "%d revoked certificates, %d%% of checked ones revoked" % \
+        (count, revoked * 100)
+  # the first bulk lookup builds the membership filter of the store
+  build_time = _time(cache.check_many, [(iss.name, 0)] * FILTER_MIN_QUERIES)
+  print "first bulk lookup %.1f ms" % (build_time * 1e3)
+  print "%10s %14s %14s %10s" % ("checked", "scalar [us]", "bulk [us]",
+                                 "speedup")
+  for num in queries:
+    checked = [(iss.name, rnd.choice(serials) if rnd.random() < revoked
+                          else rnd.getrandbits(128)) for i in xrange(num)]
+    def check_scalar():
+      return [cache.certificate_rev_date(name, sn) for name, sn in checked]
+    assert check_scalar() == cache.check_many(checked)
+    scalar_time = min(_time(check_scalar) for i in xrange(repeat))
+    bulk_time = min(_time(cache.check_many, checked) for i in xrange(repeat))
+    print "%10d %14.2f %14.2f %10.1f" % (num, scalar_time * 1e6 / num,
+                  bulk_time * 1e6 / num, scalar_time / bulk_time)
+
+
+def _peak_memory():
+  '''
+  Peak resident memory of the process in bytes.
+  '''
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _crl_suite_run(ca, count, results):
+  '''
+  Measures one CRL size, runs in a separate process to get its own
+  peak memory.
+  '''
+  from pyasn1.codec.der import decoder
+  from dslib.pkcs7.asn1_models.crl import RevCertificateList
+  der = ca.make_crl(count)
+  certificate = ca.certificate()
+  start_memory = _peak_memory()
+  times = {}
+  def timed(name, func, *args):
+    start = timer()
+    res = func(*args)
+    times[name] = timer() - start
+    return res
+  crl = timed("decode", lambda: decoder.decode(der,
+                                        asn1Spec=RevCertificateList())[0])
+  assert timed("verify", crl_verifier.verify_crl, crl, certificate, der)
+  cache = crl_store.CRL_cache()
+  dpoint = cache.add_issuer(ca.common_name).add_dist_point(
+                                            "http://crl.example.com/test.crl")
+  this_update, next_update, revoked, extensions = \
+                                          crl_store._read_decoded_crl(crl)
+  timed("ingest", dpoint.update_revoked, this_update, next_update, revoked)
+  assert len(dpoint.revoked_certs) == count
+  tmp_dir = tempfile.mkdtemp()
+  index_path = os.path.join(tmp_dir, "crl_index")
+  try:
+    timed("persist", cache.save, index_path)
+    cache = timed("restore", crl_store.CRL_cache.load, index_path)
+    probes = [1000 + i * 7 for i in xrange(0, count, max(1, count // 5000))]
+    probes += [1001 + i * 7 for i in xrange(len(probes))]
+    name = ca.common_name
+    start = timer()
+    for sn in probes:
+      cache.is_certificate_revoked(name, sn)
+    times["lookup"] = (timer() - start) / len(probes)
+    del cache
+  finally:
+    for name in os.listdir(tmp_dir):
+      os.remove(os.path.join(tmp_dir, name))
+    os.rmdir(tmp_dir)
+  results.put((len(der), times, _peak_memory() - start_memory))
+
+def bench_crl(sizes=(1000, 10000, 100000), bits=2048):
+  '''
+  Measures processing of signed CRLs of the given sizes issued by
+  a test CA: decode, signature verification, ingest into the cache,
+  persist into and restore from the index, lookup time and peak memory.
+  Use sizes up to 1000000 to see behaviour with the largest CRLs.
+  '''
+  ca = Test_CA("Benchmark CA", bits, seed=bits)
+  print "%10s %10s %9s %9s %9s %9s %9s %9s %9s" % ("entries", "size [kB]",
+                "decode", "verify", "ingest", "persist", "restore",
+                "lookup", "peak")
+  print "%10s %10s %9s %9s %9s %9s %9s %9s %9s" % ("", "", "[s]", "[s]",
+                "[s]", "[s]", "[s]", "[us]", "[MB]")
+  for count in sizes:
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=_crl_suite_run,
+                                     args=(ca, count, results))
+    worker.start()
+    size, times, memory = results.get()
+    worker.join()
+    print "%10d %10d %9.3f %9.3f %9.3f %9.3f %9.3f %9.2f %9.1f" % (count,
+                size // 1024, times["decode"], times["verify"],
+                times["ingest"], times["persist"], times["restore"],
+                times["lookup"] * 1e6, memory / 1048576.0)
+
+
+def bench_time(count=100000, distinct=1000):
+  '''
+  Compares parsing of UTCTime strings with time.strptime and with
+  time_converter (first parsing and parsing of cached times).
+  '''
+  start = calendar.timegm((2012, 1, 1, 0, 0, 0))
+  times = [time.strftime('%y%m%d%H%M%SZ', time.gmtime(start + i * 3607))
+           for i in xrange(distinct)]
+  checked = [times[i % distinct] for i in xrange(count)]
+  def strptime():
+    for value in checked:
+      calendar.timegm(time.strptime(value, '%y%m%d%H%M%SZ'))
+  def uncached():
+    for value in checked:
+      time_converter._parse(value)
+  def cached():
+    for value in checked:
+      time_converter.to_seconds(value)
+  time_converter.clear_cache()
+  assert [time_converter.to_seconds(value) for value in times] == \
+         [calendar.timegm(time.strptime(value, '%y%m%d%H%M%SZ'))
+          for value in times]
+  print "%d times parsed, %d distinct" % (count, distinct)
+  for name, func in (("strptime", strptime), ("parser", uncached),
+                     ("cached parser", cached)):
+    print "%-24s %10.2f us" % (name, _time(func) * 1e6 / count)
+
+
+BENCHMARKS = [
+  ("parser", bench_parser),
+  ("store", bench_store),
+  ("restore", bench_restore),
+  ("journal", bench_journal),
+  ("tbs", bench_tbs),
+  ("check_many", bench_check_many),
+  ("crl", bench_crl),
+  ("time", bench_time),
+  ]
+
+def main(argv):
+  '''
+  Runs benchmarks given by name (all by default), numeric arguments
+  replace default sizes of benchmarks which take sizes.
+  '''
+  names = [arg for arg in argv[1:] if not arg.isdigit()]
+  sizes = tuple(int(arg) for arg in argv[1:] if arg.isdigit())
+  for name, func in BENCHMARKS:
+    if names and name not in names:
+      continue
+    print "== %s ==" % name
+    if sizes and "sizes" in inspect.getargspec(func).args:
+      func(sizes=sizes)
+    else:
+      func()
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,256 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+
+"""
+Size bounded LRU cache of parsed certificates
+"""
+
+# standard library imports
+import time
+import threading
+from collections import OrderedDict
+
+
+class Certificate_cache(object):
+  """
+  LRU cache bounded by number of entries and by their size in bytes
+  (0 means no limit). The size is given by the caller of put, the cache
+  of parsed certificates uses the length of their DER, not the (much
+  larger) memory of the parsed certificates. Entries older than ttl
+  seconds (0 - no expiration) are dropped. Pinned keys are never evicted
+  nor expired and their size does not count against max_bytes.
+  """
+
+  def __init__(self, max_entries=0, max_bytes=0, ttl=0):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    # key -> (value, size, expiration time), the least recently used first
+    self._entries = OrderedDict()
+    # pinned key -> (value, size, expiration time)
+    self._pinned_entries = {}
+    self._pinned = set()
+    self._bytes = 0
+    self._pinned_bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key):
+    """
+    Returns cached value or None.
+    """
+    self._lock.acquire()
+    try:
+      entry = self._pinned_entries.get(key)
+      if entry is not None:
+        self.hits += 1
+        return entry[0]
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      if entry[2] is not None and entry[2] <= time.time():
+        self._bytes -= entry[1]
+        self.expirations += 1
+        self.misses += 1
+        return None
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[0]
+    finally:
+      self._lock.release()
+
+  def put(self, key, value, size=0):
+    """
+    Stores value of size bytes, the least recently used entries are
+    evicted when the cache is full.
+    """
+    self._lock.acquire()
+    try:
+      self.__remove(key)
+      expires = None
+      if self.ttl:
+        expires = time.time() + self.ttl
+      entry = (value, size, expires)
+      self._bytes += size
+      if key in self._pinned:
+        self._pinned_entries[key] = entry
+        self._pinned_bytes += size
+      else:
+        self._entries[key] = entry
+        self.__evict()
+    finally:
+      self._lock.release()
+
+  def __remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      entry = self._pinned_entries.pop(key, None)
+      if entry is not None:
+        self._pinned_bytes -= entry[1]
+    if entry is not None:
+      self._bytes -= entry[1]
+
+  def __evict(self):
+    while self._entries and \
+          ((self.max_entries and len(self._entries) > self.max_entries) or
+           (self.max_bytes and
+            self._bytes - self._pinned_bytes > self.max_bytes)):
+      key, entry = self._entries.popitem(last=False)
+      self._bytes -= entry[1]
+      self.evictions += 1
+
+  def remove(self, key):
+    self._lock.acquire()
+    try:
+      self.__remove(key)
+    finally:
+      self._lock.release()
+
+  def pin(self, key):
+    """
+    Keeps key in the cache until it is unpinned (also when it is
+    stored later).
+    """
+    self._lock.acquire()
+    try:
+      self._pinned.add(key)
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._pinned_entries[key] = (entry[0], entry[1], None)
+        self._pinned_bytes += entry[1]
+    finally:
+      self._lock.release()
+
+  def unpin(self, key):
+    self._lock.acquire()
+    try:
+      self._pinned.discard(key)
+      entry = self._pinned_entries.pop(key, None)
+      if entry is not None:
+        self._pinned_bytes -= entry[1]
+        expires = None
+        if self.ttl:
+          expires = time.time() + self.ttl
+        self._entries[key] = (entry[0], entry[1], expires)
+        self.__evict()
+    finally:
+      self._lock.release()
+
+  def is_pinned(self, key):
+    return key in self._pinned
+
+  def purge_expired(self):
+    """
+    Drops expired entries, returns their number.
+    """
+    if not self.ttl:
+      return 0
+    now = time.time()
+    self._lock.acquire()
+    try:
+      expired = [key for key, entry in self._entries.iteritems()
+                 if entry[2] is not None and entry[2] <= now]
+      for key in expired:
+        self._bytes -= self._entries.pop(key)[1]
+      self.expirations += len(expired)
+    finally:
+      self._lock.release()
+    return len(expired)
+
+  def clear(self):
+    """
+    Drops all entries (pinned keys stay pinned).
+    """
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self._pinned_entries.clear()
+      self._bytes = 0
+      self._pinned_bytes = 0
+    finally:
+      self._lock.release()
+
+  def __len__(self):
+    return len(self._entries) + len(self._pinned_entries)
+
+  def __contains__(self, key):
+    return key in self._entries or key in self._pinned_entries
+
+  def stats(self):
+    """
+    Returns dictionary with size of the cache and counters of its use.
+    """
+    self._lock.acquire()
+    try:
+      return {"entries": len(self._entries) + len(self._pinned_entries),
+              "pinned": len(self._pinned_entries),
+              "bytes": self._bytes,
+              "pinned_bytes": self._pinned_bytes,
+              "hits": self.hits,
+              "misses": self.misses,
+              "evictions": self.evictions,
+              "expirations": self.expirations}
+    finally:
+      self._lock.release()
+
+
+class Verification_cache(object):
+  """
+  Results of certificate verification keyed by (certificate hash,
+  version of trust store, version of the issuer's CRLs). Results are
+  used only inside their time window - between notBefore and notAfter
+  of the certificate and before the next update of the issuer's CRLs.
+  """
+
+  def __init__(self, max_entries=0):
+    self._cache = Certificate_cache(max_entries)
+
+  def get(self, cert_hash, trust_version, crl_version):
+    """
+    Returns cached verification results or None.
+    """
+    key = (cert_hash, trust_version, crl_version)
+    entry = self._cache.get(key)
+    if entry is None:
+      return None
+    results, valid_from, valid_until = entry
+    now = time.time()
+    if (valid_from is not None and now < valid_from) or \
+       (valid_until is not None and now >= valid_until):
+      self._cache.remove(key)
+      return None
+    return results
+
+  def put(self, cert_hash, trust_version, crl_version, results,
+          valid_from=None, valid_until=None):
+    """
+    Stores verification results valid from valid_from until valid_until
+    (seconds since the epoch, None - not limited).
+    """
+    self._cache.put((cert_hash, trust_version, crl_version),
+                    (results, valid_from, valid_until))
+
+  def clear(self):
+    self._cache.clear()
+
+  def stats(self):
+    return self._cache.stats()
@@ -0,0 +1,268 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of the cache of parsed certificates - LRU eviction by number
+of entries and by size, expiration, pinning and creation of the cache
+by the certificate manager.
+Run with python -m dslib.certs.cert_cache_test
+'''
+
+# standard library imports
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# dslib imports
+from dslib.properties.properties import Properties as props
+
+# local imports
+import cert_cache
+from cert_cache import Certificate_cache, Verification_cache
+from cert_manager import CertificateManager
+
+
+class _Clock(object):
+    '''
+    Replaces the time module in cert_cache
+    '''
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class Certificate_cache_test(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        cert_cache.time = self.clock
+
+    def tearDown(self):
+        cert_cache.time = time
+
+    def test_lru_entries(self):
+        cache = Certificate_cache(max_entries=3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        # 'a' becomes the most recently used
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('d', 'D')
+        self.assert_('b' not in cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(key) for key in 'acd'], ['A', 'C', 'D'])
+        # storing again replaces the value and refreshes the entry
+        cache.put('a', 'A2')
+        cache.put('e', 'E')
+        self.assert_('c' not in cache)
+        self.assertEqual(cache.get('a'), 'A2')
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['hits'], 5)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_bytes(self):
+        cache = Certificate_cache(max_bytes=100)
+        cache.put('a', 1, 40)
+        cache.put('b', 2, 40)
+        self.assertEqual(cache.stats()['bytes'], 80)
+        cache.get('a')
+        cache.put('c', 3, 30)
+        self.assert_('b' not in cache)
+        self.assertEqual(cache.stats()['bytes'], 70)
+        # replacing the value counts only its new size
+        cache.put('a', 1, 10)
+        self.assertEqual(cache.stats()['bytes'], 40)
+        # entry larger than the limit does not stay
+        cache.put('d', 4, 101)
+        self.assert_('d' not in cache)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        cache.put('e', 5, 20)
+        cache.remove('e')
+        cache.remove('e')
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_no_limit(self):
+        cache = Certificate_cache()
+        for i in xrange(1000):
+            cache.put(i, i, 1000)
+        self.assertEqual(len(cache), 1000)
+        self.assertEqual(cache.stats()['evictions'], 0)
+        self.clock.now += 10 ** 9
+        self.assertEqual(cache.purge_expired(), 0)
+        self.assertEqual(cache.get(0), 0)
+
+    def test_ttl(self):
+        cache = Certificate_cache(ttl=60)
+        cache.put('a', 1, 10)
+        self.clock.now += 30
+        cache.put('b', 2, 10)
+        # access does not prolong the entry
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.now += 30
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        stats = cache.stats()
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes'], 10)
+        cache.put('c', 3, 10)
+        self.clock.now += 30
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['bytes'], 10)
+        self.clock.now += 30
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 3)
+
+    def test_pinning(self):
+        cache = Certificate_cache(max_entries=2, max_bytes=100, ttl=60)
+        # key pinned before it is stored
+        cache.pin('a')
+        self.assert_(cache.is_pinned('a'))
+        self.assert_('a' not in cache)
+        cache.put('a', 1, 80)
+        cache.put('b', 2, 80)
+        cache.put('c', 3, 20)
+        # pinned size does not count against the limits
+        self.assertEqual(sorted(key for key in 'abc' if key in cache),
+                         ['a', 'b', 'c'])
+        stats = cache.stats()
+        self.assertEqual(stats['pinned'], 1)
+        self.assertEqual(stats['pinned_bytes'], 80)
+        self.assertEqual(stats['bytes'], 180)
+        for i in xrange(10):
+            cache.put(i, i, 50)
+        self.assertEqual(cache.get('a'), 1)
+        # pinned entries do not expire
+        self.clock.now += 3600
+        cache.purge_expired()
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 1)
+        # key pinned when it is in the cache
+        cache.put('b', 2, 10)
+        cache.pin('b')
+        self.clock.now += 3600
+        self.assertEqual(cache.get('b'), 2)
+        # unpinned entries become the most recently used
+        cache.put('c', 3, 10)
+        cache.put('d', 4, 10)
+        cache.unpin('a')
+        self.assert_(not cache.is_pinned('a'))
+        self.assert_('c' not in cache)
+        self.assertEqual(cache.stats()['bytes'], 100)
+        cache.put('e', 5, 10)
+        self.assert_('d' not in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['pinned_bytes'], 10)
+        self.clock.now += 60
+        self.assertEqual(cache.get('a'), None)
+        cache.unpin('x')
+        # clear keeps keys pinned
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assert_(cache.is_pinned('b'))
+        cache.put('b', 2, 1000)
+        self.assertEqual(cache.get('b'), 2)
+        cache.remove('b')
+        self.assert_('b' not in cache)
+        self.assertEqual(cache.stats()['pinned_bytes'], 0)
+
+    def test_verification_window(self):
+        cache = Verification_cache(max_entries=2)
+        now = self.clock.now
+        cache.put('h', 1, 2, 'ok', now + 10, now + 20)
+        self.assertEqual(cache.get('h', 1, 2), None)
+        cache.put('h', 1, 2, 'ok', now + 10, now + 20)
+        self.clock.now += 10
+        self.assertEqual(cache.get('h', 1, 2), 'ok')
+        self.assertEqual(cache.get('h', 1, 3), None)
+        self.clock.now += 10
+        self.assertEqual(cache.get('h', 1, 2), None)
+        cache.put('h', 1, 2, 'ok')
+        self.clock.now += 10 ** 9
+        self.assertEqual(cache.get('h', 1, 2), 'ok')
+
+
+class Manager_cache_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = (CertificateManager._cert_store,
+                      CertificateManager._verification_cache,
+                      props.PINNED_CERTIFICATES)
+        CertificateManager._cert_store = None
+        CertificateManager._verification_cache = None
+
+    def tearDown(self):
+        (CertificateManager._cert_store,
+         CertificateManager._verification_cache,
+         props.PINNED_CERTIFICATES) = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_concurrent_creation(self):
+        ders = ['certificate %d' % i for i in xrange(3)]
+        paths = []
+        for i, der in enumerate(ders):
+            path = os.path.join(self.dir, 'pinned%d.cer' % i)
+            f = open(path, 'wb')
+            f.write(der)
+            f.close()
+            paths.append(path)
+        props.PINNED_CERTIFICATES = ' , '.join(paths + [''])
+        stores = []
+        caches = []
+        start = threading.Event()
+        def get_caches():
+            start.wait()
+            stores.append(CertificateManager.get_cert_store())
+            caches.append(CertificateManager.get_verification_cache())
+        threads = [threading.Thread(target=get_caches) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(stores), 8)
+        self.assertEqual(len(set(map(id, stores))), 1)
+        self.assertEqual(len(set(map(id, caches))), 1)
+        store = stores[0]
+        for der in ders:
+            self.assert_(store.is_pinned(
+                CertificateManager._hash_certificate_der_data(der)))
+        # parsed certificates are accounted by length of their DER
+        h = CertificateManager._hash_certificate_der_data(ders[0])
+        CertificateManager._cache_certificate(h, object(), ders[0])
+        self.assertEqual(store.stats()['pinned_bytes'], len(ders[0]))
+        CertificateManager.unpin_certificate(ders[0])
+        self.assert_(not store.is_pinned(h))
+        self.assertEqual(store.stats()['bytes'], len(ders[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
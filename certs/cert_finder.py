@@ -24,6 +24,12 @@ certificates.
 # standard library imports
 import logging
 
+# dslib imports
+from dslib.pkcs7.asn1_models.tools import tuple_to_OID
+
+# local imports
+import timeutil
+
 
 def _get_tbs_certificate(certificate):
     '''
@@ -42,10 +48,43 @@ def _get_tbs_certificate(certificate):
             
   
 
+def get_extension_value(certificate, ext_id):
+    '''
+    Returns encoded value of certificate extension ext_id (dotted OID)
+    or None.
+    '''
+    extensions = _get_tbs_certificate(certificate).\
+                        getComponentByName('extensions')
+    if extensions is None:
+        return None
+    for ext in extensions:
+        if tuple_to_OID(ext.getComponentByName('extnID')) == ext_id:
+            return ext.getComponentByName('extnValue')._value
+    return None
+
+
+def get_validity(certificate):
+    '''
+    Returns notBefore and notAfter of the certificate in seconds since
+    the epoch (None, None if they cannot be parsed).
+    '''
+    validity = _get_tbs_certificate(certificate).getComponentByName("validity")
+    try:
+        return (timeutil.to_seconds_from_epoch(
+                validity.getComponentByName("notBefore").getComponent()._value),
+                timeutil.to_seconds_from_epoch(
+                validity.getComponentByName("notAfter").getComponent()._value))
+    except ValueError:
+        return None, None
+
+
 def find_cert_by_subject(subject, certs):
     '''
     Looks for the certificate with specified subject.
+    Trust_store is searched by its index.
     '''
+    if hasattr(certs, 'find_by_subject'):
+        return certs.find_by_subject(subject)
     for cert in certs:
         tbs = _get_tbs_certificate(cert)
         subj = str(tbs.getComponentByName("subject"))
@@ -54,6 +93,21 @@ def find_cert_by_subject(subject, certs):
     return None
 
 
+def find_issuer(certificate, certs, issuer=None):
+    '''
+    Looks for the certificate which issued certificate (issuer is
+    the string form of its issuer Name, if it is already known).
+    Trust_store also matches authorityKeyIdentifier, in a list the first
+    certificate with the issuer subject is taken.
+    '''
+    if hasattr(certs, 'find_issuer'):
+        return certs.find_issuer(certificate, issuer)
+    if issuer is None:
+        issuer = str(_get_tbs_certificate(certificate).\
+                     getComponentByName("issuer"))
+    return find_cert_by_subject(issuer, certs)
+
+
 def find_cert_by_serial(serial_number, certificates):
     '''
     Looks for certificate with serial_number.
@@ -22,7 +22,6 @@ Decoder for PEM files
 
 # standard library imports
 import sys
-import string
 import base64
 
 # dslib imports
@@ -33,95 +32,137 @@ from dslib.pkcs7.asn1_models.X509_certificate import *
 PEM_SUFFIX = ".pem"
 CER_SUFFIX = ".cer"
 
+PEM_CERT_BEGIN = '-----BEGIN CERTIFICATE-----'
+PEM_CERT_END = '-----END CERTIFICATE-----'
+
+def iter_pem_blocks(lines, begin=PEM_CERT_BEGIN, end=PEM_CERT_END):
+    '''
+    Yields decoded content of each PEM block (between lines begin
+    and end) found in lines.
+    '''
+    block = None
+    for line in lines:
+        line = line.strip()
+        if line == begin:
+            block = []
+        elif block is not None:
+            if line == end:
+                yield base64.b64decode(''.join(block))
+                block = None
+            else:
+                block.append(line)
+
 def _get_substrate(lines):
     '''
-    Returns substrate from PEM file
+    Returns substrate of the last certificate from PEM file
     '''
-    begin_cert, content, end_cert = 0, 1, 2
-    state = begin_cert
-    certCnt = 0
     substrate = None
-    
-    for certLine in lines:
-        certLine = string.strip(certLine)
-        if state == begin_cert:
-            if state == begin_cert:
-                if certLine == '-----BEGIN CERTIFICATE-----':
-                    certLines = []
-                    state = content
-                    continue
-        if state == content:
-            if certLine == '-----END CERTIFICATE-----':
-                state = end_cert
-            else:
-                certLines.append(certLine)
-        if state == end_cert:
-            substrate = ''
-            for certLine in certLines:
-                substrate = substrate + base64.b64decode(certLine)
+    for substrate in iter_pem_blocks(lines):
+        pass
     return substrate
 
+def _decode_certificate(substrate):
+    '''
+    Returns pyasn Certificate decoded from substrate or None.
+    '''
+    try:
+        return decoder.decode(substrate, asn1Spec=Certificate())[0]
+    except Exception, e:
+        return None
 
-def parse_pem(pem_file):
+def read_pem_bundle(pem_file):
     '''
-    Parses PEM certificate.
-    Returns pyasn Certificate object or None, if parsing failed.
+    Returns list of DER encoded certificates from PEM file (one or more
+    certificates). Returns empty list, if the file cannot be read.
     '''
     try:
-        f = open(pem_file, "r")
-        lines = f.readlines()
+        f = open(pem_file, "rb")
+    except IOError:
+        return []
+    try:
+        return list(iter_pem_blocks(f))
+    finally:
+        f.close()
+
+def read_der(der_file):
+    '''
+    Returns content of DER encoded certificate file or None.
+    '''
+    try:
+        f = open(der_file, "rb")
     except IOError:
         return None
-    substrate = _get_substrate(lines)
-    pattern = Certificate()
     try:
-        certificate = decoder.decode(substrate, asn1Spec=pattern)[0]
-    except Exception, e:
+        return f.read()
+    finally:
+        f.close()
+
+def read_certificate_file(cert_file):
+    '''
+    Returns list of DER encoded certificates from PEM or DER (.cer) file.
+    '''
+    if cert_file.endswith(PEM_SUFFIX):
+        return read_pem_bundle(cert_file)
+    if cert_file.endswith(CER_SUFFIX):
+        substrate = read_der(cert_file)
+        if substrate:
+            return [substrate]
+    return []
+
+def parse_pem(pem_file):
+    '''
+    Parses PEM certificate.
+    Returns pyasn Certificate object (the last one in the file)
+    or None, if parsing failed.
+    '''
+    substrates = read_pem_bundle(pem_file)
+    if not substrates:
         return None
-    
-    return certificate
+    return _decode_certificate(substrates[-1])
+
+def parse_pem_bundle(pem_file):
+    '''
+    Parses all certificates in PEM file.
+    Returns list of pyasn Certificate objects, certificates which
+    could not be parsed are left out.
+    '''
+    certificates = []
+    for substrate in read_pem_bundle(pem_file):
+        certificate = _decode_certificate(substrate)
+        if certificate is not None:
+            certificates.append(certificate)
+    return certificates
 
 def parse_cer(der_file):
     '''
     Parses certificate file in DER format.
     Returns pyasn Certificate or None, if parsing failed
     '''
-    f = open(der_file, "r")
-    lines = f.readlines()
-    substrate = ''
-    for line in lines:
-        substrate += line    
-    pattern = Certificate()
-    try:
-        certificate = decoder.decode(substrate, asn1Spec=pattern)[0]
-    except Exception, e:
-        print e.message
+    substrate = read_der(der_file)
+    if substrate is None:
         return None
-    
-    return certificate
+    return _decode_certificate(substrate)
 
 def load_certificates_from_dir(cert_folder):
     '''
-    Tries to extract X509 certificate from each file in the specified directory.
+    Extracts X509 certificates from each file in the specified directory,
+    PEM files may contain more certificates. Certificates found in more
+    files are returned once.
     Returns list of X509 certificates
     '''
-    if cert_folder[len(cert_folder) - 1] != "/":
-        cert_folder += "/"
     import os
     try:
-      files = os.listdir(cert_folder)
+      files = sorted(os.listdir(cert_folder))
     except:
       return []
+    seen = set()
     result = []
     for file in files:
-        certificate = None
-        if file.endswith(PEM_SUFFIX):
-            certificate = parse_pem(cert_folder + file)
-        if file.endswith(CER_SUFFIX):
-            certificate = parse_cer(cert_folder + file)
-            
-        if certificate:
-            result.append(certificate)
+        for substrate in read_certificate_file(os.path.join(cert_folder, file)):
+            if substrate in seen:
+                continue
+            seen.add(substrate)
+            certificate = _decode_certificate(substrate)
+            if certificate is not None:
+                result.append(certificate)
     return result
-
-
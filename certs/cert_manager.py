@@ -21,6 +21,9 @@ Cache and management of certificate data
 """
 
 # standard library imports
+import time
+import logging
+import threading
 from hashlib import sha256
 
 # dslib imports
@@ -29,7 +32,13 @@ from dslib.properties.properties import Properties as props
 
 # local imports
 import cert_verifier
-import cert_loader
+import crl_store
+from trust_store import Trust_store
+from cert_cache import Certificate_cache, Verification_cache
+from cert_finder import _get_tbs_certificate, get_validity
+from cert_loader import read_certificate_file
+
+logger = logging.getLogger("certs.cert_manager")
 
 
 class CertificateManager(object):
@@ -37,32 +46,111 @@ class CertificateManager(object):
   application wide singleton for storage and caching of parsed certificates
   """
   
-  _cert_store = {}
-  trusted_certificates = []
+  _cert_store = None
+  _verification_cache = None
+  # guards creation of the caches
+  _lock = threading.Lock()
+  trusted_certificates = Trust_store()
+
+  @classmethod
+  def get_cert_store(cls):
+    '''
+    Returns cache of parsed certificates, created according to properties
+    on the first use. Its byte limit (CERT_CACHE_MAX_BYTES) counts the
+    length of DER of the cached certificates, not the memory taken by
+    their parsed form
+    '''
+    if cls._cert_store is None:
+      cls._lock.acquire()
+      try:
+        if cls._cert_store is None:
+          store = Certificate_cache(props.CERT_CACHE_SIZE,
+                                    props.CERT_CACHE_MAX_BYTES,
+                                    props.CERT_CACHE_TTL)
+          cls._pin_configured_certificates(store)
+          cls._cert_store = store
+      finally:
+        cls._lock.release()
+    return cls._cert_store
+
+  @classmethod
+  def _pin_configured_certificates(cls, store):
+    '''
+    Pins certificates from files listed in PINNED_CERTIFICATES
+    (e.g. the current signing certificates of ISDS) in store
+    '''
+    for path in props.PINNED_CERTIFICATES.split(","):
+      path = path.strip()
+      if not path:
+        continue
+      ders = read_certificate_file(path)
+      if not ders:
+        logger.warning("No certificate to pin found in %s", path)
+      for der in ders:
+        store.pin(cls._hash_certificate_der_data(der))
 
+  @classmethod
+  def get_verification_cache(cls):
+    if cls._verification_cache is None:
+      cls._lock.acquire()
+      try:
+        if cls._verification_cache is None:
+          cls._verification_cache = Verification_cache(
+                                            props.VERIFICATION_CACHE_SIZE)
+      finally:
+        cls._lock.release()
+    return cls._verification_cache
+
+  @classmethod
+  def get_cache_stats(cls):
+    return cls.get_cert_store().stats()
+
+  @classmethod
+  def pin_certificate(cls, der):
+    '''
+    Keeps certificate (e.g. the current signing certificate of ISDS)
+    in the cache until it is unpinned
+    '''
+    cls.get_cert_store().pin(cls._hash_certificate_der_data(der))
+
+  @classmethod
+  def unpin_certificate(cls, der):
+    cls.get_cert_store().unpin(cls._hash_certificate_der_data(der))
+
+  @classmethod
+  def _cache_certificate(cls, h, cert, der):
+    store = cls.get_cert_store()
+    # trusted certificates stay in the cache
+    if h in cls.trusted_certificates.get_der_hashes():
+      store.pin(h)
+    store.put(h, cert, len(der))
 
   @classmethod
   def get_certificate_from_der(cls, der):
     h = cls._hash_certificate_der_data(der)
-    if h in cls._cert_store:
-      return cls._cert_store[h]
+    cert = cls.get_cert_store().get(h)
+    if cert is not None:
+      cls._update_verification(cert, h)
+      return cert
     else:
       from pyasn1.codec.der import decoder
       from pkcs7.asn1_models.X509_certificate import Certificate
       data = decoder.decode(der,asn1Spec=Certificate())[0]
       cert = cls._create_certificate(data, der)
-      cls._cert_store[h] = cert
+      cls._cache_certificate(h, cert, der)
       return cert
   
   @classmethod
   def get_certificate(cls, data):
     der = encoder.encode(data)
     h = cls._hash_certificate_der_data(der)
-    if h in cls._cert_store:
-      return cls._cert_store[h]
+    cert = cls.get_cert_store().get(h)
+    if cert is not None:
+      cls._update_verification(cert, h, data)
+      return cert
     else:
       cert = cls._create_certificate(data, der)
-      cls._cert_store[h] = cert
+      cls._cache_certificate(h, cert, der)
       return cert
     
   @classmethod
@@ -70,30 +158,107 @@ class CertificateManager(object):
     cls.trusted_certificates.append(cert)
   
   @classmethod
-  def read_trusted_certificates_from_dir(cls, dirname):
-    for cert in cert_loader.load_certificates_from_dir(dirname):
-      cls.add_trusted_certificate(cert)
+  def read_trusted_certificates_from_dir(cls, dirname, snapshot_path=None):
+    '''
+    Adds trusted certificates from directory, they are taken from its
+    snapshot and only changed files are parsed (see trust_store).
+    The snapshot is stored in TRUST_SNAPSHOT_FILE, if it is set
+    '''
+    if snapshot_path is None:
+      snapshot_path = props.TRUST_SNAPSHOT_FILE or None
+    cls.trusted_certificates.add_dir(dirname, snapshot_path)
     
   @classmethod
-  def verify_asn1_certificate(cls, certificate):
+  def verify_asn1_certificate(cls, certificate, der=None):
     '''
-    Verfies certificate by calling method from cert_verifier
+    Verfies certificate by calling method from cert_verifier.
+    Results are reused until the certificate becomes valid or expires,
+    trusted certificates change, CRLs of its issuer change or they are
+    too stale to be used
     '''
+    if der is None:
+      der = encoder.encode(certificate)
+    h = cls._hash_certificate_der_data(der)
+    issuer = str(_get_tbs_certificate(certificate).getComponentByName("issuer"))
+    res = cls._cached_verification(h, issuer)
+    if res is not None:
+      return res
     res = cert_verifier.verify_certificate(
                             certificate,
                             cls.trusted_certificates,
                             check_crl = props.CHECK_CRL,
                             force_crl_download=props.FORCE_CRL_DOWNLOAD
                             )
+    not_before, not_after = get_validity(certificate)
+    now = time.time()
+    valid_from, valid_until = not_before, not_after
+    if not_after is not None and now >= not_after:
+      # expired certificate stays expired
+      valid_from, valid_until = not_after, None
+    elif not_before is not None and now <= not_before:
+      valid_from, valid_until = None, not_before
+    crl_version, crl_until = cls._crl_state(issuer)
+    if crl_until is not None and (valid_until is None or
+                                  crl_until < valid_until):
+      valid_until = crl_until
+    cls.get_verification_cache().put(h, cls.trusted_certificates.version,
+                                     crl_version, res, valid_from, valid_until)
     return res
+
+  @classmethod
+  def _crl_state(cls, issuer):
+    '''
+    Returns version of CRLs of issuer and time (seconds) until which
+    results checked against them may be reused (None - not limited)
+    '''
+    if not props.CHECK_CRL:
+      return None, None
+    iss = crl_store.CRL_cache_manager.get_cache().get_issuer(issuer)
+    if iss is None or \
+       not [dp for dp in iss.dist_points if dp.lastUpdated is not None]:
+      # no CRL could be applied and the check passed without it,
+      # the certificate is checked again after CRL_REFRESH_RETRY
+      return iss and iss.crl_version(), time.time() + props.CRL_REFRESH_RETRY
+    next_update = iss.next_update_seconds()
+    if next_update is None:
+      return iss.crl_version(), None
+    # cached CRLs are used until they are stale for CRL_STALE_GRACE,
+    # their new version changes the key of the result
+    return iss.crl_version(), next_update + props.CRL_STALE_GRACE
+
+  @classmethod
+  def _cached_verification(cls, h, issuer):
+    if props.FORCE_CRL_DOWNLOAD:
+      return None
+    return cls.get_verification_cache().get(h,
+                                            cls.trusted_certificates.version,
+                                            cls._crl_state(issuer)[0])
+
+  @classmethod
+  def _update_verification(cls, cert, h, data=None):
+    '''
+    Verifies cached certificate again if its verification results
+    are no longer valid
+    '''
+    if not props.VERIFY_CERTIFICATE:
+      return
+    res = cls._cached_verification(h, cert.issuer_name)
+    if res is None:
+      if data is None:
+        from pyasn1.codec.der import decoder
+        from pkcs7.asn1_models.X509_certificate import Certificate
+        data = decoder.decode(cert.raw_der_data, asn1Spec=Certificate())[0]
+      res = cls.verify_asn1_certificate(data, cert.raw_der_data)
+    cert.verification_results = res
   
   @classmethod
   def _create_certificate(cls, data, der):
     from pkcs7_models import X509Certificate
     cert = X509Certificate(data)
     cert.raw_der_data = der
+    cert.issuer_name = str(_get_tbs_certificate(data).getComponentByName("issuer"))
     if props.VERIFY_CERTIFICATE:
-      cert.verification_results = cls.verify_asn1_certificate(data)
+      cert.verification_results = cls.verify_asn1_certificate(data, der)
     return cert
     
   @classmethod
@@ -0,0 +1,137 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of reuse of certificate verification results - they are kept
+until CRLs of the issuer change or get stale and they are not kept
+long when no CRL could be applied.
+Run with python -m dslib.certs.cert_manager_test
+'''
+
+# standard library imports
+import time
+import unittest
+
+# dslib imports
+from pyasn1.codec.der import decoder
+from dslib.pkcs7.asn1_models.X509_certificate import Certificate
+from dslib.properties.properties import Properties as props
+
+# local imports
+import cert_verifier
+import crl_store
+from cert_finder import _get_tbs_certificate
+from cert_manager import CertificateManager
+from crl_generator import Test_CA
+
+
+def _utc_time(seconds):
+    return time.strftime('%y%m%d%H%M%SZ', time.gmtime(seconds))
+
+
+class Verification_reuse_test(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(Verification_reuse_test, 'ca'):
+            Verification_reuse_test.ca = Test_CA(bits=1024, seed=1)
+        now = int(time.time())
+        der = self.ca.issue_certificate(1234, 'Test user',
+                                        not_before=now - 86400,
+                                        not_after=now + 10 * 365 * 86400)
+        self.der = der
+        self.certificate = decoder.decode(der, asn1Spec=Certificate())[0]
+        self.issuer_name = str(_get_tbs_certificate(self.certificate).\
+                                 getComponentByName("issuer"))
+        self.cache = crl_store.CRL_cache()
+        self.issuer = self.cache.add_issuer(self.issuer_name)
+        self.dpoint = self.issuer.add_dist_point('http://127.0.0.1:1/test.crl')
+        self.saved = (crl_store.CRL_cache_manager._crl_cache,
+                      CertificateManager._verification_cache,
+                      cert_verifier.verify_certificate,
+                      props.CHECK_CRL, props.FORCE_CRL_DOWNLOAD,
+                      props.CRL_REFRESH_RETRY, props.CRL_STALE_GRACE)
+        crl_store.CRL_cache_manager._crl_cache = self.cache
+        CertificateManager._verification_cache = None
+        props.CHECK_CRL = True
+        props.FORCE_CRL_DOWNLOAD = False
+        props.CRL_REFRESH_RETRY = 300
+        props.CRL_STALE_GRACE = 3600
+        self.verified = []
+        def verify_certificate(certificate, *args, **kwargs):
+            # CRL check which failed open
+            self.verified.append(certificate)
+            return {'CERT_NOT_REVOKED': True}
+        cert_verifier.verify_certificate = verify_certificate
+
+    def tearDown(self):
+        (crl_store.CRL_cache_manager._crl_cache,
+         CertificateManager._verification_cache,
+         cert_verifier.verify_certificate,
+         props.CHECK_CRL, props.FORCE_CRL_DOWNLOAD,
+         props.CRL_REFRESH_RETRY, props.CRL_STALE_GRACE) = self.saved
+
+    def verify(self, times=4):
+        for i in xrange(times):
+            CertificateManager.verify_asn1_certificate(self.certificate,
+                                                       self.der)
+        return len(self.verified)
+
+    def cached_until(self):
+        cache = CertificateManager.get_verification_cache()._cache
+        return [entry[0][2] for entry in cache._entries.values()]
+
+    def apply_crl(self, next_update):
+        self.dpoint.update_revoked(_utc_time(time.time() - 60),
+                                   _utc_time(next_update), [])
+
+    def test_no_crl_applied(self):
+        self.assertEqual(self.verify(), 1)
+        # the result is not kept for the life of the certificate
+        until, = self.cached_until()
+        self.assert_(until <= time.time() + props.CRL_REFRESH_RETRY)
+
+    def test_no_crl_applied_retry(self):
+        props.CRL_REFRESH_RETRY = 0
+        self.assertEqual(self.verify(), 4)
+
+    def test_fresh_crl(self):
+        next_update = int(time.time()) + 3600
+        self.apply_crl(next_update)
+        self.assertEqual(self.verify(), 1)
+        self.assertEqual(self.cached_until(),
+                         [next_update + props.CRL_STALE_GRACE])
+
+    def test_crl_in_grace_period(self):
+        self.apply_crl(int(time.time()) - 60)
+        self.assertEqual(self.verify(), 1)
+
+    def test_stale_crl(self):
+        self.apply_crl(int(time.time()) - 2 * props.CRL_STALE_GRACE)
+        self.assertEqual(self.verify(), 4)
+
+    def test_new_crl(self):
+        self.apply_crl(int(time.time()) + 3600)
+        self.assertEqual(self.verify(), 1)
+        # another CRL changes the key of cached results
+        self.dpoint.update_revoked(_utc_time(time.time() - 30),
+                                   _utc_time(time.time() + 7200),
+                                   [(5, _utc_time(time.time() - 30))])
+        self.assertEqual(self.verify(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
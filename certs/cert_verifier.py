@@ -24,6 +24,7 @@ Module for certificate verification.
 # standard library imports
 import logging
 import types
+import time
 
 # dslib imports
 from pyasn1.codec.der import encoder
@@ -32,9 +33,11 @@ from dslib.pkcs7.asn1_models.oid import *
 from dslib.pkcs7.digest import *
 from dslib.pkcs7 import verifier
 from dslib.pkcs7 import rsa_verifier
+from dslib.properties.properties import Properties as props
 
 # local imports
 import crl_store
+import ocsp_client
 from cert_finder import *
 import timeutil
 from constants import *
@@ -49,10 +52,10 @@ def _verify_date(certificate):
     validity = tbs.getComponentByName("validity")
     start = validity.getComponentByName("notBefore").getComponentByPosition(0)._value
         
-    start_time = timeutil.to_time(start)#time.strptime(start, format)
+    start_time = timeutil.to_seconds_from_epoch(start)
     end = validity.getComponentByName("notAfter").getComponentByPosition(0)._value
-    end_time = timeutil.to_time(end)#time.strptime(end, format)
-    now = timeutil.now()#time.gmtime()    
+    end_time = timeutil.to_seconds_from_epoch(end)
+    now = timeutil.to_seconds_from_epoch()
     
     if (start_time < now) and (end_time > now):    
         return True
@@ -60,9 +63,31 @@ def _verify_date(certificate):
                 (start, end))
     return False
 
+def _get_key_material(certificate, trusted_ca_certs):
+    '''
+    Returns algorithm and key material of certificate, trusted certificates
+    from Trust_store have them extracted already.
+    '''
+    if hasattr(trusted_ca_certs, 'get_key_material'):
+        key_material = trusted_ca_certs.get_key_material(certificate)
+        if key_material is not None:
+            return key_material
+    return verifier._get_key_material(certificate)
+
+def _attach_to_scheduler(scheduler, iss, issuer_cert):
+    '''
+    Gives the certificate of CRL issuer to the refresh scheduler,
+    so that it can verify the CRLs it downloads.
+    '''
+    if iss is not None and iss.verification is None:
+      iss.verification = issuer_cert
+      scheduler.schedule(iss)
+
 def _check_crl(checked_cert, issuer_cert, force_download=False):
     '''
     Checks if the certificate is not revoked by its issuer.
+    When the CRL refresh scheduler runs, CRLs of known issuers are only
+    read from the cache (unless force_download is set).
     '''    
     # extract CDT from issuer certificate
     # find issuer and its cdt in cache
@@ -73,6 +98,10 @@ def _check_crl(checked_cert, issuer_cert, force_download=False):
     tbs = cert_finder._get_tbs_certificate(checked_cert)
     # serial number of checked certificate
     cert_sn = tbs.getComponentByName("serialNumber")._value
+    if props.CHECK_OCSP:
+      status = _check_ocsp(checked_cert, issuer_cert)
+      if status is not None:
+        return status
     # get the CRL cache
     crl_cache = crl_store.CRL_cache_manager.get_cache()
     # get the name of issuer of CRL
@@ -83,21 +112,28 @@ def _check_crl(checked_cert, issuer_cert, force_download=False):
     dist_points = crl_store.extract_crl_distpoints(c)
     # look for CRL issuer in the cache
     iss = crl_cache.get_issuer(issuer_name)
+    scheduler = crl_store.CRL_cache_manager.get_scheduler()
     download_crl_success = False
+    crl_store.CRL_cache_manager.get_stats().cache_access(issuer_name,
+                                                         iss is not None)
+    if iss is not None:
+      # CRLs of the issuer may have been only imported
+      iss.add_cert_dist_points(dist_points)
     if iss is None:
-      # add new CRL issuer
-      added = crl_cache.add_issuer(issuer_name)
-      # add issuer's CDPs to issuer
-      for dp in dist_points:
-        added_dp = added.add_dist_point(dp)
-        if added_dp is not None:
-          crl_cache.changed = True
-          # initialize added CDP
-          download_success, added_certs = added.init_dist_point(dp, verification=issuer_cert)
-          # if download of CRL was successful, ignore other CDP
-          if download_success:
-            download_crl_success = True
-            break
+      # add new CRL issuer (unless another thread has just added it)
+      added = crl_cache.add_issuer(issuer_name) or \
+              crl_cache.get_issuer(issuer_name)
+      crl_cache.changed = True
+      # add issuer's CDPs to issuer and initialize them
+      download_crl_success, added_certs = added.init_issuer(dist_points,
+                                                            verification=issuer_cert)
+    elif scheduler is not None and not force_download:
+      # CRLs are refreshed in background, only read the cache
+      _attach_to_scheduler(scheduler, iss, issuer_cert)
+      download_crl_success = iss.is_fresh(props.CRL_STALE_GRACE)
+      if not download_crl_success:
+        logger.error("CRLs of %s are stale, background refresh failed" % issuer_name)
+        return False
     else:
       # if CRL issuer exists, only refresh his CDPs
       download_crl_success, added_certs = iss.\
@@ -105,6 +141,9 @@ def _check_crl(checked_cert, issuer_cert, force_download=False):
                                                      force_crl_download=force_download)
       if iss.changed:
         crl_cache.change = True
+    if scheduler is not None:
+      _attach_to_scheduler(scheduler, crl_cache.get_issuer(issuer_name),
+                           issuer_cert)
      
     # if CRL download failed from each CDP and the cache
     # is empty, return False - we cannot say anything about
@@ -128,6 +167,26 @@ def _check_crl(checked_cert, issuer_cert, force_download=False):
     
     
 
+def _check_ocsp(checked_cert, issuer_cert):
+    '''
+    Asks OCSP responder of the issuer for the status of the certificate.
+    Returns True/False (not revoked/revoked) or None when the status is
+    not known and CRLs have to be checked.
+    '''
+    try:
+      status = ocsp_client.get_client().check_certificate(checked_cert,
+                                                          issuer_cert)
+    except Exception, ex:
+      logger.warning("OCSP check failed: %s" % ex)
+      return None
+    if status is None or status.status == ocsp_client.UNKNOWN:
+      logger.info("OCSP status not available, checking CRLs")
+      return None
+    if status.status == ocsp_client.REVOKED:
+      logger.warning("Certificate revoked on %s (OCSP)" % status.revocation_time)
+      return False
+    return True
+
 def verify_certificate(cert, trusted_ca_certs=[],\
                        check_crl=False, force_crl_download=False):
     '''
@@ -170,7 +229,7 @@ def verify_certificate(cert, trusted_ca_certs=[],\
     # look for signing certificate among certificates
     issuer = str(tbs.getComponentByName("issuer"))  
     subject = str(tbs.getComponentByName("subject"))
-    signing_cert = find_cert_by_subject(issuer, trusted_ca_certs)        
+    signing_cert = find_issuer(cert, trusted_ca_certs, issuer)
     if not signing_cert:
         msg = "No certificate found for %s, needed to verify certificate of %s" %\
                (issuer,subject)
@@ -194,7 +253,9 @@ def verify_certificate(cert, trusted_ca_certs=[],\
     # if we want to download and check the crl of issuing authority 
     # for certificate being checked
     if check_crl:
+        started = time.time()
         is_ok = _check_crl(cert, signing_cert, force_download=force_crl_download)
+        crl_store.CRL_cache_manager.get_stats().check(time.time() - started)
         csn = tbs.getComponentByName("serialNumber")._value
         if not is_ok:
           msg = "Certificate %d issued by %s is revoked" % (csn,issuer)
@@ -205,7 +266,7 @@ def verify_certificate(cert, trusted_ca_certs=[],\
           results["CERT_NOT_REVOKED"] = True
     
     # extract public key from matching certificate
-    alg, key_material = verifier._get_key_material(signing_cert)
+    alg, key_material = _get_key_material(signing_cert, trusted_ca_certs)
     # decrypt signature in explored certificate
     signature = cert.getComponentByName("signatureValue").toOctets()    
     # compare calculated hash and decrypted signature
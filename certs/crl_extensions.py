@@ -0,0 +1,93 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Extensions of CRLs needed for delta CRLs (RFC 5280, 5.2).
+'''
+
+# dslib imports
+from pyasn1.codec.der import decoder
+from pyasn1.type import tag, univ
+from dslib.pkcs7.asn1_models.tools import tuple_to_OID
+from dslib.pkcs7.asn1_models.X509_certificate import Extensions
+from dslib.pkcs7.asn1_models.certificate_extensions import CRLDistributionPoints
+
+CRL_NUMBER_EXT_ID = '2.5.29.20'
+DELTA_CRL_INDICATOR_EXT_ID = '2.5.29.27'
+FRESHEST_CRL_EXT_ID = '2.5.29.46'
+
+# crlExtensions component of tbsCertList
+_CRL_EXTENSIONS_SPEC = Extensions().subtype(
+              explicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0x0))
+
+
+def extensions_to_dict(extensions):
+  '''
+  Converts pyasn1 Extensions into dictionary OID -> DER encoded value.
+  '''
+  res = {}
+  if extensions is None:
+    return res
+  for ext in extensions:
+    oid = tuple_to_OID(ext.getComponentByName("extnID"))
+    res[oid] = ext.getComponentByName("extnValue")._value
+  return res
+
+def decode_crl_extensions(der_data):
+  '''
+  Decodes DER encoded crlExtensions component into dictionary
+  OID -> DER encoded value.
+  '''
+  exts = decoder.decode(der_data, asn1Spec=_CRL_EXTENSIONS_SPEC)[0]
+  return extensions_to_dict(exts)
+
+def _get_integer(extensions, oid):
+  value = extensions.get(oid)
+  if value is None:
+    return None
+  return int(decoder.decode(value, asn1Spec=univ.Integer())[0])
+
+def get_crl_number(extensions):
+  '''
+  Returns cRLNumber of the CRL or None.
+  '''
+  return _get_integer(extensions, CRL_NUMBER_EXT_ID)
+
+def get_delta_base(extensions):
+  '''
+  Returns BaseCRLNumber from deltaCRLIndicator or None, if the CRL
+  is not a delta CRL.
+  '''
+  return _get_integer(extensions, DELTA_CRL_INDICATOR_EXT_ID)
+
+def get_freshest_crl_urls(extensions):
+  '''
+  Returns list of HTTP URLs of delta CRLs from freshestCRL extension.
+  '''
+  value = extensions.get(FRESHEST_CRL_EXT_ID)
+  if value is None:
+    return []
+  res = []
+  for dp in decoder.decode(value, asn1Spec=CRLDistributionPoints())[0]:
+    name = dp.getComponentByName("distPoint")
+    if name is None:
+      continue
+    for url in str(name.getComponent()).split(";"):
+      url = url.strip(" ,")
+      if url.startswith("http://"):
+        res.append(url)
+  return res
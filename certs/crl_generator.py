@@ -0,0 +1,293 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+
+'''
+Generator of signed test CRLs issued by a local test CA.
+Used by the benchmarks to measure the CRL code offline, it can be run
+also as a command writing the CRL and the CA certificate to files:
+python -m dslib.certs.crl_generator [options] count crl_file
+'''
+
+# standard library imports
+import sys
+import time
+import random
+import hashlib
+import optparse
+
+# OIDs used in the generated structures (content octets only)
+SHA256_RSA_OID = '\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b'
+RSA_OID = '\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+SHA256_OID = '\x60\x86\x48\x01\x65\x03\x04\x02\x01'
+COMMON_NAME_OID = '\x55\x04\x03'
+BASIC_CONSTRAINTS_OID = '\x55\x1d\x13'
+KEY_USAGE_OID = '\x55\x1d\x0f'
+CRL_NUMBER_OID = '\x55\x1d\x14'
+DELTA_CRL_INDICATOR_OID = '\x55\x1d\x1b'
+FRESHEST_CRL_OID = '\x55\x1d\x2e'
+REASON_CODE_OID = '\x55\x1d\x15'
+
+RSA_EXPONENT = 65537
+DEFAULT_KEY_BITS = 1024
+
+
+def _der_length(length):
+  if length < 128:
+    return chr(length)
+  res = ''
+  while length:
+    res = chr(length & 0xFF) + res
+    length >>= 8
+  return chr(0x80 | len(res)) + res
+
+def _der(tag, content):
+  return chr(tag) + _der_length(len(content)) + content
+
+def _der_int(number):
+  res = ''
+  while number:
+    res = chr(number & 0xFF) + res
+    number >>= 8
+  if not res or ord(res[0]) & 0x80:
+    res = '\x00' + res
+  return _der(0x02, res)
+
+def _der_seq(*parts):
+  return _der(0x30, ''.join(parts))
+
+def _der_time(seconds):
+  '''
+  UTCTime of seconds since the epoch.
+  '''
+  return _der(0x17, time.strftime('%y%m%d%H%M%SZ', time.gmtime(seconds)))
+
+def _der_name(common_name):
+  return _der_seq(_der(0x31, _der_seq(_der(0x06, COMMON_NAME_OID),
+                                      _der(0x0c, common_name))))
+
+def _der_extension(oid, value, critical=False):
+  if critical:
+    return _der_seq(_der(0x06, oid), '\x01\x01\xff', _der(0x04, value))
+  return _der_seq(_der(0x06, oid), _der(0x04, value))
+
+SIGNATURE_ALGORITHM = _der_seq(_der(0x06, SHA256_RSA_OID), '\x05\x00')
+
+
+def _is_probable_prime(number, rnd, rounds=20):
+  '''
+  Miller-Rabin primality test.
+  '''
+  if number < 2:
+    return False
+  for small in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+    if number % small == 0:
+      return number == small
+  d, r = number - 1, 0
+  while d % 2 == 0:
+    d //= 2
+    r += 1
+  for i in xrange(rounds):
+    x = pow(rnd.randrange(2, number - 1), d, number)
+    if x in (1, number - 1):
+      continue
+    for j in xrange(r - 1):
+      x = pow(x, 2, number)
+      if x == number - 1:
+        break
+    else:
+      return False
+  return True
+
+def _random_prime(bits, rnd):
+  while True:
+    candidate = rnd.getrandbits(bits) | (1 << (bits - 1)) | 1
+    if _is_probable_prime(candidate, rnd):
+      return candidate
+
+def _inverse(a, modulus):
+  g, x, b, y = modulus, 0, a, 1
+  while b:
+    q = g // b
+    g, b = b, g - q * b
+    x, y = y, x - q * y
+  return x % modulus
+
+def generate_rsa_key(bits=DEFAULT_KEY_BITS, rnd=None):
+  '''
+  Returns RSA key (modulus, public exponent, private exponent).
+  It is meant for tests only - pass seeded random.Random to get
+  the same key on every run.
+  '''
+  rnd = rnd or random.SystemRandom()
+  while True:
+    p = _random_prime(bits // 2, rnd)
+    q = _random_prime(bits - bits // 2, rnd)
+    phi = (p - 1) * (q - 1)
+    if p != q and phi % RSA_EXPONENT:
+      return p * q, RSA_EXPONENT, _inverse(RSA_EXPONENT, phi)
+
+
+class Test_CA(object):
+  '''
+  Self-signed certification authority issuing CRLs
+  (sha256WithRSAEncryption signatures).
+  '''
+
+  def __init__(self, common_name="Test CA", bits=DEFAULT_KEY_BITS, seed=None,
+               not_before=None, validity=10 * 365 * 86400):
+    self.common_name = common_name
+    rnd = random.Random(seed) if seed is not None else None
+    self.modulus, self.exponent, self.private_exponent = \
+                                            generate_rsa_key(bits, rnd)
+    self.name = _der_name(common_name)
+    if not_before is None:
+      not_before = int(time.time()) - 86400
+    self.certificate_der = self.__make_certificate(not_before,
+                                                   not_before + validity)
+
+  def sign(self, data):
+    '''
+    Returns PKCS#1 v1.5 signature of SHA-256 digest of data.
+    '''
+    digest_info = _der_seq(_der_seq(_der(0x06, SHA256_OID), '\x05\x00'),
+                           _der(0x04, hashlib.sha256(data).digest()))
+    size = (self.modulus.bit_length() + 7) // 8
+    padded = '\x00\x01' + '\xff' * (size - 3 - len(digest_info)) + '\x00' + \
+             digest_info
+    signature = pow(int(padded.encode('hex'), 16), self.private_exponent,
+                    self.modulus)
+    signature = '%x' % signature
+    return ('0' * (2 * size - len(signature)) + signature).decode('hex')
+
+  def _signed(self, tbs):
+    return _der_seq(tbs, SIGNATURE_ALGORITHM,
+                    _der(0x03, '\x00' + self.sign(tbs)))
+
+  def __make_certificate(self, not_before, not_after):
+    extensions = _der_extension(BASIC_CONSTRAINTS_OID,
+                                _der_seq('\x01\x01\xff'), critical=True) + \
+                 _der_extension(KEY_USAGE_OID, '\x03\x02\x01\x06',
+                                critical=True)
+    return self.issue_certificate(1, self.common_name, extensions=extensions,
+                                  not_before=not_before, not_after=not_after)
+
+  def issue_certificate(self, serial, common_name, public_key=None,
+                        extensions='', not_before=None, not_after=None):
+    '''
+    Returns DER encoded certificate issued by the CA. public_key is
+    tuple (modulus, exponent), the key of the CA by default. extensions
+    are DER encoded Extension structures (see _der_extension).
+    '''
+    if public_key is None:
+      public_key = (self.modulus, self.exponent)
+    if not_before is None:
+      not_before = int(time.time()) - 86400
+    if not_after is None:
+      not_after = not_before + 2 * 86400
+    key_info = _der_seq(_der_seq(_der(0x06, RSA_OID), '\x05\x00'),
+                        _der(0x03, '\x00' + _der_seq(_der_int(public_key[0]),
+                                                     _der_int(public_key[1]))))
+    tbs = _der(0xa0, _der_int(2)) + _der_int(serial) + SIGNATURE_ALGORITHM + \
+          self.name + _der_seq(_der_time(not_before), _der_time(not_after)) + \
+          _der_name(common_name) + key_info
+    if extensions:
+      tbs += _der(0xa3, _der_seq(extensions))
+    return self._signed(_der(0x30, tbs))
+
+  def certificate(self):
+    '''
+    Returns the CA certificate decoded with pyasn1.
+    '''
+    from pyasn1.codec.der import decoder
+    from dslib.pkcs7.asn1_models.X509_certificate import Certificate
+    return decoder.decode(self.certificate_der, asn1Spec=Certificate())[0]
+
+  def make_crl(self, count, this_update=None, next_update=None,
+               first_serial=1000, step=7, crl_number=None, delta_base=None,
+               freshest_url=None, reasons=None):
+    '''
+    Returns DER encoded CRL with count revoked certificates - serial
+    numbers first_serial + i * step. Revocation reason of i-th entry
+    is reasons[i % len(reasons)] when reasons are given (None means
+    no reason). CRL with delta_base is a delta CRL.
+    '''
+    if this_update is None:
+      this_update = int(time.time()) - 60
+    if next_update is None:
+      next_update = this_update + 86400
+    entries = []
+    for i in xrange(count):
+      entry = _der_int(first_serial + i * step) + \
+              _der_time(this_update - count + i)
+      if reasons:
+        reason = reasons[i % len(reasons)]
+        if reason is not None:
+          entry += _der_seq(_der_extension(REASON_CODE_OID,
+                                           _der(0x0a, chr(reason))))
+      entries.append(_der(0x30, entry))
+    body = _der_int(1) + SIGNATURE_ALGORITHM + self.name + \
+           _der_time(this_update) + _der_time(next_update)
+    if entries:
+      body += _der(0x30, ''.join(entries))
+    extensions = ''
+    if crl_number is not None:
+      extensions += _der_extension(CRL_NUMBER_OID, _der_int(crl_number))
+    if delta_base is not None:
+      extensions += _der_extension(DELTA_CRL_INDICATOR_OID,
+                                   _der_int(delta_base), critical=True)
+    if freshest_url is not None:
+      general_name = _der(0x86, freshest_url)
+      extensions += _der_extension(FRESHEST_CRL_OID,
+                        _der_seq(_der_seq(_der(0xa0, _der(0xa0, general_name)))))
+    if extensions:
+      body += _der(0xa0, _der_seq(extensions))
+    return self._signed(_der(0x30, body))
+
+
+USAGE = '''%prog [options] count crl_file
+Writes CRL with count revoked certificates signed by a test CA.'''
+
+def main(argv):
+  parser = optparse.OptionParser(usage=USAGE)
+  parser.add_option("-c", "--ca-certificate", dest="ca_file",
+                    help="write certificate of the test CA to CA_FILE")
+  parser.add_option("-n", "--name", dest="name", default="Test CA",
+                    help="common name of the test CA")
+  parser.add_option("-s", "--seed", dest="seed", type="int",
+                    help="seed of the CA key generation")
+  parser.add_option("-b", "--bits", dest="bits", type="int",
+                    default=DEFAULT_KEY_BITS, help="size of the CA key")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 2 or not args[0].isdigit():
+    parser.error("count and crl_file are required")
+  ca = Test_CA(options.name, options.bits, options.seed)
+  f = open(args[1], "wb")
+  try:
+    f.write(ca.make_crl(int(args[0])))
+  finally:
+    f.close()
+  if options.ca_file:
+    f = open(options.ca_file, "wb")
+    try:
+      f.write(ca.certificate_der)
+    finally:
+      f.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,278 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of CRL downloads against a local HTTP server - conditional
+requests (ETag), unchanged content, delta CRLs which need newer
+base CRL, concurrent downloads from mirrors and refreshes of imported
+CRLs. Run with python -m dslib.certs.crl_http_test
+'''
+
+# standard library imports
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# dslib imports
+from dslib.properties.properties import Properties as props
+
+# local imports
+import crl_store
+import crl_verifier
+from crl_generator import Test_CA
+from worker_pool import Worker_pool
+
+SERIAL_STEP = 7
+
+
+def _utc_time(seconds):
+    return time.strftime('%y%m%d%H%M%SZ', time.gmtime(seconds))
+
+
+class _CRL_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        content = server.files.get(self.path)
+        if content is None:
+            server.responses.append((self.path, 404))
+            self.send_error(404)
+            return
+        etag = None
+        if server.etags:
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            server.responses.append((self.path, 304))
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        server.responses.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pkix-crl')
+        self.send_header('Content-Length', str(len(content)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class CRL_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves CRLs from files (path -> content), answers conditional
+    requests with 304 when etags are enabled and records responses
+    (path, status).
+    '''
+    daemon_threads = True
+
+    def __init__(self, etags=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _CRL_handler)
+        self.files = {}
+        self.etags = etags
+        self.responses = []
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def statuses(self, path):
+        return [status for p, status in self.responses if p == path]
+
+
+class CRL_download_test(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(CRL_download_test, 'ca'):
+            CRL_download_test.ca = Test_CA(bits=1024, seed=1)
+        self.ca_cert = self.ca.certificate()
+        self.stream = props.STREAM_CRL_DOWNLOAD
+        props.STREAM_CRL_DOWNLOAD = False
+        self.verified = []
+        self.verify_crl = crl_verifier.verify_crl
+        def verify_crl(*args):
+            self.verified.append(args)
+            return self.verify_crl(*args)
+        crl_verifier.verify_crl = verify_crl
+        self.server = None
+
+    def tearDown(self):
+        crl_verifier.verify_crl = self.verify_crl
+        props.STREAM_CRL_DOWNLOAD = self.stream
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def start_server(self, etags=True):
+        self.server = CRL_server(etags)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def make_issuer(self, path):
+        issuer = crl_store.CRL_issuer('Test CA')
+        issuer.add_dist_point(self.server.url(path))
+        return issuer, issuer.dist_points[0]
+
+    def test_etag_not_modified(self):
+        server = self.start_server(etags=True)
+        server.files['/test.crl'] = self.ca.make_crl(10)
+        issuer, dpoint = self.make_issuer('/test.crl')
+        self.assertEqual(issuer.init_dist_point(dpoint.url, self.ca_cert),
+                         (True, 10))
+        self.assert_(dpoint.get_validators(dpoint.url).get('etag'))
+        self.assertEqual(issuer.refresh_dist_point(dpoint.url, self.ca_cert,
+                                                   force_download=True),
+                         (True, 0))
+        self.assertEqual(server.statuses('/test.crl'), [200, 304])
+        self.assertEqual(len(self.verified), 1)
+        self.assert_(issuer.certificate_revoked(1000))
+
+    def test_unchanged_content(self):
+        server = self.start_server(etags=False)
+        now = int(time.time())
+        server.files['/test.crl'] = self.ca.make_crl(10, now - 120)
+        issuer, dpoint = self.make_issuer('/test.crl')
+        issuer.init_dist_point(dpoint.url, self.ca_cert)
+        self.assertEqual(issuer.refresh_dist_point(dpoint.url, self.ca_cert,
+                                                   force_download=True),
+                         (True, 0))
+        self.assertEqual(server.statuses('/test.crl'), [200, 200])
+        # the same content is neither decoded nor verified again
+        self.assertEqual(len(self.verified), 1)
+        # changed content is
+        server.files['/test.crl'] = self.ca.make_crl(11, now - 60)
+        self.assertEqual(issuer.refresh_dist_point(dpoint.url, self.ca_cert,
+                                                   force_download=True),
+                         (True, 1))
+        self.assertEqual(len(self.verified), 2)
+        self.assert_(issuer.certificate_revoked(1000 + 10 * SERIAL_STEP))
+
+    def test_delta_requiring_newer_base(self):
+        server = self.start_server(etags=True)
+        now = int(time.time())
+        delta_url = server.url('/delta.crl')
+        server.files['/test.crl'] = self.ca.make_crl(3, now - 120,
+                                                     crl_number=10,
+                                                     freshest_url=delta_url)
+        # delta which is already due
+        server.files['/delta.crl'] = self.ca.make_crl(1, now - 120, now - 60,
+                                                      first_serial=4000,
+                                                      crl_number=11,
+                                                      delta_base=10)
+        issuer, dpoint = self.make_issuer('/test.crl')
+        self.assertEqual(issuer.init_dist_point(dpoint.url, self.ca_cert),
+                         (True, 4))
+        self.assert_(dpoint.delta_due())
+        # new delta revoking 5000 is based on a new base CRL
+        server.files['/test.crl'] = self.ca.make_crl(3, now - 60,
+                                                     crl_number=12,
+                                                     freshest_url=delta_url)
+        server.files['/delta.crl'] = self.ca.make_crl(1, first_serial=5000,
+                                                      crl_number=13,
+                                                      delta_base=12)
+        self.assertEqual(issuer.refresh_dist_point(dpoint.url, self.ca_cert),
+                         (True, 1))
+        self.assertEqual(dpoint.crlNumber, 12)
+        self.assertEqual(dpoint.deltaCrlNumber, 13)
+        self.assert_(issuer.certificate_revoked(5000))
+        self.failIf(dpoint.delta_due())
+        # the delta was downloaded again after the base CRL
+        self.assertEqual(server.statuses('/delta.crl'), [200, 200, 200])
+        # and its validators are used from now on
+        dpoint.deltaNextUpdate = None
+        self.assertEqual(issuer.refresh_dist_point(dpoint.url, self.ca_cert),
+                         (True, 0))
+        self.assertEqual(server.statuses('/delta.crl'), [200, 200, 200, 304])
+        self.assert_(issuer.certificate_revoked(5000))
+
+    def test_mirrors(self):
+        server = self.start_server(etags=False)
+        now = int(time.time())
+        # both mirrors have CRL which is already due
+        for path in ('/a.crl', '/b.crl'):
+            server.files[path] = self.ca.make_crl(3, now - 7200, now - 3600)
+        issuer, dpoint = self.make_issuer('/a.crl')
+        issuer.add_dist_point(server.url('/b.crl'))
+        for dp in issuer.dist_points:
+            issuer.init_dist_point(dp.url, self.ca_cert)
+        for path in ('/a.crl', '/b.crl'):
+            server.files[path] = self.ca.make_crl(4, now - 60, now + 3600)
+        pool = Worker_pool(2)
+        try:
+            self.assertEqual(issuer.refresh_issuer(self.ca_cert, pool=pool),
+                             (True, 1))
+            requests = len(server.responses)
+            self.assertEqual(issuer.next_update_seconds(), now + 3600)
+            self.failIf(issuer.freshest_dist_point().base_due())
+            # the mirror which lost the race is not downloaded again
+            for i in xrange(3):
+                self.assertEqual(issuer.refresh_issuer(self.ca_cert,
+                                                       pool=pool),
+                                 (True, 0))
+            self.assertEqual(len(server.responses), requests)
+        finally:
+            pool.close()
+        self.assert_(issuer.certificate_revoked(1000 + 3 * SERIAL_STEP))
+
+    def test_imported(self):
+        server = self.start_server(etags=False)
+        now = int(time.time())
+        dirname = tempfile.mkdtemp()
+        try:
+            f = open(os.path.join(dirname, 'test.crl'), 'wb')
+            f.write(self.ca.make_crl(3, now - 60, now + 3600))
+            f.close()
+            cache = crl_store.CRL_cache()
+            self.assertEqual(cache.import_dir(dirname, [self.ca_cert]),
+                             (1, 0))
+        finally:
+            shutil.rmtree(dirname)
+        issuer = cache.issuers[0]
+        imported = issuer.dist_points[0]
+        self.failIf(imported.is_downloadable())
+        # the imported file is not used as CDP
+        self.assertEqual(issuer.refresh_issuer(self.ca_cert,
+                                               force_crl_download=True),
+                         (False, 0))
+        self.assertEqual(issuer.add_cert_dist_points(
+                                    [server.url('/test.crl')]), 1)
+        self.assertEqual(issuer.add_cert_dist_points(
+                                    [server.url('/other.crl')]), 0)
+        self.assertEqual(len(issuer.dist_points), 2)
+        # the imported CRL is used until it is due
+        self.assertEqual(issuer.refresh_issuer(self.ca_cert), (True, 0))
+        self.assertEqual(server.responses, [])
+        server.files['/test.crl'] = self.ca.make_crl(4, now - 30, now + 7200)
+        imported.nextUpdate = _utc_time(now - 1)
+        self.assertEqual(issuer.refresh_issuer(self.ca_cert), (True, 4))
+        self.assertEqual(server.statuses('/test.crl'), [200])
+        self.assertEqual(issuer.next_update_seconds(), now + 7200)
+        self.assert_(issuer.certificate_revoked(1000 + 3 * SERIAL_STEP))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Binary index file with the content of CRL cache.
+The file is memory mapped when loaded, so only the directory is parsed
+and blocks of revoked serial numbers are read by the OS on first access.
+
+Layout (all offsets are absolute):
+- header: magic, format version, offset and length of the directory
+- for each distribution point: sorted serial numbers block (fixed width
+  records) followed by block of revocation dates (see revoked_store)
+- directory: marshalled list of issuers with their distribution points
+  (url, metadata, offsets of serial and date blocks)
+'''
+
+# standard library imports
+import os
+import mmap
+import struct
+import marshal
+import logging
+logger = logging.getLogger('certs.crl_index')
+
+# local imports
+from revoked_store import Revoked_store, DATE_SIZE, _widen_dates
+
+INDEX_MAGIC = 'DSCRLIDX'
+INDEX_VERSION = 2
+# version 1 stored dates as unsigned 32 bit numbers
+_OLD_VERSIONS = {1: 4}
+_HEADER = struct.Struct('>8sHHQQ')
+
+
+def _replace_file(tmp_path, path):
+  '''
+  Moves tmp_path to path (atomically where the platform allows it)
+  '''
+  try:
+    os.rename(tmp_path, path)
+  except OSError:
+    # rename does not overwrite existing files on Windows
+    os.remove(path)
+    os.rename(tmp_path, path)
+
+def write_index(issuers, path):
+  '''
+  Writes index of issuers (list of CRL_issuer) into file path.
+  The file is written under temporary name first and then replaces
+  the old one, so readers never see a half written index.
+  '''
+  tmp_path = path + '.tmp'
+  f = open(tmp_path, 'wb')
+  try:
+    f.write('\x00' * _HEADER.size)
+    offset = _HEADER.size
+    directory = []
+    for issuer in issuers:
+      dpoints = []
+      for dpoint in issuer.dist_points:
+        serials, dates, count, width = dpoint.revoked_certs.get_buffers()
+        f.write(serials)
+        f.write(dates)
+        dpoints.append({'url': dpoint.url,
+                        'meta': dpoint.get_meta(),
+                        'count': count,
+                        'width': width,
+                        'serials': offset,
+                        'dates': offset + count * width})
+        offset += count * width + count * DATE_SIZE
+      directory.append({'name': issuer.name, 'dist_points': dpoints})
+    dir_data = marshal.dumps(directory)
+    f.write(dir_data)
+    f.seek(0)
+    f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, offset, len(dir_data)))
+  finally:
+    f.close()
+  _replace_file(tmp_path, path)
+  logger.debug("CRL index written to %s (%d bytes)" % (path, offset))
+
+def read_index(path):
+  '''
+  Maps index file into memory.
+  Returns the mapping and the directory. Raises ValueError if the file
+  is not an index or has unsupported version.
+  '''
+  f = open(path, 'rb')
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if size < _HEADER.size:
+      raise ValueError("CRL index %s is truncated" % path)
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+  magic, version, flags, dir_offset, dir_length = _HEADER.unpack_from(mm, 0)
+  if magic != INDEX_MAGIC:
+    raise ValueError("File %s is not a CRL index" % path)
+  if version != INDEX_VERSION and version not in _OLD_VERSIONS:
+    raise ValueError("Unsupported CRL index version %d" % version)
+  if dir_offset + dir_length > size:
+    raise ValueError("CRL index %s is truncated" % path)
+  directory = marshal.loads(mm[dir_offset:dir_offset + dir_length])
+  if version in _OLD_VERSIONS:
+    for iss_entry in directory:
+      for entry in iss_entry['dist_points']:
+        entry['date_size'] = _OLD_VERSIONS[version]
+  return mm, directory
+
+def open_store(mm, entry):
+  '''
+  Returns Revoked_store reading directly from the mapped index
+  for distribution point entry of the directory.
+  '''
+  count, width = entry['count'], entry['width']
+  serials = buffer(mm, entry['serials'], count * width)
+  date_size = entry.get('date_size', DATE_SIZE)
+  dates = buffer(mm, entry['dates'], count * date_size)
+  if date_size != DATE_SIZE:
+    # index of older version, converted until it is written again
+    dates = _widen_dates(dates, count)
+  return Revoked_store.from_buffers(serials, dates, count, width)
@@ -0,0 +1,178 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of the index with snapshot of the CRL cache - round trip, damaged
+files and indexes of version 1.
+Run with python -m dslib.certs.crl_index_test
+'''
+
+# standard library imports
+import marshal
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+# local imports
+import crl_index
+import crl_journal
+import crl_store
+from revoked_store import _pack_date
+
+URL = 'http://crl.example.com/ca%d.crl'
+
+
+def _revoked(first, count, step=7):
+    return [(first + i * step, '1201%02d120000Z' % (i % 28 + 1))
+            for i in xrange(count)]
+
+
+def _content(cache):
+    '''
+    Returns comparable content of the cache.
+    '''
+    return dict(((iss.name, dpoint.url),
+                 (dpoint.get_meta(), sorted(dpoint.revoked_certs)))
+                for iss in cache.issuers for dpoint in iss.dist_points)
+
+
+class Stored_cache_test(unittest.TestCase):
+    '''
+    Cache stored in a temporary directory
+    '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'crl.idx')
+        self.journal = crl_journal.journal_path(self.path)
+        self.saved = (crl_store.JOURNAL_COMPACT_RATIO,
+                      crl_store.JOURNAL_MIN_COMPACT_SIZE)
+
+    def tearDown(self):
+        (crl_store.JOURNAL_COMPACT_RATIO,
+         crl_store.JOURNAL_MIN_COMPACT_SIZE) = self.saved
+        shutil.rmtree(self.dir)
+
+    def make_cache(self, issuers=3, count=100):
+        cache = crl_store.CRL_cache()
+        for i in xrange(issuers):
+            iss = cache.add_issuer('CN=Test CA %d' % i)
+            dpoint = iss.add_dist_point(URL % i)
+            dpoint.update_revoked('120201000000Z', '120301000000Z',
+                                  _revoked(1000 * i, count * i))
+            dpoint.crlNumber = i
+        return cache
+
+    def write(self, data):
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+
+    def read(self, path=None):
+        f = open(path or self.path, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def refresh(self, cache, i, count):
+        '''
+        Adds count certificates to CRL of the i-th issuer.
+        '''
+        dpoint = cache.issuers[i].dist_points[0]
+        first = 100000 * (len(dpoint.revoked_certs) + 1)
+        dpoint.update_revoked('1202%02d000000Z' % (i + 2), '120401000000Z',
+                              list(dpoint.revoked_certs) +
+                              _revoked(first, count))
+
+
+class CRL_index_test(Stored_cache_test):
+
+    def test_round_trip(self):
+        cache = self.make_cache()
+        # serial numbers wider than 64 bits
+        dpoint = cache.issuers[0].dist_points[0]
+        dpoint.update_revoked('120201000000Z', None,
+                              [(2 ** 130 + 1, '20510101000000Z'),
+                               (5, '')])
+        cache.save(self.path)
+        loaded = crl_store.CRL_cache.load(self.path)
+        self.assertEqual(_content(loaded), _content(cache))
+        self.assertEqual(loaded.issuers[0].dist_points[0].
+                         revoked_certs.get(2 ** 130 + 1), '20510101000000Z')
+        self.assertEqual(loaded.get_issuer('CN=Test CA 2').
+                         certificate_revoked(2000 + 7), '120102120000Z')
+        # only the header of an empty journal
+        self.assertEqual(len(self.read(self.journal)),
+                         crl_journal._HEADER.size)
+
+    def test_damaged_index(self):
+        self.make_cache().save(self.path)
+        data = self.read()
+        for damaged in (data[:10], data[:-1], 'XXXXXXXX' + data[8:],
+                        data[:8] + struct.pack('>H', 99) + data[10:]):
+            self.write(damaged)
+            self.assertRaises(ValueError, crl_index.read_index, self.path)
+        # the cache manager starts with an empty cache
+        dump_dir = crl_store.CRL_DUMP_DIR
+        index_file = crl_store.CRL_INDEX_FILE
+        crl_store.CRL_DUMP_DIR, crl_store.CRL_INDEX_FILE = \
+                                self.dir, os.path.basename(self.path)
+        try:
+            self.assertEqual(crl_store._restore_cache(), None)
+        finally:
+            crl_store.CRL_DUMP_DIR, crl_store.CRL_INDEX_FILE = \
+                                dump_dir, index_file
+
+    def test_version_1(self):
+        cache = self.make_cache()
+        # index of version 1 - dates are unsigned 32 bit numbers
+        blocks = []
+        directory = []
+        offset = crl_index._HEADER.size
+        for iss in cache.issuers:
+            dpoints = []
+            for dpoint in iss.dist_points:
+                serials, dates, count, width = \
+                                        dpoint.revoked_certs.get_buffers()
+                old_dates = struct.pack('<%dI' % count,
+                                        *[_pack_date(date) for sn, date
+                                          in dpoint.revoked_certs])
+                blocks += [serials, old_dates]
+                dpoints.append({'url': dpoint.url, 'meta': dpoint.get_meta(),
+                                'count': count, 'width': width,
+                                'serials': offset,
+                                'dates': offset + count * width})
+                offset += count * width + count * 4
+            directory.append({'name': iss.name, 'dist_points': dpoints})
+        dir_data = marshal.dumps(directory)
+        self.write(crl_index._HEADER.pack(crl_index.INDEX_MAGIC, 1, 0,
+                                          offset, len(dir_data)) +
+                   ''.join(blocks) + dir_data)
+        loaded = crl_store.CRL_cache.load(self.path)
+        self.assertEqual(_content(loaded), _content(cache))
+        # the index is upgraded when it is written again
+        loaded.save(self.path, compact=True)
+        self.assertEqual(crl_index._HEADER.unpack_from(self.read())[1],
+                         crl_index.INDEX_VERSION)
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
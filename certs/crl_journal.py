@@ -0,0 +1,125 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Append-only journal of changes of the CRL cache.
+Each refresh appends one record per changed distribution point (its new
+CRL metadata and newly revoked certificates), so the cost of storing
+the cache is proportional to the change. Records are replayed on top of
+the index snapshot when the cache is loaded and folded into the snapshot
+when the cache is compacted.
+
+Record: big endian length and crc32 of the payload, marshalled dictionary
+with keys issuer, url, meta, added (packed records of Revoked_store -
+tuple serials, dates, count, width; version 1 used list of serial number,
+date pairs) and removed (serial numbers removed by delta CRLs).
+Replaying a record twice has no effect, so a crash between writing a new
+snapshot and truncating the journal is harmless.
+'''
+
+# standard library imports
+import os
+import struct
+import marshal
+import zlib
+import logging
+logger = logging.getLogger('certs.crl_journal')
+
+JOURNAL_MAGIC = 'DSCRLJNL'
+JOURNAL_VERSION = 2
+# older versions which can be read
+_OLD_VERSIONS = (1,)
+_HEADER = struct.Struct('>8sH')
+_RECORD = struct.Struct('>Ii')
+
+
+def journal_path(index_path):
+  '''
+  Returns path of the journal belonging to index file.
+  '''
+  return index_path + '.journal'
+
+def _make_record(issuer, dpoint):
+  serials, dates, count, width = dpoint.pending_revoked.get_buffers()
+  payload = marshal.dumps({'issuer': issuer.name,
+                           'url': dpoint.url,
+                           'meta': dpoint.get_meta(),
+                           'added': (str(serials), str(dates), count, width),
+                           'removed': dpoint.pending_removed})
+  return _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+def append(path, records):
+  '''
+  Appends changes to the journal. records is a list of (CRL_issuer,
+  CRL_dist_point) pairs. Returns size of the journal after the write.
+  '''
+  data = ''.join([_make_record(issuer, dpoint) for issuer, dpoint in records])
+  if not os.path.exists(path) or os.path.getsize(path) < _HEADER.size:
+    reset(path)
+  f = open(path, 'ab')
+  try:
+    # one write call, so that concurrent writers do not interleave records
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+  finally:
+    f.close()
+
+def reset(path):
+  '''
+  Creates an empty journal (after its content was compacted into
+  the snapshot).
+  '''
+  f = open(path, 'wb')
+  try:
+    f.write(_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION))
+  finally:
+    f.close()
+
+def read(path):
+  '''
+  Generator of journal records (dictionaries). Stops at the first
+  incomplete or damaged record (e.g. after a crash during write).
+  '''
+  if not os.path.exists(path):
+    return
+  f = open(path, 'rb')
+  try:
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+      return
+    magic, version = _HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or \
+       (version != JOURNAL_VERSION and version not in _OLD_VERSIONS):
+      logger.warning("Unsupported CRL journal %s ignored" % path)
+      return
+    while True:
+      head = f.read(_RECORD.size)
+      if not head:
+        return
+      if len(head) < _RECORD.size:
+        logger.warning("Incomplete record at the end of CRL journal")
+        return
+      length, crc = _RECORD.unpack(head)
+      payload = f.read(length)
+      if len(payload) < length or zlib.crc32(payload) != crc:
+        logger.warning("Damaged record at the end of CRL journal")
+        return
+      yield marshal.loads(payload)
+  finally:
+    f.close()
@@ -0,0 +1,160 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of the journal of changes of the CRL cache - replay on top of
+the index, damaged records, records of version 1 and compaction.
+Run with python -m dslib.certs.crl_journal_test
+'''
+
+# standard library imports
+import marshal
+import unittest
+import zlib
+
+# local imports
+import crl_index
+import crl_journal
+import crl_store
+from crl_index_test import Stored_cache_test, _content, _revoked
+from fast_rev_cert_parser import REMOVE_FROM_CRL
+
+
+class CRL_journal_test(Stored_cache_test):
+
+    def test_journal(self):
+        cache = self.make_cache()
+        cache.save(self.path)
+        index = self.read()
+        self.refresh(cache, 1, 10)
+        # the removal by delta CRL is journaled too
+        dpoint = cache.issuers[2].dist_points[0]
+        dpoint.apply_delta('120202000000Z', '120203000000Z',
+                           [(2007, ''), (5, '120201000000Z')],
+                           {2007: REMOVE_FROM_CRL}, 3)
+        self.failIf(2007 in dpoint.revoked_certs)
+        cache.save(self.path)
+        self.refresh(cache, 1, 5)
+        cache.issuers[0].changed = True
+        cache.save(self.path)
+        # the index is not rewritten by small changes
+        self.assertEqual(self.read(), index)
+        records = list(crl_journal.read(self.journal))
+        # numbers of added certificates
+        self.assertEqual([(record['issuer'], record['added'][2])
+                          for record in records],
+                         [('CN=Test CA 1', 10), ('CN=Test CA 2', 1),
+                          ('CN=Test CA 0', 0), ('CN=Test CA 1', 5)])
+        self.assertEqual(records[1]['removed'], [2007])
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(cache))
+        # replaying the journal over snapshot which already contains it
+        # (crash before the journal was emptied)
+        crl_index.write_index(cache.issuers, self.path)
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(cache))
+
+    def test_damaged_journal(self):
+        cache = self.make_cache()
+        cache.save(self.path)
+        self.refresh(cache, 0, 3)
+        cache.save(self.path)
+        expected = _content(cache)
+        self.refresh(cache, 1, 3)
+        cache.save(self.path)
+        data = self.read(self.journal)
+        # the end of the first record
+        first_end = crl_journal._HEADER.size + crl_journal._RECORD.size + \
+                    crl_journal._RECORD.unpack_from(data,
+                                        crl_journal._HEADER.size)[0]
+        damaged = list(data)
+        damaged[-1] = chr(ord(damaged[-1]) ^ 1)
+        for journal in (''.join(damaged), data[:-1],
+                        data[:first_end + 3], data[:first_end]):
+            f = open(self.journal, 'wb')
+            f.write(journal)
+            f.close()
+            # records after the damaged one are ignored
+            self.assertEqual(len(list(crl_journal.read(self.journal))), 1)
+            self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                             expected)
+        # journal of unknown version is ignored
+        f = open(self.journal, 'wb')
+        f.write(crl_journal._HEADER.pack(crl_journal.JOURNAL_MAGIC, 99) +
+                data[crl_journal._HEADER.size:])
+        f.close()
+        self.assertEqual(list(crl_journal.read(self.journal)), [])
+
+    def test_journal_version_1(self):
+        cache = self.make_cache()
+        cache.save(self.path)
+        dpoint = cache.issuers[1].dist_points[0]
+        added = _revoked(50000, 5)
+        dpoint.update_revoked('120202000000Z', '120401000000Z',
+                              list(dpoint.revoked_certs) + added)
+        # records of version 1 keep the added certificates in a list
+        payload = marshal.dumps({'issuer': cache.issuers[1].name,
+                                 'url': dpoint.url,
+                                 'meta': dpoint.get_meta(),
+                                 'added': added,
+                                 'removed': []})
+        f = open(self.journal, 'wb')
+        f.write(crl_journal._HEADER.pack(crl_journal.JOURNAL_MAGIC, 1) +
+                crl_journal._RECORD.pack(len(payload), zlib.crc32(payload)) +
+                payload)
+        f.close()
+        loaded = crl_store.CRL_cache.load(self.path)
+        self.assertEqual(_content(loaded), _content(cache))
+        # records of the current version are appended after them
+        self.refresh(loaded, 0, 2)
+        loaded.save(self.path)
+        self.assertEqual(len(list(crl_journal.read(self.journal))), 2)
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(loaded))
+
+    def test_compaction(self):
+        cache = self.make_cache()
+        cache.save(self.path)
+        self.refresh(cache, 1, 3)
+        cache.save(self.path, compact=True)
+        self.assertEqual(list(crl_journal.read(self.journal)), [])
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(cache))
+        # the journal is folded into the index when it grows too big
+        crl_store.JOURNAL_MIN_COMPACT_SIZE = 0
+        crl_store.JOURNAL_COMPACT_RATIO = 0.5
+        index_size = len(self.read())
+        sizes = []
+        while True:
+            self.refresh(cache, 2, 20)
+            cache.save(self.path)
+            records = list(crl_journal.read(self.journal))
+            if not records:
+                break
+            sizes.append(len(self.read(self.journal)))
+        self.assert_(sizes)
+        self.assert_(max(sizes) <= 0.5 * index_size)
+        self.assertEqual(_content(crl_store.CRL_cache.load(self.path)),
+                         _content(cache))
+        # nothing is written without changes
+        index = self.read()
+        cache.save(self.path)
+        self.assertEqual(self.read(), index)
+
+
+if __name__ == '__main__':
+    unittest.main()
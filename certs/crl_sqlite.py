@@ -0,0 +1,587 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+CRL cache stored in SQLite database shared by processes.
+Revoked certificates are kept in table revoked(issuer_key, serial, date),
+metadata of distribution points in table dist_points. The database runs
+in WAL mode, so readers are not blocked by a refresh.
+Refresh of an issuer is coordinated through a row in table locks - one
+process downloads the CRLs, the others wait for it (or use the stored
+CRLs) and see its result as soon as it is committed.
+'''
+
+# standard library imports
+import os
+import time
+import socket
+import marshal
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger('certs.crl_sqlite')
+
+# dslib imports
+from dslib.properties.properties import Properties as props
+
+# local imports
+import crl_store
+from crl_store import CRL_cache, CRL_issuer, CRL_dist_point, issuer_key,\
+                      normalize_url
+from revoked_store import Revoked_store, _pack_date, _unpack_date, \
+                          _byte_len, _to_record
+
+# seconds after which lock of a refresh is considered abandoned, the lock
+# is extended while the refresh runs (see _Lock_keeper)
+LOCK_TIMEOUT = 300
+# seconds between extensions of the held lock
+LOCK_EXTEND_INTERVAL = LOCK_TIMEOUT / 3
+# seconds between checks of lock held by another process
+LOCK_POLL_INTERVAL = 0.5
+# seconds to wait for database locked by another writer
+BUSY_TIMEOUT = 30
+# maximal number of serial numbers in one query
+SQL_CHUNK = 500
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS issuers (
+              issuer_key TEXT PRIMARY KEY,
+              name TEXT NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS dist_points (
+              issuer_key TEXT NOT NULL,
+              url_key TEXT NOT NULL,
+              url TEXT NOT NULL,
+              meta BLOB NOT NULL,
+              PRIMARY KEY (issuer_key, url_key))''',
+    '''CREATE TABLE IF NOT EXISTS revoked (
+              issuer_key TEXT NOT NULL,
+              serial BLOB NOT NULL,
+              date INTEGER NOT NULL,
+              PRIMARY KEY (issuer_key, serial))''',
+    '''CREATE TABLE IF NOT EXISTS locks (
+              name TEXT PRIMARY KEY,
+              owner TEXT NOT NULL,
+              expires REAL NOT NULL)''',
+    ]
+
+# states of refresh started by SQLite_CRL_issuer.start_refresh
+_IDLE = 'idle'
+_LOCKED = 'locked'
+_BUSY = 'busy'
+
+
+def _to_blob(serial):
+    return buffer(_to_record(serial, _byte_len(serial)))
+
+
+class Shared_store(object):
+    '''
+    Revoked certificates of one issuer in the database, shared by all its
+    distribution points. Provides the part of Revoked_store interface
+    used by the cache. Changes are kept in memory until they are flushed
+    by the refresh which made them.
+    '''
+
+    def __init__(self, cache, issuer_key):
+        self.cache = cache
+        self.issuer_key = issuer_key
+        # serial number -> packed date of not yet stored certificates
+        self._added = {}
+        # serial numbers to be removed from the database
+        self._removed = set()
+
+    def _select(self, serials):
+        '''
+        Returns dictionary serial number -> packed date of serials stored
+        in the database.
+        '''
+        serials = [sn for sn in serials if sn >= 0]
+        found = {}
+        conn = self.cache.connection()
+        for i in xrange(0, len(serials), SQL_CHUNK):
+            chunk = serials[i:i+SQL_CHUNK]
+            by_blob = dict((str(_to_blob(sn)), sn) for sn in chunk)
+            query = 'SELECT serial, date FROM revoked WHERE issuer_key = ? ' \
+                    'AND serial IN (%s)' % ','.join('?' * len(by_blob))
+            params = [self.issuer_key] + [buffer(blob) for blob in by_blob]
+            for serial, date in conn.execute(query, params):
+                found[by_blob[str(serial)]] = date
+        return found
+
+    def get(self, serial, default=None):
+        date = self.get_many([serial])[0]
+        if date is None:
+            return default
+        # empty date - revoked on unknown date
+        return date
+
+    def get_many(self, serials):
+        '''
+        Returns list of revocation dates (or None) of serial numbers.
+        '''
+        stored = self._select([sn for sn in serials if sn not in self._added])
+        result = []
+        for sn in serials:
+            seconds = self._added.get(sn)
+            if seconds is None and sn not in self._removed:
+                seconds = stored.get(sn)
+            result.append(None if seconds is None else _unpack_date(seconds))
+        return result
+
+    def __contains__(self, serial):
+        return self.get(serial) is not None
+
+    def __len__(self):
+        count = self.cache.connection().execute(
+            'SELECT COUNT(*) FROM revoked WHERE issuer_key = ?',
+            (self.issuer_key,)).fetchone()[0]
+        return count + len(self._added) - len(self._removed)
+
+    def __iter__(self):
+        rows = self.cache.connection().execute(
+            'SELECT serial, date FROM revoked WHERE issuer_key = ?',
+            (self.issuer_key,))
+        for serial, date in rows:
+            sn = int(str(serial).encode('hex'), 16)
+            if sn not in self._removed and sn not in self._added:
+                yield sn, _unpack_date(date)
+        for sn, date in self._added.items():
+            yield sn, _unpack_date(date)
+
+    def add_many(self, revoked, added=None):
+        '''
+        Adds revoked certificates from iterable of (serial number, date) pairs.
+        If list added is given, newly added pairs are appended to it.
+        Returns number of added certificates.
+        '''
+        revoked = [(sn, date) for sn, date in revoked if sn >= 0]
+        new = {}
+        for i in xrange(0, len(revoked), SQL_CHUNK):
+            chunk = revoked[i:i+SQL_CHUNK]
+            stored = self._select([sn for sn, date in chunk])
+            for sn, date in chunk:
+                if sn in new or sn in self._added:
+                    continue
+                if sn in stored and sn not in self._removed:
+                    continue
+                new[sn] = date
+        for sn, date in new.iteritems():
+            self._removed.discard(sn)
+            self._added[sn] = _pack_date(date)
+        if added is not None:
+            added.extend(new.iteritems())
+        return len(new)
+
+    def discard_many(self, serials, removed=None):
+        '''
+        Removes serial numbers. If list removed is given, removed serial
+        numbers are appended to it. Returns number of removed certificates.
+        '''
+        serials = set(serials)
+        stored = self._select([sn for sn in serials if sn not in self._added])
+        done = []
+        for sn in serials:
+            if sn in self._added:
+                del self._added[sn]
+            elif sn not in stored or sn in self._removed:
+                continue
+            self._removed.add(sn)
+            done.append(sn)
+        if removed is not None:
+            removed.extend(done)
+        return len(done)
+
+    def has_changes(self):
+        return bool(self._added or self._removed)
+
+    def flush(self, conn):
+        '''
+        Writes changes into the database within transaction of conn.
+        '''
+        conn.executemany('DELETE FROM revoked WHERE issuer_key = ? AND serial = ?',
+                         [(self.issuer_key, _to_blob(sn))
+                          for sn in self._removed])
+        conn.executemany('INSERT OR REPLACE INTO revoked VALUES (?, ?, ?)',
+                         [(self.issuer_key, _to_blob(sn), date)
+                          for sn, date in self._added.iteritems()])
+        self.discard()
+
+    def discard(self):
+        self._added = {}
+        self._removed = set()
+
+
+class SQLite_CRL_issuer(CRL_issuer):
+    '''
+    Issuer of CRLs whose revoked certificates and metadata are stored
+    in the database. Refresh runs only in the process holding the lock
+    of the issuer.
+    '''
+
+    def __init__(self, name, cache):
+        CRL_issuer.__init__(self, name)
+        self.cache = cache
+        self.key = issuer_key(name)
+        self.store = Shared_store(cache, self.key)
+
+    def append_dist_point(self, dpoint):
+        dpoint.revoked_certs = self.store
+        CRL_issuer.append_dist_point(self, dpoint)
+
+    def add_dist_point(self, url, delta_url=None):
+        dpoint = CRL_issuer.add_dist_point(self, url, delta_url)
+        if dpoint is not None:
+            conn = self.cache.connection()
+            conn.execute('INSERT OR IGNORE INTO dist_points VALUES (?, ?, ?, ?)',
+                         (self.key, normalize_url(url), url,
+                          buffer(marshal.dumps(dpoint.get_meta()))))
+        return dpoint
+
+    def revoked_view(self):
+        return self.store
+
+    def certificate_revoked(self, cert_sn):
+        # dist points may be known only to other processes
+        rev_date = self.store.get(cert_sn)
+        crl_store.CRL_cache_manager.get_stats().lookup(self.name, 1,
+                                                       rev_date is not None)
+        return rev_date
+
+    def is_fresh(self, grace=0):
+        if CRL_issuer.is_fresh(self, grace):
+            return True
+        # CRLs may have been refreshed by another process
+        self.reload()
+        return CRL_issuer.is_fresh(self, grace)
+
+    def reload(self):
+        '''
+        Reads dist points and their metadata stored by other processes.
+        Dist points with unsaved changes are kept.
+        '''
+        rows = self.cache.connection().execute(
+            'SELECT url, meta FROM dist_points WHERE issuer_key = ?',
+            (self.key,))
+        for url, meta in rows:
+            dpoint = self.find_dpoint(url)
+            if dpoint is None:
+                dpoint = CRL_dist_point(url)
+                self.append_dist_point(dpoint)
+            elif dpoint.changed:
+                continue
+            dpoint.set_meta(marshal.loads(str(meta)))
+
+    def store_changes(self):
+        '''
+        Writes revoked certificates and metadata changed by refresh into
+        the database in one transaction.
+        '''
+        conn = self.cache.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.store.flush(conn)
+            for dpoint in self.dist_points:
+                conn.execute('INSERT OR REPLACE INTO dist_points VALUES (?, ?, ?, ?)',
+                             (self.key, normalize_url(dpoint.url), dpoint.url,
+                              buffer(marshal.dumps(dpoint.get_meta()))))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        self.changed = False
+        for dpoint in self.dist_points:
+            dpoint.changed = False
+            dpoint.pending_revoked = Revoked_store()
+            dpoint.pending_removed = []
+
+    def discard_changes(self):
+        self.store.discard()
+        for dpoint in self.dist_points:
+            dpoint.changed = False
+        self.reload()
+
+    def __due(self):
+        dpoint = self.freshest_dist_point()
+        return dpoint is None or dpoint.base_due() or dpoint.delta_due()
+
+    def __initialized(self):
+        for dpoint in self.dist_points:
+            if dpoint.lastUpdated is not None:
+                return True
+        return False
+
+    def start_refresh(self, verification=None, force_crl_download=False,
+                      pool=None):
+        self.reload()
+        if not (force_crl_download or self.__due()):
+            return (_IDLE, CRL_issuer.start_refresh(self, verification,
+                                                    force_crl_download, pool))
+        if not self.cache.acquire_lock(self.key):
+            logger.info("Issuer %s is being refreshed by another process" % self.name)
+            return (_BUSY, None)
+        try:
+            # the other process may have just finished
+            self.reload()
+            started = CRL_issuer.start_refresh(self, verification,
+                                               force_crl_download, pool)
+        except:
+            self.cache.release_lock(self.key)
+            raise
+        return (_LOCKED, started)
+
+    def finish_refresh(self, started):
+        state, started = started
+        if state is _IDLE:
+            return CRL_issuer.finish_refresh(self, started)
+        if state is _BUSY:
+            if not (props.CRL_REFRESH_WAIT is False and
+                    CRL_issuer.is_fresh(self, props.CRL_STALE_GRACE)):
+                self.cache.wait_for_lock(self.key)
+            self.reload()
+            return self.__initialized(), 0
+        try:
+            try:
+                result = CRL_issuer.finish_refresh(self, started)
+                self.store_changes()
+            except:
+                self.discard_changes()
+                raise
+        finally:
+            self.cache.release_lock(self.key)
+        return result
+
+    def init_issuer(self, urls, verification=None):
+        while True:
+            self.reload()
+            if self.__initialized():
+                return True, 0
+            if self.cache.acquire_lock(self.key):
+                break
+            self.cache.wait_for_lock(self.key)
+        try:
+            try:
+                result = CRL_issuer.init_issuer(self, urls, verification)
+                self.store_changes()
+            except:
+                self.discard_changes()
+                raise
+        finally:
+            self.cache.release_lock(self.key)
+        return result
+
+
+class _Lock_keeper(threading.Thread):
+    '''
+    Extends lock held by a refresh until it is stopped, so that a refresh
+    taking longer than LOCK_TIMEOUT (e.g. slow download of many CRLs)
+    does not lose the lock. If the process dies, the lock expires after
+    LOCK_TIMEOUT.
+    '''
+
+    def __init__(self, cache, lock_name, owner):
+        threading.Thread.__init__(self, name="CRL lock keeper %s" % lock_name)
+        self.setDaemon(True)
+        self.cache = cache
+        self.lock_name = lock_name
+        self.owner = owner
+        self._finished = threading.Event()
+
+    def stop(self):
+        self._finished.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            self._finished.wait(LOCK_EXTEND_INTERVAL)
+            if self._finished.isSet():
+                break
+            try:
+                if not self.cache.extend_lock(self.lock_name, self.owner):
+                    logger.warning("Lock %s was lost" % self.lock_name)
+                    break
+            except Exception, ex:
+                logger.warning("Extending lock %s failed: %s" % \
+                               (self.lock_name, ex))
+        self.cache.close_connection()
+
+
+class SQLite_CRL_cache(CRL_cache):
+    '''
+    CRL cache stored in SQLite database. Lookups read the database,
+    so changes made by other processes are seen immediately.
+    '''
+
+    def __init__(self, path):
+        CRL_cache.__init__(self)
+        # get_issuer loads issuers added by other processes, also when it is
+        # called by add_issuer holding the lock
+        self._lock = threading.RLock()
+        self.path = path
+        self._local = threading.local()
+        # lock name -> _Lock_keeper of locks held by this process
+        self._keepers = {}
+        conn = self.connection()
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        self.reload()
+
+    def connection(self):
+        '''
+        Returns connection to the database for the current thread.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close_connection(self):
+        '''
+        Closes connection of the current thread.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _new_issuer(self, issuer_name):
+        return SQLite_CRL_issuer(issuer_name, self)
+
+    def add_issuer(self, issuer_name):
+        iss = CRL_cache.add_issuer(self, issuer_name)
+        if iss is not None:
+            self.connection().execute('INSERT OR IGNORE INTO issuers VALUES (?, ?)',
+                                      (iss.key, issuer_name))
+        return iss
+
+    def get_issuer(self, issuer_name):
+        iss = CRL_cache.get_issuer(self, issuer_name)
+        if iss is None:
+            # the issuer may have been added by another process
+            row = self.connection().execute(
+                'SELECT name FROM issuers WHERE issuer_key = ?',
+                (issuer_key(issuer_name),)).fetchone()
+            if row is not None:
+                iss = self.__load_issuer(row[0])
+        return iss
+
+    def __load_issuer(self, name):
+        self._lock.acquire()
+        try:
+            iss = CRL_cache.get_issuer(self, name)
+            if iss is None:
+                iss = self._new_issuer(name)
+                iss.reload()
+                self.append_issuer(iss)
+            return iss
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        '''
+        Reads issuers stored by other processes.
+        '''
+        rows = self.connection().execute('SELECT name FROM issuers').fetchall()
+        for (name,) in rows:
+            self.__load_issuer(name)
+
+    def save(self, path=None, compact=False):
+        '''
+        Stores changes not yet written by refreshes (e.g. made by
+        refresh_dist_point called directly).
+        '''
+        for iss in list(self.issuers):
+            changed = iss.changed or iss.store.has_changes()
+            for dpoint in iss.dist_points:
+                changed = changed or dpoint.changed
+            if changed:
+                iss.lock.acquire()
+                try:
+                    iss.store_changes()
+                finally:
+                    iss.lock.release()
+        self.changed = False
+
+    def pickle(self):
+        self.save()
+
+    def _owner(self):
+        return '%s:%d:%d' % (socket.gethostname(), os.getpid(),
+                             threading.currentThread().ident)
+
+    def acquire_lock(self, name):
+        '''
+        Tries to take lock with name. Returns False if it is held by
+        another process (or thread).
+        '''
+        conn = self.connection()
+        owner = self._owner()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT owner, expires FROM locks WHERE name = ?',
+                               (name,)).fetchone()
+            now = time.time()
+            if row is not None and row[1] > now and row[0] != owner:
+                conn.execute('COMMIT')
+                return False
+            conn.execute('INSERT OR REPLACE INTO locks VALUES (?, ?, ?)',
+                         (name, owner, now + LOCK_TIMEOUT))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        keeper = _Lock_keeper(self, name, owner)
+        old_keeper = self._keepers.get(name)
+        self._keepers[name] = keeper
+        if old_keeper is not None:
+            old_keeper.stop()
+        keeper.start()
+        return True
+
+    def extend_lock(self, name, owner):
+        '''
+        Moves expiration of lock with name held by owner LOCK_TIMEOUT
+        seconds from now. Returns False if the lock is not held by owner.
+        '''
+        cursor = self.connection().execute(
+            'UPDATE locks SET expires = ? WHERE name = ? AND owner = ?',
+            (time.time() + LOCK_TIMEOUT, name, owner))
+        return cursor.rowcount > 0
+
+    def release_lock(self, name):
+        keeper = self._keepers.pop(name, None)
+        if keeper is not None:
+            keeper.stop()
+        self.connection().execute('DELETE FROM locks WHERE name = ? AND owner = ?',
+                                  (name, self._owner()))
+
+    def wait_for_lock(self, name, timeout=LOCK_TIMEOUT):
+        '''
+        Waits until lock with name is released (or expires).
+        '''
+        end = time.time() + timeout
+        conn = self.connection()
+        while time.time() < end:
+            row = conn.execute('SELECT expires FROM locks WHERE name = ?',
+                               (name,)).fetchone()
+            if row is None or row[0] <= time.time():
+                return
+            time.sleep(LOCK_POLL_INTERVAL)
@@ -0,0 +1,172 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of the CRL cache shared in SQLite database - visibility of stored
+changes to other caches (processes), refresh locks and their extension.
+Run with python -m dslib.certs.crl_sqlite_test
+'''
+
+# standard library imports
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+# local imports
+import crl_sqlite
+from crl_sqlite import SQLite_CRL_cache
+
+ISSUER = 'Test CA'
+URL = 'http://127.0.0.1:1/test.crl'
+
+
+def _in_thread(func, *args):
+    '''
+    Returns result of func called in another thread (which has its own
+    connection and lock owner, like another process).
+    '''
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args)))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+class SQLite_cache_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'crl_cache.sqlite')
+        self.interval = crl_sqlite.LOCK_EXTEND_INTERVAL
+        self.caches = []
+
+    def tearDown(self):
+        crl_sqlite.LOCK_EXTEND_INTERVAL = self.interval
+        for cache in self.caches:
+            for name in list(cache._keepers):
+                cache.release_lock(name)
+            cache.close_connection()
+        shutil.rmtree(self.dirname)
+
+    def open_cache(self):
+        cache = SQLite_CRL_cache(self.path)
+        self.caches.append(cache)
+        return cache
+
+    def add_issuer(self, cache, revoked):
+        iss = cache.add_issuer(ISSUER) or cache.get_issuer(ISSUER)
+        dpoint = iss.add_dist_point(URL) or iss.find_dpoint(URL)
+        dpoint.update_revoked('120101000000Z', '491231000000Z', revoked)
+        return iss
+
+    def test_unknown_date(self):
+        cache = self.open_cache()
+        iss = self.add_issuer(cache, [(5, ''), (6, '120101000000Z')])
+        # revoked on unknown date, before and after the flush
+        for i in xrange(2):
+            self.assertEqual(iss.store.get(5), '')
+            self.assertEqual(iss.store.get(5, 'x'), '')
+            self.assert_(5 in iss.store)
+            self.assertEqual(iss.store.get(7, 'x'), 'x')
+            self.assertEqual(iss.store.get_many([5, 6, 7]),
+                             ['', '120101000000Z', None])
+            iss.store_changes()
+        self.assertEqual(cache.certificate_rev_date(ISSUER, 5), '')
+        self.assert_(cache.is_certificate_revoked(ISSUER, 5))
+        self.failIf(cache.is_certificate_revoked(ISSUER, 7))
+
+    def test_shared_visibility(self):
+        writer = self.open_cache()
+        reader = self.open_cache()
+        iss = self.add_issuer(writer, [(sn, '120101000000Z')
+                                       for sn in (1, 2, 1 << 100)])
+        # issuer and its dist point are stored when they are added,
+        # revoked certificates when the changes are flushed
+        other = reader.get_issuer(ISSUER)
+        self.assertNotEqual(other, None)
+        self.failIf(reader.is_certificate_revoked(ISSUER, 2))
+        iss.store_changes()
+        self.assert_(reader.is_certificate_revoked(ISSUER, 2))
+        self.assert_(reader.is_certificate_revoked(ISSUER, 1 << 100))
+        self.assertEqual(len(other.store), 3)
+        other.reload()
+        self.assertEqual(other.dist_points[0].lastUpdated, '120101000000Z')
+        # removal
+        self.assertEqual(iss.store.discard_many([2, 3]), 1)
+        self.assert_(reader.is_certificate_revoked(ISSUER, 2))
+        self.failIf(writer.is_certificate_revoked(ISSUER, 2))
+        writer.save()
+        self.failIf(reader.is_certificate_revoked(ISSUER, 2))
+        self.assertEqual(sorted(other.store),
+                         [(1, '120101000000Z'), (1 << 100, '120101000000Z')])
+
+    def test_discarded_changes(self):
+        cache = self.open_cache()
+        iss = self.add_issuer(cache, [(1, '120101000000Z')])
+        iss.discard_changes()
+        self.failIf(iss.store.has_changes())
+        self.failIf(cache.is_certificate_revoked(ISSUER, 1))
+        self.assertEqual(self.open_cache().get_issuer(ISSUER).\
+                         dist_points[0].lastUpdated, None)
+
+    def test_lock(self):
+        cache = self.open_cache()
+        other = self.open_cache()
+        self.assert_(cache.acquire_lock('x'))
+        # taken again by its owner, not by others
+        self.assert_(cache.acquire_lock('x'))
+        self.failIf(_in_thread(other.acquire_lock, 'x'))
+        cache.release_lock('x')
+        self.assertEqual(cache.connection().execute(
+            'SELECT COUNT(*) FROM locks').fetchone()[0], 0)
+        self.assert_(_in_thread(other.acquire_lock, 'x'))
+        # lock of dead owner expires
+        other.connection().execute('UPDATE locks SET expires = ?',
+                                   (time.time() - 1,))
+        self.assert_(cache.acquire_lock('x'))
+        started = time.time()
+        cache.wait_for_lock('y')
+        cache.release_lock('x')
+        cache.wait_for_lock('x')
+        self.assert_(time.time() - started < 1)
+
+    def test_lock_keeper(self):
+        crl_sqlite.LOCK_EXTEND_INTERVAL = 0.05
+        cache = self.open_cache()
+        self.assert_(cache.acquire_lock('x'))
+        keeper = cache._keepers['x']
+        conn = cache.connection()
+        conn.execute('UPDATE locks SET expires = ?', (time.time() + 5,))
+        time.sleep(0.3)
+        expires = conn.execute('SELECT expires FROM locks').fetchone()[0]
+        self.assert_(expires > time.time() + crl_sqlite.LOCK_TIMEOUT - 1)
+        cache.release_lock('x')
+        self.failIf(keeper.isAlive())
+        self.failIf('x' in cache._keepers)
+        # keeper of lost lock ends
+        self.assert_(cache.acquire_lock('x'))
+        keeper = cache._keepers['x']
+        conn.execute('DELETE FROM locks')
+        keeper.join(5)
+        self.failIf(keeper.isAlive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Statistics of the revocation checking - downloads, decoding and
+verification of CRLs per distribution point, lookups per issuer and
+time spent in CRL checks of certificates.
+Exporters (callables taking name, value and tags) attached to CRL_stats
+get every recorded value, e.g. to pass it to a metrics system. Without
+exporters recording only updates the counters.
+'''
+
+# standard library imports
+import threading
+import logging
+logger = logging.getLogger('certs.crl_stats')
+
+# counters kept for each distribution point (URL of CRL or delta CRL)
+DPOINT_COUNTERS = ('downloads', 'download_failures', 'not_modified',
+                   'download_bytes', 'download_seconds',
+                   'decodes', 'decode_seconds',
+                   'verifications', 'verification_failures', 'verify_seconds')
+# counters kept for each issuer
+ISSUER_COUNTERS = ('lookups', 'revoked_found', 'cache_hits', 'cache_misses')
+# counters of CRL checks of certificates (cert_verifier._check_crl)
+CHECK_COUNTERS = ('checks', 'check_seconds', 'max_check_seconds')
+
+
+def _new_counters(names):
+    return dict.fromkeys(names, 0)
+
+
+class CRL_stats(object):
+    '''
+    Thread safe counters of the CRL cache.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (issuer name, url) -> counters
+        self._dpoints = {}
+        # issuer name -> counters
+        self._issuers = {}
+        self._checks = _new_counters(CHECK_COUNTERS)
+        self.exporters = []
+
+    def add_exporter(self, exporter):
+        '''
+        Attaches exporter - callable exporter(name, value, tags), where
+        tags is dictionary with 'issuer' and 'url' (when they apply).
+        '''
+        self.exporters = self.exporters + [exporter]
+
+    def remove_exporter(self, exporter):
+        self.exporters = [e for e in self.exporters if e is not exporter]
+
+    def _export(self, values, tags):
+        for exporter in self.exporters:
+            for name, value in values:
+                try:
+                    exporter(name, value, tags)
+                except Exception, ex:
+                    logger.warning("Stats exporter failed: %s" % ex)
+
+    def _add(self, table, key, names, values):
+        self._lock.acquire()
+        try:
+            counters = table.get(key)
+            if counters is None:
+                counters = table[key] = _new_counters(names)
+            for name, value in values:
+                counters[name] += value
+        finally:
+            self._lock.release()
+
+    def __dpoint(self, issuer, url, values):
+        self._add(self._dpoints, (issuer, url), DPOINT_COUNTERS, values)
+        if self.exporters:
+            self._export([('crl.' + name, value) for name, value in values],
+                         {'issuer': issuer, 'url': url})
+
+    def __issuer(self, issuer, values):
+        self._add(self._issuers, issuer, ISSUER_COUNTERS, values)
+        if self.exporters:
+            self._export([('crl.' + name, value) for name, value in values],
+                         {'issuer': issuer})
+
+    def download(self, issuer, url, size, seconds, success=True,
+                 not_modified=False):
+        '''
+        Records download of CRL from url (failed one when success is False).
+        '''
+        if not success:
+            values = [('download_failures', 1), ('download_seconds', seconds)]
+        elif not_modified:
+            values = [('downloads', 1), ('not_modified', 1),
+                      ('download_seconds', seconds)]
+        else:
+            values = [('downloads', 1), ('download_bytes', size),
+                      ('download_seconds', seconds)]
+        self.__dpoint(issuer, url, values)
+
+    def decode(self, issuer, url, seconds):
+        self.__dpoint(issuer, url, [('decodes', 1), ('decode_seconds', seconds)])
+
+    def verify(self, issuer, url, seconds, success=True):
+        values = [('verifications', 1), ('verify_seconds', seconds)]
+        if not success:
+            values.append(('verification_failures', 1))
+        self.__dpoint(issuer, url, values)
+
+    def lookup(self, issuer, count=1, found=0):
+        '''
+        Records lookups of count serial numbers in revoked certificates
+        of issuer, found of them were revoked.
+        '''
+        # called for every lookup, counters are updated directly
+        self._lock.acquire()
+        try:
+            counters = self._issuers.get(issuer)
+            if counters is None:
+                counters = self._issuers[issuer] = \
+                                            _new_counters(ISSUER_COUNTERS)
+            counters['lookups'] += count
+            counters['revoked_found'] += found
+        finally:
+            self._lock.release()
+        if self.exporters:
+            self._export([('crl.lookups', count), ('crl.revoked_found', found)],
+                         {'issuer': issuer})
+
+    def cache_access(self, issuer, hit):
+        '''
+        Records if CRLs of issuer were in the cache when a certificate
+        was checked (miss means they had to be downloaded first).
+        '''
+        self.__issuer(issuer, [(hit and 'cache_hits' or 'cache_misses', 1)])
+
+    def check(self, seconds):
+        '''
+        Records time spent in CRL check of a certificate.
+        '''
+        self._lock.acquire()
+        try:
+            self._checks['checks'] += 1
+            self._checks['check_seconds'] += seconds
+            if seconds > self._checks['max_check_seconds']:
+                self._checks['max_check_seconds'] = seconds
+        finally:
+            self._lock.release()
+        if self.exporters:
+            self._export([('crl.check_seconds', seconds)], {})
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._dpoints = {}
+            self._issuers = {}
+            self._checks = _new_counters(CHECK_COUNTERS)
+        finally:
+            self._lock.release()
+
+    def snapshot(self, cache=None):
+        '''
+        Returns dictionary with copy of the counters:
+        {'checks': {...}, 'issuers': {name: {counters...,
+          'dist_points': {url: {counters...}}}}}
+        When cache is given, dist points are completed with number of
+        revoked certificates and update times of their CRLs, and lookup
+        hit ratio of issuers is computed.
+        '''
+        self._lock.acquire()
+        try:
+            checks = dict(self._checks)
+            issuers = dict((name, dict(counters))
+                           for name, counters in self._issuers.iteritems())
+            dpoints = dict((key, dict(counters))
+                           for key, counters in self._dpoints.iteritems())
+        finally:
+            self._lock.release()
+        for (name, url), counters in dpoints.iteritems():
+            issuer = issuers.setdefault(name, _new_counters(ISSUER_COUNTERS))
+            issuer.setdefault('dist_points', {})[url] = counters
+        if cache is not None:
+            for iss in list(cache.issuers):
+                issuer = issuers.setdefault(iss.name,
+                                            _new_counters(ISSUER_COUNTERS))
+                dist_points = issuer.setdefault('dist_points', {})
+                for dpoint in list(iss.dist_points):
+                    counters = dist_points.setdefault(dpoint.url,
+                                            _new_counters(DPOINT_COUNTERS))
+                    counters['revoked'] = len(dpoint.revoked_certs)
+                    counters['thisUpdate'] = dpoint.lastUpdated
+                    counters['nextUpdate'] = dpoint.nextUpdate
+                    counters['crlNumber'] = dpoint.crlNumber
+                    if dpoint.deltaUrl:
+                        counters['deltaUrl'] = dpoint.deltaUrl
+                        counters['deltaThisUpdate'] = dpoint.deltaLastUpdated
+                        counters['deltaNextUpdate'] = dpoint.deltaNextUpdate
+        for issuer in issuers.itervalues():
+            issuer.setdefault('dist_points', {})
+            accesses = issuer['cache_hits'] + issuer['cache_misses']
+            if accesses:
+                issuer['cache_hit_ratio'] = float(issuer['cache_hits']) / accesses
+        return {'checks': checks, 'issuers': issuers}
@@ -27,22 +27,60 @@ import sys
 logger = logging.getLogger('certs.crl_store')
 import os
 import pickle 
+import hashlib
+import threading
+import Queue
+import random
+import time
+import urlparse
+import base64
+import multiprocessing
+from itertools import izip
+from operator import itemgetter
 
 # dslib imports
-from pyasn1.codec.der import decoder
+from pyasn1.codec.der import decoder, encoder
 from pyasn1 import error
 from dslib.pkcs7.asn1_models.crl import *
+from dslib.properties.properties import Properties as props
 
 # local imports
 import crl_verifier
+import crl_stream
+import crl_extensions
 import timeutil
 import fast_rev_cert_parser as fast_parser
+import crl_index
+import crl_journal
+import crl_stats
+from revoked_store import Revoked_store
+from worker_pool import Worker_pool
 
 CRL_DUMP_DIR = ".crl_dumps"
+# pickled cache of older versions, read only when there is no index
 CRL_DUMP_FILE = ".crl_dump"
+CRL_INDEX_FILE = ".crl_index"
+# database of the sqlite backend (CRL_CACHE_BACKEND = sqlite)
+CRL_SQLITE_FILE = ".crl_cache.sqlite"
+# changes are appended to journal next to the index, the index is
+# rewritten when the journal grows over this ratio of its size
+JOURNAL_COMPACT_RATIO = 0.5
+JOURNAL_MIN_COMPACT_SIZE = 1024 * 1024
+
+# size of chunks read from network when CRL is streamed
+CRL_CHUNK_SIZE = 64 * 1024
+# smaller CRLs are decoded in the calling thread even when the decode
+# processes are enabled (CRL_DECODE_PROCESSES)
+PROCESS_DECODE_MIN_SIZE = 256 * 1024
+
+# result of CRL download, when the CRL did not change since the last one
+NOT_MODIFIED = "not modified"
 
 CRL_DIST_POINT_EXT_ID = '2.5.29.31'
 
+PEM_CRL_BEGIN = '-----BEGIN X509 CRL-----'
+PEM_CRL_END = '-----END X509 CRL-----'
+
 def extract_crl_distpoints(certificate):
     '''
     extracts CRL dist point information from certificate extensions.
@@ -58,32 +96,241 @@ def extract_crl_distpoints(certificate):
       
 
 
+def _read_decoded_crl(crl, reasons=None):
+    '''
+    Returns thisUpdate, nextUpdate, iterator of revoked certificates
+    (serial number, revocation date) and extensions (OID -> value)
+    of pyasn1 decoded CRL. Reason codes of revoked certificates are
+    collected into reasons dictionary, if it is given.
+    '''
+    tbs = crl.getComponentByName("tbsCertList")
+    thisUpdate = str(tbs.getComponentByName("thisUpdate"))
+    nextUpdate = tbs.getComponentByName("nextUpdate")
+    if nextUpdate is not None:
+        nextUpdate = str(nextUpdate)
+    extensions = crl_extensions.extensions_to_dict(
+                                tbs.getComponentByName("crlExtensions"))
+    revoked = tbs.getComponentByName("revokedCertificates")
+    if revoked is None:
+        return thisUpdate, nextUpdate, [], extensions
+    # parse the unparsed content for revokedCerts
+    return thisUpdate, nextUpdate, \
+           fast_parser.iter_revoked(revoked._value, reasons=reasons), extensions
+
+
+def decode_crl(der_data, verification_der=None):
+    '''
+    Decodes CRL, verifies it with DER encoded certificate verification_der
+    and extracts revoked certificates. Runs in worker process of the decode
+    pool, so only picklable compact data are passed back.
+    Returns None if verification failed, otherwise tuple (thisUpdate,
+    nextUpdate, Revoked_store, extensions, reasons).
+    '''
+    crl = decoder.decode(der_data, asn1Spec=RevCertificateList())[0]
+    if verification_der is not None:
+        certificate = decoder.decode(verification_der, asn1Spec=Certificate())[0]
+        if not crl_verifier.verify_crl(crl, certificate, der_data):
+            return None
+    reasons = {}
+    this_update, next_update, revoked, extensions = \
+                                            _read_decoded_crl(crl, reasons)
+    return this_update, next_update, Revoked_store(revoked), extensions, \
+           reasons
+
+
+def _time_passed(time_string):
+    '''
+    Checks if time (in the CRL format) is in the past.
+    '''
+    return timeutil.passed(time_string)
+
+def issuer_key(issuer_name):
+    '''
+    Returns canonical key of issuer name (string form of Name) -
+    case and whitespace differences are ignored.
+    '''
+    return ' '.join(issuer_name.split()).lower()
+
+def normalize_url(url):
+    '''
+    Returns url with lower case scheme and host and without default port,
+    used as a key of distribution points.
+    '''
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if scheme == 'http' and netloc.endswith(':80'):
+        netloc = netloc[:-3]
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, fragment))
+
+def _to_seconds(time_string):
+    '''
+    Converts time in the CRL format to seconds since the epoch.
+    '''
+    return timeutil.to_seconds_from_epoch(time_string)
+
+def read_crl_file(path):
+    '''
+    Returns list of encoded CRLs from file in DER or PEM format
+    (PEM file may contain more CRLs).
+    '''
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if PEM_CRL_BEGIN not in data:
+        return [data]
+    crls = []
+    lines = None
+    for line in data.splitlines():
+        line = line.strip()
+        if line == PEM_CRL_BEGIN:
+            lines = []
+        elif line == PEM_CRL_END and lines is not None:
+            crls.append(base64.b64decode(''.join(lines)))
+            lines = None
+        elif lines is not None:
+            lines.append(line)
+    return crls
+
+
 class CRL_dist_point():
     '''
     CRL distribution point
     '''
     
-    def __init__(self, url):
+    # attributes stored together with revoked certificates in the index
+    META_ATTRIBUTES = ('lastUpdated', 'nextUpdate', 'crlNumber',
+                       'deltaUrl', 'deltaCrlNumber', 'deltaLastUpdated',
+                       'deltaNextUpdate', 'httpValidators')
+    
+    def __init__(self, url, delta_url=None):
         self.url = url
-        self.revoked_certs = {}
+        self.revoked_certs = Revoked_store()
         self.lastUpdated = None
         self.nextUpdate = None
+        self.crlNumber = None
+        # delta CRL - configured or taken from freshestCRL extension
+        self.deltaUrl = delta_url
+        self.deltaCrlNumber = None
+        self.deltaLastUpdated = None
+        self.deltaNextUpdate = None
+        # ETag, Last-Modified and content hash of the last download
+        # of the CRL and of the delta CRL (url -> validators)
+        self.httpValidators = {}
+        # validators of downloaded CRLs which were not applied yet
+        self.pending_validators = {}
         self.changed = False
+        # revoked certificates added (packed) and serial numbers removed
+        # since the cache was stored
+        self.pending_revoked = Revoked_store()
+        self.pending_removed = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('pending_revoked', None)
+        state.pop('pending_removed', None)
+        state.pop('pending_validators', None)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.META_ATTRIBUTES:
+            setattr(self, name, None)
+        self.httpValidators = {}
+        self.__dict__.update(state)
+        # changes are not pickled (older versions stored empty lists)
+        self.pending_revoked = Revoked_store()
+        self.pending_removed = []
+        self.pending_validators = {}
+        # caches pickled by older versions keep revoked certs in a dict
+        if isinstance(self.revoked_certs, dict):
+            self.revoked_certs = Revoked_store(self.revoked_certs.iteritems())
+
+    def get_meta(self):
+        '''
+        Returns dictionary with metadata of the CRL (update times...)
+        '''
+        return dict((name, getattr(self, name)) for name in self.META_ATTRIBUTES)
+
+    def set_meta(self, meta):
+        for name in self.META_ATTRIBUTES:
+            if name in meta:
+                setattr(self, name, meta[name])
+
+    def get_validators(self, url):
+        '''
+        Returns HTTP validators (etag, lastModified, contentHash) of the last
+        download from url.
+        '''
+        return self.httpValidators.get(url, {})
+
+    def set_validators(self, url, etag, last_modified, content_hash):
+        validators = {'etag': etag, 'lastModified': last_modified,
+                      'contentHash': content_hash}
+        if self.httpValidators.get(url) != validators:
+            self.httpValidators = dict(self.httpValidators)
+            self.httpValidators[url] = validators
+            self.changed = True
+
+    def stage_validators(self, url, etag, last_modified, content_hash):
+        '''
+        Keeps validators of CRL downloaded from url until the CRL is
+        applied (see commit_validators). Validators of CRL which was
+        not applied must not be used, the next conditional request
+        would skip that CRL.
+        '''
+        self.pending_validators[url] = (etag, last_modified, content_hash)
+
+    def commit_validators(self, url):
+        '''
+        Stores validators of the applied CRL downloaded from url.
+        '''
+        validators = self.pending_validators.pop(url, None)
+        if validators is not None:
+            self.set_validators(url, *validators)
+
+    def drop_validators(self, url):
+        self.pending_validators.pop(url, None)
 
     def __fill_revoked(self, revoked_sn_list):
         '''
         Fills list of revoked certs with new certificates.
         Returns number of added certificates
         '''       
-        added_certs = 0
-        for revoked in revoked_sn_list:            
-            sn = revoked[0]
-            if not self.revoked_certs.has_key(sn): 
-                # write the revocation time of this key (cert serial number) 
-                self.revoked_certs[sn] = revoked[1]
+        if isinstance(self.revoked_certs, Revoked_store) and \
+           not len(self.revoked_certs) and not len(self.pending_revoked):
+            # the whole CRL is new, pending changes share its packed records
+            added_certs = self.revoked_certs.add_many(revoked_sn_list)
+            if added_certs:
                 self.changed = True
-                added_certs += 1
+                self.pending_revoked = Revoked_store.from_buffers(
+                                            *self.revoked_certs.get_buffers())
+                self.pending_removed = []
+            return added_certs
+        added = []
+        added_certs = self.revoked_certs.add_many(revoked_sn_list, added=added)
+        if added_certs:
+            self.changed = True
+            self.pending_revoked.add_many(added)
+            if self.pending_removed:
+                added_sns = set(sn for sn, date in added)
+                self.pending_removed = [sn for sn in self.pending_removed
+                                        if sn not in added_sns]
         return added_certs
+
+    def __remove_revoked(self, serials):
+        '''
+        Removes certificates from the list of revoked certs.
+        Returns number of removed certificates
+        '''
+        removed = []
+        removed_certs = self.revoked_certs.discard_many(serials, removed=removed)
+        if removed_certs:
+            self.changed = True
+            self.pending_removed.extend(removed)
+            self.pending_revoked.discard_many(removed)
+        return removed_certs
     
     def seconds_from_last_update(self):
         '''
@@ -102,9 +349,7 @@ class CRL_dist_point():
         Looks for certificate with certain serial number.
         Returns certificate revocation date if found.
         '''
-        if cert_sn in self.revoked_certs:
-          return self.revoked_certs[cert_sn]
-        return None
+        return self.revoked_certs.get(cert_sn)
         
     
     def update_revoked_list(self, crl):   
@@ -113,18 +358,90 @@ class CRL_dist_point():
         downloaded and parsed crl. 
         Returns number of added certificates
         '''
-        thisUpdate = str(crl.getComponentByName("tbsCertList").\
-                            getComponentByName("thisUpdate"))
-        nextUpdate = str(crl.getComponentByName("tbsCertList").\
-                            getComponentByName("nextUpdate"))
-        self.lastUpdated = thisUpdate
-        self.nextUpdate = nextUpdate
-        revoked = crl.getComponentByName("tbsCertList").\
-                        getComponentByName("revokedCertificates")
-        # parse the unparsed content for revokedCerts        
-        revoked_sns = fast_parser.parse_all(revoked._value)
-
-        return self.__fill_revoked(revoked_sns)
+        thisUpdate, nextUpdate, revoked_sns = _read_decoded_crl(crl)
+        return self.update_revoked(thisUpdate, nextUpdate, revoked_sns)
+
+    def update_revoked(self, this_update, next_update, revoked_sn_list):
+        '''
+        Sets update times of the CRL and adds revoked certificates
+        (iterable of serial number, revocation date pairs).
+        Returns number of added certificates
+        '''
+        if self.lastUpdated != this_update or self.nextUpdate != next_update:
+            self.changed = True
+        self.lastUpdated = this_update
+        self.nextUpdate = next_update
+        return self.__fill_revoked(revoked_sn_list)
+
+    def update_crl_info(self, extensions):
+        '''
+        Takes CRL number and delta CRL location (if not configured)
+        from extensions of the base CRL.
+        '''
+        crl_number = crl_extensions.get_crl_number(extensions)
+        if crl_number != self.crlNumber:
+            self.crlNumber = crl_number
+            self.changed = True
+        if self.deltaUrl is None:
+            urls = crl_extensions.get_freshest_crl_urls(extensions)
+            if urls:
+                logger.info("Delta CRL of %s found at %s" % (self.url, urls[0]))
+                self.deltaUrl = urls[0]
+                self.changed = True
+
+    def delta_due(self):
+        '''
+        Checks if the delta CRL should be downloaded.
+        '''
+        if self.deltaUrl is None:
+            return False
+        return not self.deltaNextUpdate or _time_passed(self.deltaNextUpdate)
+
+    def base_due(self):
+        '''
+        Checks if the base CRL should be downloaded.
+        '''
+        return not self.nextUpdate or _time_passed(self.nextUpdate)
+
+    def is_downloadable(self):
+        '''
+        Checks if the CRL can be downloaded from url - dist points of CRLs
+        imported from files (see CRL_cache.import_dir) are not refreshed.
+        '''
+        return self.url.startswith('http://')
+
+    def next_update_seconds(self, delta=False):
+        '''
+        Returns time of the next update of the CRL (or of its delta CRL)
+        in seconds since the epoch or None, if it is not known.
+        '''
+        next_update = self.deltaNextUpdate if delta else self.nextUpdate
+        if not next_update:
+            return None
+        return _to_seconds(next_update)
+
+    def apply_delta(self, this_update, next_update, revoked_sn_list, reasons,
+                    delta_crl_number):
+        '''
+        Applies delta CRL on top of the base CRL. Entries with reason code
+        removeFromCRL are removed from the list of revoked certificates.
+        Returns number of added certificates
+        '''
+        # consume the list first, reasons are filled while it is parsed
+        revoked_sn_list = list(revoked_sn_list)
+        removed = set(sn for sn, reason in reasons.iteritems()
+                      if reason == fast_parser.REMOVE_FROM_CRL)
+        added_certs = self.__fill_revoked((sn, date) for sn, date in revoked_sn_list
+                                          if sn not in removed)
+        removed_certs = self.__remove_revoked(removed)
+        if removed_certs:
+            logger.info("Removed %d certificates from CRL of %s" % \
+                        (removed_certs, self.url))
+        self.deltaLastUpdated = this_update
+        self.deltaNextUpdate = next_update
+        self.deltaCrlNumber = delta_crl_number
+        self.changed = True
+        return added_certs
     
         
 class CRL_issuer():
@@ -133,53 +450,414 @@ class CRL_issuer():
         self.name = name
         self.dist_points = []
         self.changed = False
+        # certificate of the issuer, used to verify CRLs refreshed
+        # in background (not stored)
+        self.verification = None
+        self.__init_sync()
+        self.__init_index()
+
+    def __init_index(self):
+        # normalized url -> dist point
+        self._dpoints_by_url = {}
+        for dpoint in self.dist_points:
+            self._dpoints_by_url[normalize_url(dpoint.url)] = dpoint
+        # revoked certificates of all dist points (see revoked_view)
+        self._merged = None
+
+    def __init_sync(self):
+        # held while CRLs of the issuer are being changed or stored
+        self.lock = threading.RLock()
+        # refresh in progress (see begin_flight)
+        self._flight = None
+        self._flight_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('verification', 'lock', '_flight', '_flight_lock',
+                     '_dpoints_by_url', '_merged'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.verification = None
+        self.__init_sync()
+        self.__init_index()
+
+    def begin_flight(self):
+        '''
+        Registers refresh of the issuer. Returns the refresh in progress and
+        True, if the caller has to perform it (and call end_flight), or
+        False, if it was started by another thread.
+        '''
+        self._flight_lock.acquire()
+        try:
+            if self._flight is None:
+                self._flight = _Flight()
+                return self._flight, True
+            return self._flight, False
+        finally:
+            self._flight_lock.release()
+
+    def end_flight(self, flight, result):
+        '''
+        Finishes refresh started by begin_flight, threads waiting for it
+        get result.
+        '''
+        flight.result = result
+        self._flight_lock.acquire()
+        try:
+            self._flight = None
+        finally:
+            self._flight_lock.release()
+        flight.done.set()
+
+    def __single_flight(self, wait, func, *args):
+        '''
+        Calls func unless another thread already does the same for this
+        issuer - then waits for its result or, if wait is False and the
+        cached CRLs are still usable, returns True, 0 immediately.
+        '''
+        flight, leader = self.begin_flight()
+        if not leader:
+            if not wait and self.is_fresh(props.CRL_STALE_GRACE):
+                logger.debug("Issuer %s is being refreshed, using cached CRLs" %\
+                             self.name)
+                return True, 0
+            logger.debug("Waiting for refresh of issuer %s" % self.name)
+            flight.done.wait()
+            return flight.result
+        result = False, 0
+        try:
+            self.lock.acquire()
+            try:
+                result = func(*args)
+            finally:
+                self.lock.release()
+        finally:
+            self.end_flight(flight, result)
+        return result
         
     def __decode_crl(self, der_data):
         crl = decoder.decode(der_data, asn1Spec=RevCertificateList())[0]
         return crl
     
-    def __download_crl(self, url):
+    def __decode_in_pool(self, downloaded, dpoint, verification, url, reasons):
+        '''
+        Decodes and verifies CRL in the decode pool, so that the GIL is not
+        held by the parsing. The worker gets only the CRL and the issuer
+        certificate, certificates already known to dpoint are dropped
+        from its packed result here.
+        Returns None if decoding failed, False if verification failed,
+        otherwise tuple (thisUpdate, nextUpdate, revoked, extensions).
+        '''
+        verification_der = None
+        if verification is not None:
+            verification_der = encoder.encode(verification)
+        try:
+            decoded = CRL_cache_manager.get_decode_pool().apply(decode_crl,
+                                    (downloaded, verification_der))
+        except Exception, ex:
+            logger.warning("Decoding of crl from %s failed: %s" % (url, ex))
+            return None
+        if decoded is None:
+            logger.warning('CRL verification failed')
+            return False
+        if verification is not None:
+            logger.info("CRL verified")
+        this_update, next_update, revoked, extensions, decoded_reasons = decoded
+        if isinstance(dpoint.revoked_certs, Revoked_store):
+            revoked = revoked.difference(dpoint.revoked_certs)
+        if reasons is not None:
+            reasons.update(decoded_reasons)
+        return this_update, next_update, revoked, extensions
+
+    def __open_url(self, url, headers=None):
+        '''
+        Opens url, returns response, None if it failed or NOT_MODIFIED
+        if the server answered conditional request with 304.
+        '''
         logger.debug("Downloading CRL from %s" % url)
-        # we construct an urlopener using proxy settings
+        # shared urlopener using proxy settings, keeps connections open
         from dslib.network import ProxyManager
-        prox_hand = ProxyManager.HTTP_PROXY.create_proxy_handler()
-        prox_auth_hand = ProxyManager.HTTP_PROXY.create_proxy_auth_handler()
-        opener = urllib2.build_opener()
-        if prox_hand:
-          opener.add_handler(prox_hand)
-        if prox_auth_hand:
-          opener.add_handler(prox_auth_hand)
+        opener = ProxyManager.get_opener()
+        request = urllib2.Request(url, headers=headers or {})
+        try:
+          return opener.open(request, timeout=10)
+        except urllib2.HTTPError, ex:
+          if ex.code == 304:
+            logger.info("CRL at %s not modified" % url)
+            return NOT_MODIFIED
+          logger.warning("Downloading crl from %s failed! (HTTP %s)" % (url, ex.code))
+          return None
+        except:
+          logger.warning("Downloading crl from %s failed!" % url)
+          return None
+
+    def __download_crl(self, f, url):
         try:
-          f = opener.open(url, timeout=10)
           c = f.read()
           logger.debug("Downloading finished")
           return c
         except:
           logger.warning("Downloading crl from %s failed!" % url)
           return None
+
+    def __stream_crl(self, f, dpoint, url, reasons):
+        '''
+        Reads CRL in chunks and parses it on the fly. Only revoked
+        certificates not yet known to dpoint are kept until the CRL
+        signature is verified.
+        Returns parser (with size of the content) and sha256 hash
+        of the content or None, if the download failed.
+        '''
+        staged = []
+        def on_revoked(sn, date):
+            if dpoint.find_certificate(sn) is None:
+                staged.append((sn, date))
+        parser = crl_stream.CRL_stream_parser(on_revoked, reasons)
+        parser.staged = staged
+        parser.size = 0
+        content_hash = hashlib.sha256()
+        try:
+            while True:
+                chunk = f.read(CRL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.size += len(chunk)
+                content_hash.update(chunk)
+                parser.feed(chunk)
+            parser.close()
+            logger.debug("Downloading finished, %d revoked certificates parsed" %\
+                         parser.revoked_count)
+        except ValueError, ex:
+            logger.warning("Parsing of crl from %s failed: %s" % (url, ex))
+            return None
+        except:
+            logger.warning("Downloading crl from %s failed!" % url)
+            return None
+        return parser, content_hash.hexdigest()
+
+    def __fetch_crl(self, dpoint, verification, url=None, reasons=None,
+                    claim=None):
+        '''
+        Downloads and parses CRL of the dist point (or CRL from url, e.g.
+        its delta CRL) and verifies it when verification certificate is
+        given. Reason codes of entries are collected into reasons.
+        The request is conditional (ETag, Last-Modified) and content equal
+        to the last downloaded one is neither decoded nor verified.
+        When claim is given, it is called before a valid result is
+        returned; if it returns False, the result is dropped (None is
+        returned) and validators of dpoint are kept.
+        Validators of the response are staged in dpoint, the caller
+        commits them when the CRL is applied.
+        Returns None if download failed, False if verification failed,
+        NOT_MODIFIED if the CRL did not change, otherwise tuple
+        (thisUpdate, nextUpdate, revoked certificates, extensions).
+        '''
+        if url is None:
+            url = dpoint.url
+        validators = dpoint.get_validators(url)
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('lastModified'):
+            headers['If-Modified-Since'] = validators['lastModified']
+        stats = CRL_cache_manager.get_stats()
+        started = time.time()
+        f = self.__open_url(url, headers)
+        if f is None:
+            stats.download(self.name, url, 0, time.time() - started, False)
+            return None
+        if f is NOT_MODIFIED:
+            stats.download(self.name, url, 0, time.time() - started,
+                           not_modified=True)
+            if claim is not None and not claim():
+                return None
+            return f
+        try:
+            etag = f.info().getheader('ETag')
+            last_modified = f.info().getheader('Last-Modified')
+            if props.STREAM_CRL_DOWNLOAD:
+                # parsing is included in the download time
+                streamed = self.__stream_crl(f, dpoint, url, reasons)
+                if streamed is None:
+                    stats.download(self.name, url, 0, time.time() - started,
+                                   False)
+                    return None
+                parser, content_hash = streamed
+                size = parser.size
+            else:
+                downloaded = self.__download_crl(f, url)
+                if downloaded is None:
+                    stats.download(self.name, url, 0, time.time() - started,
+                                   False)
+                    return None
+                size = len(downloaded)
+                content_hash = hashlib.sha256(downloaded).hexdigest()
+        finally:
+            f.close()
+        stats.download(self.name, url, size, time.time() - started)
+        if content_hash == validators.get('contentHash'):
+            logger.info("CRL at %s did not change, skipping its verification" % url)
+            if claim is not None and not claim():
+                return None
+            dpoint.stage_validators(url, etag, last_modified, content_hash)
+            return NOT_MODIFIED
+        if props.STREAM_CRL_DOWNLOAD:
+            if (verification is not None):
+                started = time.time()
+                verified = parser.verify(verification)
+                stats.verify(self.name, url, time.time() - started, verified)
+                if not verified:
+                    logger.warning('CRL verification failed')
+                    return False
+                logger.info("CRL verified")
+            else:
+                logger.info("CRL verification not performed, no certificate provided")
+            result = (parser.this_update, parser.next_update, parser.staged,
+                      parser.get_extensions())
+        elif len(downloaded) >= PROCESS_DECODE_MIN_SIZE and \
+             CRL_cache_manager.get_decode_pool() is not None:
+            started = time.time()
+            result = self.__decode_in_pool(downloaded, dpoint, verification,
+                                           url, reasons)
+            # verification runs in the worker too
+            stats.decode(self.name, url, time.time() - started)
+            if result is None or result is False:
+                return result
+        else:
+            started = time.time()
+            crl = self.__decode_crl(downloaded)
+            stats.decode(self.name, url, time.time() - started)
+            if (verification is not None):
+                started = time.time()
+                verified = crl_verifier.verify_crl(crl, verification,
+                                                    downloaded)
+                stats.verify(self.name, url, time.time() - started, verified)
+                if not verified:
+                    logger.warning('CRL verification failed')
+                    return False
+                else:
+                    logger.info("CRL verified")
+            else:
+                logger.info("CRL verification not performed, no certificate provided")
+            result = _read_decoded_crl(crl, reasons)
+        if claim is not None and not claim():
+            return None
+        dpoint.stage_validators(url, etag, last_modified, content_hash)
+        return result
+
+    def __refresh_delta(self, dpoint, verification, refresh_base=True):
+        '''
+        Downloads delta CRL of dpoint and applies it on top of the cached
+        base CRL. If the delta needs newer base CRL than the cached one,
+        the base CRL is downloaded (when refresh_base is set).
+        Returns result of download attempt and number of added certificates
+        '''
+        logger.debug("Refreshing delta CRL %s", dpoint.deltaUrl)
+        reasons = {}
+        delta_url = dpoint.deltaUrl
+        fetched = self.__fetch_crl(dpoint, verification, delta_url, reasons)
+        if fetched is NOT_MODIFIED:
+            dpoint.commit_validators(delta_url)
+            return True, 0
+        if not fetched:
+            # the base CRL is still valid
+            logger.warning("Delta CRL %s not available" % dpoint.deltaUrl)
+            return True, 0
+        this_update, next_update, revoked, extensions = fetched
+        base_number = crl_extensions.get_delta_base(extensions)
+        if base_number is None:
+            logger.warning("CRL %s is not a delta CRL" % dpoint.deltaUrl)
+            dpoint.drop_validators(delta_url)
+            return True, 0
+        if dpoint.crlNumber is None or base_number > dpoint.crlNumber:
+            logger.info("Delta CRL requires base CRL %s, cached base CRL is %s",
+                        base_number, dpoint.crlNumber)
+            # the delta is downloaded again after the base CRL
+            dpoint.drop_validators(delta_url)
+            if refresh_base:
+                return self.refresh_dist_point(dpoint.url, verification,
+                                               force_download=True)
+            return True, 0
+        delta_number = crl_extensions.get_crl_number(extensions)
+        if dpoint.deltaLastUpdated == this_update and \
+           dpoint.deltaCrlNumber == delta_number:
+            logger.info("Delta CRL is the same as current one")
+            dpoint.deltaNextUpdate = next_update
+            dpoint.commit_validators(delta_url)
+            return True, 0
+        added_certs = dpoint.apply_delta(this_update, next_update, revoked,
+                                         reasons, delta_number)
+        dpoint.commit_validators(delta_url)
+        logger.info("Added %d revoked certificates from delta CRL" % added_certs)
+        self.changed = True
+        return True, added_certs
       
     def find_dpoint(self, url):
-        for dpoint in self.dist_points:
-            if dpoint.url == url:
-                return dpoint
-        return None
+        return self._dpoints_by_url.get(normalize_url(url))
+
+    def append_dist_point(self, dpoint):
+        '''
+        Adds dist point instance to the issuer (e.g. when it is loaded).
+        '''
+        self._dpoints_by_url[normalize_url(dpoint.url)] = dpoint
+        self.dist_points.append(dpoint)
     
     
-    def add_dist_point(self, url):
+    def add_dist_point(self, url, delta_url=None):
+        '''
+        Adds distribution point. Location of delta CRLs may be configured
+        with delta_url, otherwise it is taken from freshestCRL extension
+        of the CRL.
+        '''
         dpoint = self.find_dpoint(url)
         if dpoint is None:
             if not url.startswith('http://'):
               logger.warning("Only HTTP distribution ports supported")
               logger.warning("CDP %s not added" % url)
               return None
-            dpoint = CRL_dist_point(url)       
-            self.dist_points.append(dpoint)
+            dpoint = CRL_dist_point(url, delta_url)       
+            self.append_dist_point(dpoint)
             self.changed = True
             return dpoint
         else:
             logger.warning('Issuer already contains this dist point')
             return None
     
+    def add_cert_dist_points(self, urls):
+        '''
+        Adds CDPs urls (taken from a certificate of the issuer) when none
+        of its dist points can be downloaded, i.e. all its CRLs were
+        imported, so that they can be refreshed.
+        Returns number of added dist points
+        '''
+        if not self.__only_imported():
+            return 0
+        self.lock.acquire()
+        try:
+            if not self.__only_imported():
+                return 0
+            added = 0
+            for url in urls:
+                if self.find_dpoint(url) is None and \
+                   self.add_dist_point(url) is not None:
+                    logger.info("CDP %s added to imported CRLs of %s" % \
+                                (url, self.name))
+                    added += 1
+            return added
+        finally:
+            self.lock.release()
+
+    def __only_imported(self):
+        if not self.dist_points:
+            return False
+        for dpoint in self.dist_points:
+            if dpoint.is_downloadable():
+                return False
+        return True
+
     def init_dist_point(self, url, verification=None):
         '''
         Initializes CDP - downloads and parses CRL.
@@ -191,18 +869,20 @@ class CRL_issuer():
             self.changed = True
             if dpoint.lastUpdated is None:
                 logger.debug("Initializing dpoint %s", url)
-                downloaded = self.__download_crl(url)
-                if downloaded is None:
+                fetched = self.__fetch_crl(dpoint, verification)
+                if fetched is None:
                   return False, 0
-                crl = self.__decode_crl(downloaded)
-                if (verification is not None):                    
-                    verified = crl_verifier.verify_crl(crl, verification)
-                    if not verified:
-                        logger.warning('CRL verification failed')
-                        return True, 0
-                    else:
-                        logger.info("CRL verified")
-                return True, dpoint.update_revoked_list(crl)
+                if fetched is False or fetched is NOT_MODIFIED:
+                  return True, 0
+                this_update, next_update, revoked, extensions = fetched
+                added_certs = dpoint.update_revoked(this_update, next_update, revoked)
+                dpoint.update_crl_info(extensions)
+                dpoint.commit_validators(dpoint.url)
+                if dpoint.deltaUrl:
+                  success, delta_added = self.__refresh_delta(dpoint, verification,
+                                                              refresh_base=False)
+                  added_certs += delta_added
+                return True, added_certs
             else:
               logger.warning("CDP %s is already initialized. Try to refresh it" % url)
               return True, 0
@@ -216,32 +896,199 @@ class CRL_issuer():
         cert_sn serial number. Returns date of revocation or None
         '''
         if not len(self.dist_points):
-          logger.info("This issuer has no CDP")
+          logger.debug("This issuer has no CDP")
+          return None
+        rev_date = self.revoked_view().get(cert_sn)
+        CRL_cache_manager.get_stats().lookup(self.name, 1, rev_date is not None)
+        if rev_date is not None:
+            logger.debug("Certificate %s revoked on %s" % (cert_sn, rev_date))
+        return rev_date
+
+    def revoked_view(self):
+        '''
+        Returns store with revoked certificates of all dist points of
+        the issuer (the date from the first dist point is used when
+        they differ). The merged store is rebuilt only after some of
+        the dist points changed.
+        '''
+        dpoints = self.dist_points
+        if len(dpoints) == 1:
+            return dpoints[0].revoked_certs
+        versions = [dpoint.revoked_certs.get_buffers() for dpoint in dpoints]
+        merged = self._merged
+        if merged is not None and len(merged[0]) == len(versions):
+            for old, new in zip(merged[0], versions):
+                if old is not new:
+                    break
+            else:
+                return merged[1]
+        store = Revoked_store()
+        for dpoint in dpoints:
+            store.add_many(iter(dpoint.revoked_certs))
+        self._merged = (versions, store)
+        return store
+
+    def crl_version(self):
+        '''
+        Returns value which changes whenever new CRL or delta CRL of some
+        of the dist points is applied.
+        '''
+        return tuple((dpoint.lastUpdated, dpoint.deltaLastUpdated)
+                     for dpoint in self.dist_points)
+
+    def freshest_dist_point(self):
+        '''
+        Returns dist point whose CRL has the latest nextUpdate or None,
+        if no CRL was applied. Dist points are mirrors, only the winner
+        of a concurrent download gets the new CRL, so the issuer is due
+        when this dist point is.
+        '''
+        freshest = None
         for dpoint in self.dist_points:
-            rev_date = dpoint.find_certificate(cert_sn)
-            if rev_date is not None:
-                logger.debug("Certificate %s revoked on %s" % (cert_sn, rev_date))
-                return rev_date
-        #return "100330140210T"
-        return None
+            if dpoint.lastUpdated is None:
+                continue
+            if freshest is None or (dpoint.next_update_seconds() or 0) > \
+                                   (freshest.next_update_seconds() or 0):
+                freshest = dpoint
+        return freshest
+
+    def next_update_seconds(self):
+        '''
+        Returns the earliest nextUpdate of the CRL and delta CRL of the
+        freshest dist point in seconds since the epoch or None.
+        '''
+        dpoint = self.freshest_dist_point()
+        if dpoint is None:
+            return None
+        times = [seconds for seconds in (dpoint.next_update_seconds(),
+                                         dpoint.next_update_seconds(delta=True))
+                 if seconds is not None]
+        return times and min(times) or None
+
+    def is_fresh(self, grace=0):
+        '''
+        Checks if revoked certificates of this issuer may be used - some
+        of its CRLs has not passed its nextUpdate by more than grace
+        seconds.
+        '''
+        now = time.time()
+        for dpoint in self.dist_points:
+            if dpoint.lastUpdated is None:
+                continue
+            next_update = dpoint.next_update_seconds()
+            if next_update is None or now < next_update + grace:
+                return True
+        return False
     
-    def refresh_issuer(self, verification=None, force_crl_download=False):
+    def refresh_issuer(self, verification=None, force_crl_download=False,
+                       pool=None, wait=None):
         '''
         Refresh CDPs of this issuer. Goes through
         CDPS, tries to refresh them. Stops after first successful refresh.
+        When worker pool is given, CRLs of all CDPs (mirrors) are downloaded
+        concurrently and the first valid one is used.
+        Only one refresh of the issuer runs at a time, other callers wait
+        for its result, or use the cached CRLs when wait is False
+        (default is CRL_REFRESH_WAIT property).
+        Returns result of download attempt and number of added certificates
+        '''
+        if wait is None:
+            wait = props.CRL_REFRESH_WAIT
+        return self.__single_flight(wait, self.__refresh, verification,
+                                    force_crl_download, pool)
+
+    def __refresh(self, verification, force_crl_download, pool):
+        race = self.start_refresh(verification, force_crl_download, pool)
+        return self.finish_refresh(race)
+
+    def init_issuer(self, urls, verification=None):
+        '''
+        Adds distribution points with urls and initializes them, stops
+        after the first successful download. Concurrent callers wait for
+        the result of the first one.
         Returns result of download attempt and number of added certificates
         '''
+        return self.__single_flight(True, self.__init_dist_points, urls,
+                                    verification)
+
+    def __init_dist_points(self, urls, verification):
+        for url in urls:
+            dpoint = self.find_dpoint(url)
+            if dpoint is None:
+                dpoint = self.add_dist_point(url)
+                if dpoint is None:
+                    continue
+            elif dpoint.lastUpdated is not None:
+                # initialized by previous call
+                return True, 0
+            success, added_certs = self.init_dist_point(url, verification)
+            # if download of CRL was successful, ignore other CDP
+            if success:
+                return True, added_certs
+        return False, 0
+
+    def start_refresh(self, verification=None, force_crl_download=False,
+                      pool=None):
+        '''
+        Starts concurrent download of CRLs of this issuer in the pool.
+        Returns object to be passed to finish_refresh.
+        '''
         logger.info("Refreshing issuer %s" % self.name)
-        for dp in self.dist_points:
-          success, added_certs = self.refresh_dist_point(dp.url, \
-                                                         verification,\
-                                                         force_crl_download)
-          if success:            
-            return True, added_certs
-          else:
-            logger.warning("CDP %s failed to download" % dp.url)
-        # refreshing of each CDP failed
-        return False, 0    
+        freshest = self.freshest_dist_point()
+        mirrors = [dpoint for dpoint in self.dist_points
+                   if dpoint.is_downloadable()]
+        if pool is None or len(mirrors) < 2 or \
+           not (force_crl_download or freshest is None or freshest.base_due()):
+            # no download or nothing to race
+            return (verification, force_crl_download, None)
+        race = _Fetch_race(len(mirrors))
+        for dpoint in mirrors:
+            pool.submit(self.__race_fetch, dpoint, verification, race)
+        return (verification, force_crl_download, race)
+
+    def __race_fetch(self, dpoint, verification, race):
+        fetched = None
+        try:
+            fetched = self.__fetch_crl(dpoint, verification, claim=race.claim)
+        finally:
+            race.results.put((dpoint, fetched))
+
+    def finish_refresh(self, started):
+        '''
+        Waits for CRLs downloaded by start_refresh and applies the first
+        valid one. Returns result of download attempt and number of added
+        certificates
+        '''
+        verification, force_crl_download, race = started
+        if race is None:
+            dist_points = list(self.dist_points)
+            freshest = self.freshest_dist_point()
+            if freshest is not None and not force_crl_download:
+                # mirrors which lost earlier races are not downloaded
+                # while the freshest CRL is valid
+                dist_points.remove(freshest)
+                dist_points.insert(0, freshest)
+            for dp in dist_points:
+              success, added_certs = self.refresh_dist_point(dp.url, \
+                                                             verification,\
+                                                             force_crl_download)
+              if success:            
+                return True, added_certs
+              else:
+                logger.warning("CDP %s failed to download" % dp.url)
+            # refreshing of each CDP failed
+            return False, 0
+        verification_failed = False
+        for i in xrange(race.count):
+            dpoint, fetched = race.results.get()
+            if fetched is False:
+                verification_failed = True
+            elif fetched is not None:
+                return True, self.__apply_fetched(dpoint, fetched, verification)
+            else:
+                logger.warning("CDP %s failed to download" % dpoint.url)
+        # the cached CRLs are kept when verification of new ones fails
+        return verification_failed, 0
         
     def refresh_dist_point(self, url, verification=None, force_download=False):
         '''
@@ -252,7 +1099,6 @@ class CRL_issuer():
         '''
         dpoint = self.find_dpoint(url)
         if dpoint is not None:
-            last_updated = dpoint.lastUpdated
             logger.debug("Refreshing dpoint %s", url)
             # check time of next update - if it is in the future, return True,0
             # download only in case when nextUpdate time passed               
@@ -261,45 +1107,93 @@ class CRL_issuer():
             else:
               # if force download was not set, check the nextUpdate parameter
               if dpoint.nextUpdate:
-                next_time = timeutil.to_time(dpoint.nextUpdate)         
-                current_time = timeutil.now()
-                if current_time >= next_time:
+                if dpoint.base_due():
                   logger.info("Next update time passed, downloading CRL")
                 else:
-                  logger.info("Next update scheduled on %s, not downloading anything" % dpoint.nextUpdate)
+                  logger.info("Next update scheduled on %s, not downloading base CRL" % dpoint.nextUpdate)
+                  if dpoint.delta_due():
+                    return self.__refresh_delta(dpoint, verification)
                   return True, 0
               else:
                 logger.info("No previous download recorded, downloading CRL")
-            # download CRL
-            downloaded = self.__download_crl(url)
-            if downloaded is None:
+            if not dpoint.is_downloadable():
+              logger.info("CRL of %s was imported, not downloading it" % url)
               return False, 0
-            # decode it and get the update time
-            crl = self.__decode_crl(downloaded)
-            if (verification is not None):                    
-                verified = crl_verifier.verify_crl(crl, verification)
-                if not verified:
-                    logger.warning('CRL verification failed')
-                    return True, 0
-                else:
-                    logger.info("CRL verified")
-            else:
-              logger.info("CRL verification not performed, no certificate provided")
-            downloaded_update_time = str(crl.getComponentByName("tbsCertList").getComponentByName("thisUpdate"))
-            # if there was new crl issued, commit changes to local copy
-            if dpoint.lastUpdated != downloaded_update_time:
-                logger.info("New CRL detected, current version: %s, new version: %s",\
-                             dpoint.lastUpdated, downloaded_update_time)
-                added_certs = dpoint.update_revoked_list(crl)
-                logger.info("Added %d new revoked certificate serial numbers" % added_certs)
-                if added_certs:
-                    self.changed = True
-                return True, added_certs
-            else:
-                logger.info("Downloaded CRL is the same as current, no changes in list of revoked certificates")
-                return True, 0
+            # download CRL, decode it and get the update time
+            fetched = self.__fetch_crl(dpoint, verification)
+            if fetched is None:
+              return False, 0
+            if fetched is False:
+              return True, 0
+            return True, self.__apply_fetched(dpoint, fetched, verification)
+
+    def __apply_fetched(self, dpoint, fetched, verification):
+        '''
+        Applies downloaded CRL (result of __fetch_crl) on dpoint and
+        brings it up to date with its delta CRL.
+        Returns number of added certificates
+        '''
+        if fetched is NOT_MODIFIED:
+          downloaded_update_time = dpoint.lastUpdated
+        else:
+          downloaded_update_time, next_update, revoked, extensions = fetched
+        # if there was new crl issued, commit changes to local copy
+        if dpoint.lastUpdated != downloaded_update_time:
+            logger.info("New CRL detected, current version: %s, new version: %s",\
+                         dpoint.lastUpdated, downloaded_update_time)
+            added_certs = dpoint.update_revoked(downloaded_update_time,
+                                                next_update, revoked)
+            dpoint.update_crl_info(extensions)
+            logger.info("Added %d new revoked certificate serial numbers" % added_certs)
+            if added_certs:
+                self.changed = True
+        else:
+            logger.info("Downloaded CRL is the same as current, no changes in list of revoked certificates")
+            added_certs = 0
+        dpoint.commit_validators(dpoint.url)
+        # bring the new base up to date with its delta CRL
+        if dpoint.deltaUrl:
+            success, delta_added = self.__refresh_delta(dpoint, verification,
+                                                        refresh_base=False)
+            added_certs += delta_added
+        return added_certs
     
     
+class _Flight(object):
+    '''
+    Refresh of an issuer in progress.
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class _Fetch_race(object):
+    '''
+    Concurrent downloads of CRLs of one issuer. Only the first valid
+    CRL is used, the others are dropped.
+    '''
+
+    def __init__(self, count):
+        self.count = count
+        self.results = Queue.Queue()
+        self._lock = threading.Lock()
+        self._won = False
+
+    def claim(self):
+        '''
+        Returns True for the first caller only.
+        '''
+        self._lock.acquire()
+        try:
+            won = not self._won
+            self._won = True
+            return won
+        finally:
+            self._lock.release()
+
+
 class CRL_cache():
     '''
     Represents cache of CRLs. Contains issuers of CRLs.
@@ -310,6 +1204,32 @@ class CRL_cache():
     def __init__(self):
       self.issuers = []    
       self.changed = False
+      self.__init_sync()
+      self.__init_index()
+
+    def __init_index(self):
+      # issuer_key(name) -> issuer
+      self._issuers_by_key = {}
+      for iss in self.issuers:
+        self._issuers_by_key[issuer_key(iss.name)] = iss
+
+    def __init_sync(self):
+      # guards adding of issuers
+      self._lock = threading.Lock()
+      # only one thread stores the cache at a time
+      self._save_lock = threading.Lock()
+
+    def __getstate__(self):
+      state = self.__dict__.copy()
+      state.pop('_lock', None)
+      state.pop('_save_lock', None)
+      state.pop('_issuers_by_key', None)
+      return state
+
+    def __setstate__(self, state):
+      self.__dict__.update(state)
+      self.__init_sync()
+      self.__init_index()
         
     def add_issuer(self, issuer_name):
         '''
@@ -317,25 +1237,34 @@ class CRL_cache():
         Returns CRL_issuer instance or None, if issuer 
         already exists.
         '''
-        iss = self.get_issuer(issuer_name)
-        if iss is None:
-            iss = CRL_issuer(issuer_name)        
-            self.issuers.append(iss)
-            self.changed = True
-            return iss
-        else:
-            logger.warn('Cache already contains this issuer')
-            return None
+        self._lock.acquire()
+        try:
+            iss = self.get_issuer(issuer_name)
+            if iss is None:
+                iss = self._new_issuer(issuer_name)        
+                self.append_issuer(iss)
+                self.changed = True
+                return iss
+        finally:
+            self._lock.release()
+        logger.warn('Cache already contains this issuer')
+        return None
     
+    def _new_issuer(self, issuer_name):
+        return CRL_issuer(issuer_name)
+
+    def append_issuer(self, iss):
+        '''
+        Adds issuer instance to the cache (e.g. when it is loaded).
+        '''
+        self._issuers_by_key[issuer_key(iss.name)] = iss
+        self.issuers.append(iss)
+
     def get_issuer(self, issuer_name):
         '''
         Returns issuer with specified name or None
         '''
-        for issuer in self.issuers:
-            if issuer.name == issuer_name:
-                return issuer
-        logger.warning("Issuer %s not found in cache" % issuer_name)
-        return None
+        return self._issuers_by_key.get(issuer_key(issuer_name))
     
     def is_certificate_revoked(self, issuer_name, cert_sn):
         '''
@@ -358,41 +1287,291 @@ class CRL_cache():
         '''
         iss = self.get_issuer(issuer_name)
         if iss is None:
-            iss = self.add_issuer(issuer_name)
+            iss = self.add_issuer(issuer_name) or self.get_issuer(issuer_name)
             #raise Exception("Issuer %s not found" % issuer_name)
         rev_date = iss.certificate_revoked(cert_sn)
         return rev_date
         
-    def pickle(self):   
+    def check_many(self, queries):
         '''
-        Stores the cache instance into a file
-        ''' 
-        # check if we have to pickle
-        has_to_pickle = False
-        if self.changed:
-            has_to_pickle = True
+        Returns revocation dates of certificates given as list of
+        (issuer name, serial number) pairs, in the same order. None stands
+        for certificates which are not revoked or whose issuer is not
+        in the cache. Serial numbers are looked up in bulk per issuer.
+        '''
+        names = set(map(itemgetter(0), queries))
+        if len(names) == 1:
+            # usual case - certificates of one issuer
+            groups = {names.pop(): (None, map(itemgetter(1), queries))}
         else:
-            for iss in self.issuers:
-                if iss.changed:
-                    has_to_pickle = True
-                    break
-        if not has_to_pickle:
-            logging.info("No changes since last load, pickling aborted")
+            groups = {}
+            for pos, (issuer_name, serial) in enumerate(queries):
+                group = groups.get(issuer_name)
+                if group is None:
+                    group = groups[issuer_name] = ([], [])
+                group[0].append(pos)
+                group[1].append(serial)
+        result = [None] * len(queries)
+        for issuer_name, (positions, serials) in groups.iteritems():
+            iss = self.get_issuer(issuer_name)
+            if iss is None or not iss.dist_points:
+                continue
+            dates = iss.revoked_view().get_many(serials)
+            CRL_cache_manager.get_stats().lookup(issuer_name, len(dates),
+                                                 len(dates) - dates.count(None))
+            if positions is None:
+                return dates
+            for pos, date in izip(positions, dates):
+                result[pos] = date
+        return result
+
+    def refresh_all(self, pool, verifications=None, force_crl_download=False):
+        '''
+        Refreshes CRLs of all issuers, downloads run concurrently in the
+        worker pool. verifications maps issuer names to certificates used
+        to verify their CRLs, by default the certificates attached to the
+        issuers are used.
+        Returns dictionary issuer name -> (result of download attempt,
+        number of added certificates).
+        '''
+        if verifications is None:
+            verifications = {}
+        started = []
+        waiting = []
+        for iss in list(self.issuers):
+            flight, leader = iss.begin_flight()
+            if not leader:
+                # refreshed by another thread
+                waiting.append((iss, flight))
+                continue
+            try:
+                verification = verifications.get(iss.name, iss.verification)
+                race = iss.start_refresh(verification, force_crl_download, pool)
+            except:
+                iss.end_flight(flight, (False, 0))
+                raise
+            started.append((iss, flight, race))
+        results = {}
+        for iss, flight, race in started:
+            result = False, 0
+            try:
+                iss.lock.acquire()
+                try:
+                    result = iss.finish_refresh(race)
+                finally:
+                    iss.lock.release()
+            finally:
+                iss.end_flight(flight, result)
+            results[iss.name] = result
+        for iss, flight in waiting:
+            flight.done.wait()
+            results[iss.name] = flight.result
+        return results
+
+    def save(self, path=None, compact=False):
+        '''
+        Stores changes of the cache. Changed distribution points are
+        appended to the journal next to the index file. The whole index
+        is rewritten (and the journal emptied) when it does not exist yet,
+        when compact is set or when the journal grows too big.
+        '''
+        self._save_lock.acquire()
+        # issuers are not changed while they are being stored
+        issuers = list(self.issuers)
+        for iss in issuers:
+            iss.lock.acquire()
+        try:
+            self.__save(issuers, path, compact)
+        finally:
+            for iss in issuers:
+                iss.lock.release()
+            self._save_lock.release()
+
+    def __save(self, issuers, path, compact):
+        changed = []
+        for iss in issuers:
+            for dpoint in iss.dist_points:
+                if iss.changed or dpoint.changed:
+                    changed.append((iss, dpoint))
+        if not (changed or self.changed or compact):
+            logger.info("No changes since last load, saving aborted")
             return
         
+        if path is None:
+            if not os.path.exists(CRL_DUMP_DIR):
+              logger.debug("Creating directory %s to store the CRL cache" % CRL_DUMP_DIR)
+              os.mkdir(CRL_DUMP_DIR)
+            path = os.path.join(CRL_DUMP_DIR, CRL_INDEX_FILE)
+        journal_path = crl_journal.journal_path(path)
+        if not compact and os.path.exists(path):
+            journal_size = crl_journal.append(journal_path, changed)
+            index_size = max(os.path.getsize(path), JOURNAL_MIN_COMPACT_SIZE)
+            compact = journal_size > JOURNAL_COMPACT_RATIO * index_size
+            if not compact:
+                logger.debug("Changes of %d CRLs appended to %s" % \
+                             (len(changed), journal_path))
+        if compact or not os.path.exists(path):
+            crl_index.write_index(issuers, path)
+            crl_journal.reset(journal_path)
+            logger.debug("CRL cache stored to file %s" % path)
         self.changed = False
-        import os.path
-        if not os.path.exists(CRL_DUMP_DIR):
-          logger.debug("Creating directory %s to pickle the CRL cache" % CRL_DUMP_DIR)
-          os.mkdir(CRL_DUMP_DIR)
-        path_to_cache = os.path.join(CRL_DUMP_DIR, CRL_DUMP_FILE)
-        logger.debug("Opening file %s to write the CRL cache" % CRL_DUMP_FILE)
-        f = open(path_to_cache, "w")
-        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
-        f.close()
-        logger.debug("CRL cache stored to file %s" % path_to_cache)
-        
-       
+        for iss in issuers:
+            iss.changed = False
+            for dpoint in iss.dist_points:
+                dpoint.changed = False
+                dpoint.pending_revoked = Revoked_store()
+                dpoint.pending_removed = []
+
+    def pickle(self):   
+        '''
+        Stores the cache instance into a file.
+        Kept for compatibility, the cache is stored as index (see save).
+        ''' 
+        self.save()
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads cache from the index file and applies changes from its
+        journal. Revoked certificates are not read, they stay in
+        the memory mapped file.
+        '''
+        mm, directory = crl_index.read_index(path)
+        cache = cls()
+        for iss_entry in directory:
+            iss = CRL_issuer(iss_entry['name'])
+            for dp_entry in iss_entry['dist_points']:
+                dpoint = CRL_dist_point(dp_entry['url'])
+                dpoint.set_meta(dp_entry['meta'])
+                dpoint.revoked_certs = crl_index.open_store(mm, dp_entry)
+                iss.append_dist_point(dpoint)
+            cache.append_issuer(iss)
+        for record in crl_journal.read(crl_journal.journal_path(path)):
+            cache._apply_journal_record(record)
+        return cache
+
+    def _apply_journal_record(self, record):
+        iss = self.get_issuer(record['issuer'])
+        if iss is None:
+            iss = CRL_issuer(record['issuer'])
+            self.append_issuer(iss)
+        dpoint = iss.find_dpoint(record['url'])
+        if dpoint is None:
+            dpoint = CRL_dist_point(record['url'])
+            iss.append_dist_point(dpoint)
+        dpoint.set_meta(record['meta'])
+        added = record['added']
+        if isinstance(added, tuple):
+            # packed records (serials, dates, count, width)
+            added = Revoked_store.from_buffers(*added)
+        dpoint.revoked_certs.add_many(added)
+        dpoint.revoked_certs.discard_many(record.get('removed', ()))
+
+    def import_crl(self, der_data, trusted_certs, url, crl=None):
+        '''
+        Adds CRL obtained offline (e.g. from a bundle copied to a host
+        without access to the CDPs) to the cache as dist point url.
+        The CRL is verified with the certificate of its issuer found
+        in trusted_certs. Delta CRLs are applied on top of the cached
+        base CRL they refer to, so base CRLs have to be imported first.
+        Returns number of added certificates or None, if the CRL
+        was not imported.
+        '''
+        if crl is None:
+            try:
+                crl = decoder.decode(der_data, asn1Spec=RevCertificateList())[0]
+            except Exception, ex:
+                logger.warning("Decoding of CRL %s failed: %s" % (url, ex))
+                return None
+        tbs = crl.getComponentByName("tbsCertList")
+        issuer_name = str(tbs.getComponentByName("issuer"))
+        issuer_cert = None
+        for cert in trusted_certs:
+            subject = cert.getComponentByName("tbsCertificate").\
+                           getComponentByName("subject")
+            if issuer_key(str(subject)) == issuer_key(issuer_name):
+                issuer_cert = cert
+                break
+        if issuer_cert is None:
+            logger.warning("Issuer of CRL %s is not trusted" % url)
+            return None
+        if not crl_verifier.verify_crl(crl, issuer_cert, der_data):
+            logger.warning("Verification of CRL %s failed" % url)
+            return None
+        reasons = {}
+        this_update, next_update, revoked, extensions = \
+                                            _read_decoded_crl(crl, reasons)
+        iss = self.add_issuer(issuer_name) or self.get_issuer(issuer_name)
+        base_number = crl_extensions.get_delta_base(extensions)
+        if base_number is not None:
+            for dpoint in iss.dist_points:
+                if dpoint.crlNumber is not None and \
+                   dpoint.crlNumber >= base_number:
+                    break
+            else:
+                logger.warning("Base CRL %s of delta CRL %s not imported" % \
+                               (base_number, url))
+                return None
+            if dpoint.deltaLastUpdated is not None and \
+               _to_seconds(dpoint.deltaLastUpdated) >= \
+               _to_seconds(this_update):
+                logger.info("Newer delta CRL already imported, %s skipped" % url)
+                return 0
+            return dpoint.apply_delta(this_update, next_update, revoked,
+                                      reasons,
+                                      crl_extensions.get_crl_number(extensions))
+        dpoint = iss.find_dpoint(url)
+        if dpoint is None:
+            dpoint = CRL_dist_point(url)
+            iss.append_dist_point(dpoint)
+            iss.changed = True
+        elif _to_seconds(dpoint.lastUpdated) >= _to_seconds(this_update):
+            logger.info("Newer CRL already imported, %s skipped" % url)
+            return 0
+        added_certs = dpoint.update_revoked(this_update, next_update, revoked)
+        dpoint.update_crl_info(extensions)
+        return added_certs
+
+    def import_dir(self, dirname, trusted_certs):
+        '''
+        Imports all CRLs (DER or PEM) from files in directory dirname,
+        base CRLs before delta CRLs, older before newer. The files are
+        used as dist points which are not downloaded by refreshes, CDPs
+        of the issuer are added from the first verified certificate
+        (see CRL_issuer.add_cert_dist_points).
+        Returns number of imported and number of rejected CRLs.
+        '''
+        crls = []
+        rejected = 0
+        for fname in sorted(os.listdir(dirname)):
+            path = os.path.abspath(os.path.join(dirname, fname))
+            if not os.path.isfile(path):
+                continue
+            url = 'file://' + urllib2.quote(path)
+            for der_data in read_crl_file(path):
+                try:
+                    crl = decoder.decode(der_data,
+                                         asn1Spec=RevCertificateList())[0]
+                except Exception, ex:
+                    logger.warning("%s is not a CRL: %s" % (path, ex))
+                    rejected += 1
+                    continue
+                tbs = crl.getComponentByName("tbsCertList")
+                extensions = crl_extensions.extensions_to_dict(
+                                        tbs.getComponentByName("crlExtensions"))
+                is_delta = crl_extensions.get_delta_base(extensions) is not None
+                this_update = _to_seconds(
+                                        str(tbs.getComponentByName("thisUpdate")))
+                crls.append((is_delta, this_update, url, der_data, crl))
+        crls.sort(key=lambda item: item[:2])
+        imported = 0
+        for is_delta, this_update, url, der_data, crl in crls:
+            if self.import_crl(der_data, trusted_certs, url, crl) is None:
+                rejected += 1
+            else:
+                imported += 1
+        return imported, rejected
+
     @classmethod
     def unpickle(self,fname):
         '''
@@ -405,8 +1584,13 @@ class CRL_cache():
     
 def _restore_cache():
     try:
+        index_fname = os.path.join(CRL_DUMP_DIR, CRL_INDEX_FILE)
+        if os.path.exists(index_fname):
+            return CRL_cache.load(index_fname)
         crl_fname = os.path.join(CRL_DUMP_DIR, CRL_DUMP_FILE)
         cache = CRL_cache.unpickle(crl_fname)
+        # store the old cache in the new format on next save
+        cache.changed = True
         return cache
     except Exception, ex:
         logger.warning(ex)
@@ -416,23 +1600,326 @@ def _restore_cache():
 
 
 
+class CRL_refresh_scheduler(threading.Thread):
+    '''
+    Background thread refreshing CRLs of issuers in the cache ahead of
+    their nextUpdate (with random jitter), so that certificate
+    verification only reads the cache. CRLs are verified with
+    the certificate attached to the issuer (CRL_issuer.verification),
+    issuers without it are not refreshed.
+    '''
+
+    # longest sleep of the thread, new issuers are noticed after it
+    MAX_WAIT = 3600
+
+    def __init__(self, cache, ahead=None, jitter=None, retry=None):
+        threading.Thread.__init__(self, name="CRL refresh scheduler")
+        self.setDaemon(True)
+        self.cache = cache
+        self.ahead = props.CRL_REFRESH_AHEAD if ahead is None else ahead
+        self.jitter = props.CRL_REFRESH_JITTER if jitter is None else jitter
+        self.retry = props.CRL_REFRESH_RETRY if retry is None else retry
+        # issuer name -> planned time of refresh (seconds since the epoch)
+        self._planned = {}
+        self._wakeup = threading.Event()
+        self._finished = threading.Event()
+
+    def schedule(self, issuer, when=None):
+        '''
+        Plans refresh of issuer on time when (now by default).
+        '''
+        if when is None:
+            when = time.time()
+        self._planned[issuer.name] = when
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._finished.set()
+        self._wakeup.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join(timeout)
+
+    def run(self):
+        logger.info("CRL refresh scheduler started")
+        while not self._finished.isSet():
+            try:
+                wake_time = self.refresh_due()
+            except Exception, ex:
+                logger.error("Background CRL refresh failed: %s" % ex)
+                wake_time = time.time() + self.retry
+            timeout = min(max(wake_time - time.time(), 0), self.MAX_WAIT)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+        logger.info("CRL refresh scheduler stopped")
+
+    def refresh_due(self):
+        '''
+        Refreshes issuers whose planned time passed and stores the changes
+        of the cache. Returns time of the next planned refresh.
+        '''
+        wake_time = time.time() + self.MAX_WAIT
+        refreshed = False
+        for iss in list(self.cache.issuers):
+            if self._finished.isSet():
+                break
+            planned = self._planned.get(iss.name)
+            if planned is None:
+                planned = self._planned[iss.name] = self.__plan(iss)
+            if planned <= time.time():
+                refreshed = self.__refresh(iss) or refreshed
+                planned = self._planned[iss.name]
+            wake_time = min(wake_time, planned)
+        if refreshed:
+            self.cache.save()
+        return wake_time
+
+    def __plan(self, iss):
+        '''
+        Returns time of the next refresh of the issuer - ahead of the
+        first nextUpdate of its CRLs and delta CRLs.
+        '''
+        dpoint = iss.freshest_dist_point()
+        if dpoint is None:
+            return time.time()
+        times = [dpoint.next_update_seconds()]
+        if dpoint.deltaUrl:
+            times.append(dpoint.next_update_seconds(delta=True))
+        times = [t for t in times if t is not None]
+        if not times:
+            return time.time() + self.MAX_WAIT
+        return min(times) - self.ahead + random.uniform(0, self.jitter)
+
+    def __refresh(self, iss):
+        now = time.time()
+        if iss.verification is None:
+            logger.debug("No certificate to verify CRLs of %s, not refreshing" %\
+                         iss.name)
+            self._planned[iss.name] = now + self.retry
+            return False
+        # base CRLs are downloaded even before their nextUpdate
+        dpoint = iss.freshest_dist_point()
+        next_update = dpoint and dpoint.next_update_seconds()
+        force = next_update is None or next_update - self.ahead <= now
+        try:
+            pool = CRL_cache_manager.get_fetch_pool()
+            success, added_certs = iss.refresh_issuer(iss.verification,
+                                                      force_crl_download=force,
+                                                      pool=pool)
+        except Exception, ex:
+            logger.warning("Refresh of %s failed: %s" % (iss.name, ex))
+            success = False
+        if success:
+            # the CA may publish new CRL later than planned, do not retry
+            # sooner than after the retry interval
+            self._planned[iss.name] = max(self.__plan(iss), now + self.retry)
+        else:
+            logger.warning("Background refresh of %s failed" % iss.name)
+            self._planned[iss.name] = now + self.retry
+        return success
+
+
 class CRL_cache_manager():
   _crl_cache = None
+  _scheduler = None
+  _fetch_pool = None
+  _decode_pool = None
+  # the decode pool is not forked after the fetch pool or the scheduler
+  # started their threads
+  _threads_started = False
+  _stats = crl_stats.CRL_stats()
+  _lock = threading.RLock()
   
   @classmethod
   def get_cache(self): 
     #global _crl_cache
        
     if self._crl_cache is None:
-      # try to restore cache
-      cache = _restore_cache()
-      # if restoring failed   
-      if cache is None:    
-        logger.info("CRL cache not found locally, returning empty cache")  
-        self._crl_cache = CRL_cache()
-      else:
-        logger.info("Cache restored from local storage")
-        self._crl_cache = cache
+      self._lock.acquire()
+      try:
+        if self._crl_cache is None:
+          self.start_decode_pool()
+          self.__restore()
+      finally:
+        self._lock.release()
     return self._crl_cache
 
-    
\ No newline at end of file
+  @classmethod
+  def __restore(self):
+    if props.CRL_CACHE_BACKEND == 'sqlite':
+      # cache shared with other processes
+      import crl_sqlite
+      if not os.path.exists(CRL_DUMP_DIR):
+        os.mkdir(CRL_DUMP_DIR)
+      path = os.path.join(CRL_DUMP_DIR, CRL_SQLITE_FILE)
+      self._crl_cache = crl_sqlite.SQLite_CRL_cache(path)
+      logger.info("Using CRL cache database %s" % path)
+      if props.CRL_REFRESH_SCHEDULER:
+        self.start_scheduler()
+      return
+    # try to restore cache
+    cache = _restore_cache()
+    # if restoring failed   
+    if cache is None:    
+      logger.info("CRL cache not found locally, returning empty cache")  
+      self._crl_cache = CRL_cache()
+    else:
+      logger.info("Cache restored from local storage")
+      self._crl_cache = cache
+    if props.CRL_REFRESH_SCHEDULER:
+      self.start_scheduler()
+
+  @classmethod
+  def start_scheduler(self, ahead=None, jitter=None, retry=None):
+    '''
+    Starts background refreshing of CRLs in the cache.
+    '''
+    self._lock.acquire()
+    try:
+      if self._scheduler is None:
+        self.start_decode_pool()
+        self._scheduler = CRL_refresh_scheduler(self.get_cache(), ahead,
+                                                jitter, retry)
+        self._threads_started = True
+        self._scheduler.start()
+      return self._scheduler
+    finally:
+      self._lock.release()
+
+  @classmethod
+  def stop_scheduler(self):
+    if self._scheduler is not None:
+      self._scheduler.stop()
+      self._scheduler = None
+
+  @classmethod
+  def get_fetch_pool(self):
+    '''
+    Returns pool of threads downloading CRLs.
+    '''
+    self._lock.acquire()
+    try:
+      if self._fetch_pool is None:
+        self.start_decode_pool()
+        self._fetch_pool = Worker_pool(props.CRL_FETCH_WORKERS)
+        self._threads_started = True
+      return self._fetch_pool
+    finally:
+      self._lock.release()
+
+  @classmethod
+  def start_decode_pool(self):
+    '''
+    Creates pool of processes decoding large CRLs (CRL_DECODE_PROCESSES).
+    It is created before the cache starts any thread (fetch pool,
+    scheduler, lock keepers), because processes forked while other
+    threads run may inherit locks held by them. Applications running
+    their own threads should call it at startup.
+    multiprocessing.Pool is used, Python 2 has no ProcessPoolExecutor.
+    '''
+    self._lock.acquire()
+    try:
+      if self._decode_pool is None and props.CRL_DECODE_PROCESSES > 0:
+        if self._threads_started:
+          logger.warning("CRL decode processes not started, threads of "
+                         "the CRL cache are already running")
+        else:
+          self._decode_pool = multiprocessing.Pool(props.CRL_DECODE_PROCESSES)
+      return self._decode_pool
+    finally:
+      self._lock.release()
+
+  @classmethod
+  def get_decode_pool(self):
+    '''
+    Returns pool of processes decoding large CRLs or None, if they are
+    decoded in the calling thread (CRL_DECODE_PROCESSES is 0 or the pool
+    was not started, see start_decode_pool).
+    '''
+    return self._decode_pool
+
+  @classmethod
+  def refresh_all(self, force_crl_download=False):
+    '''
+    Refreshes all issuers of the cache concurrently and saves the cache.
+    '''
+    cache = self.get_cache()
+    results = cache.refresh_all(self.get_fetch_pool(),
+                                force_crl_download=force_crl_download)
+    cache.save()
+    return results
+
+  @classmethod
+  def get_stats(self):
+    '''
+    Returns CRL_stats collecting statistics of the CRL checks.
+    '''
+    return self._stats
+
+  @classmethod
+  def get_stats_snapshot(self):
+    '''
+    Returns dictionary with statistics of issuers and their dist points
+    (see CRL_stats.snapshot), completed with data of the cached CRLs.
+    '''
+    return self._stats.snapshot(self._crl_cache)
+
+  @classmethod
+  def add_stats_exporter(self, exporter):
+    '''
+    Attaches exporter(name, value, tags) receiving all recorded values.
+    '''
+    self._stats.add_exporter(exporter)
+
+  @classmethod
+  def remove_stats_exporter(self, exporter):
+    self._stats.remove_exporter(exporter)
+
+  @classmethod
+  def get_scheduler(self):
+    '''
+    Returns running refresh scheduler or None.
+    '''
+    return self._scheduler
+
+    
+
+USAGE = '''python -m dslib.certs.crl_store import [options] <dir>
+
+Imports CRLs (DER or PEM files) from directory <dir> into the CRL cache,
+e.g. on hosts without access to the CDPs. CRLs are verified with trusted
+certificates and stored in the index file, which is only mapped to memory
+when the cache is restored.'''
+
+def main(argv):
+  from optparse import OptionParser
+  import cert_loader
+  parser = OptionParser(usage=USAGE)
+  parser.add_option("-t", "--trusted", default="trusted_certificates",
+                    help="directory with trusted certificates "
+                         "[default: %default]")
+  parser.add_option("-o", "--output",
+                    default=os.path.join(CRL_DUMP_DIR, CRL_INDEX_FILE),
+                    help="index file of the cache, CRLs are added to it "
+                         "when it exists [default: %default]")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 2 or args[0] != 'import':
+    parser.error("expected: import <dir>")
+  logging.basicConfig(level=logging.WARNING)
+  trusted_certs = cert_loader.load_certificates_from_dir(options.trusted)
+  if not trusted_certs:
+    parser.error("no trusted certificates found in %s" % options.trusted)
+  if os.path.exists(options.output):
+    cache = CRL_cache.load(options.output)
+  else:
+    cache = CRL_cache()
+    output_dir = os.path.dirname(options.output)
+    if output_dir and not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+  imported, rejected = cache.import_dir(args[1], trusted_certs)
+  cache.save(options.output, compact=True)
+  print "%d CRLs imported, %d rejected, cache stored to %s" % \
+        (imported, rejected, options.output)
+  return 1 if rejected else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,305 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Streaming parser of CRLs.
+CRL is parsed while it is being downloaded - data are fed in chunks,
+revoked certificates are passed to a callback as soon as their entry
+is complete and tbsCertList is hashed on the fly for the signature check.
+Only the unparsed rest of the last chunk is kept in memory.
+'''
+
+# standard library imports
+import logging
+logger = logging.getLogger('certs.crl_stream')
+
+# dslib imports
+from pyasn1.codec.der import decoder
+from dslib.pkcs7.asn1_models.general_types import AlgorithmIdentifier, Name
+from dslib.pkcs7.digest import new_digest
+
+# local imports
+import crl_verifier
+import crl_extensions
+import fast_rev_cert_parser as fast_parser
+from fast_rev_cert_parser import SEQUENCE_TAG, INTEGER_TAG, \
+                                 UTC_TIME_TAG, GENERALIZED_TIME_TAG
+
+BIT_STRING_TAG = 0x03
+CRL_EXTENSIONS_TAG = 0xA0
+
+# states of the parser
+_OUTER, _TBS, _TBS_FIELDS, _REVOKED, _SIG_ALG, _SIG_VALUE, _DONE = range(7)
+
+
+def _header_available(buf, pos):
+  '''
+  Checks if the whole tag and length of the object starting
+  at pos is in the buffer.
+  '''
+  if pos + 2 > len(buf):
+    return False
+  first_byte = ord(buf[pos+1])
+  if first_byte > 128:
+    return pos + 2 + (first_byte & 0x7F) <= len(buf)
+  return True
+
+
+class CRL_stream_parser(object):
+  '''
+  Incremental CRL parser. Feed it with chunks of DER encoded CRL
+  and call close() at the end. After that following attributes are set:
+  - issuer (string form of Name)
+  - this_update, next_update (time strings, next_update may be None)
+  - signature_algorithm (OID string)
+  - signature (octets)
+  - tbs_digest (digest of tbsCertList computed with digest_algorithm)
+  - crl_extensions (DER of crlExtensions component or None)
+  - revoked_count
+  on_revoked(serial, date) is called for each revoked certificate.
+  If reasons dictionary is given, reason codes of the entries are
+  stored into it.
+  '''
+
+  def __init__(self, on_revoked, reasons=None):
+    self.on_revoked = on_revoked
+    self.reasons = reasons
+    self.issuer = None
+    self.this_update = None
+    self.next_update = None
+    self.tbs_signature_algorithm = None
+    self.signature_algorithm = None
+    self.digest_algorithm = None
+    self.signature = None
+    self.tbs_digest = None
+    self.crl_extensions = None
+    self.revoked_count = 0
+    self._buf = ''
+    self._pos = 0
+    self._state = _OUTER
+    # absolute offset of self._buf[0] in the stream
+    self._base = 0
+    self._tbs_end = None
+    self._revoked_end = None
+    self._hash = None
+    self._tbs_prefix = []
+
+  def _offset(self):
+    return self._base + self._pos
+
+  def _hash_update(self, data):
+    if self._hash is not None:
+      self._hash.update(data)
+    else:
+      # digest algorithm is not known before the signature field is parsed
+      self._tbs_prefix.append(data)
+
+  def _take_element(self):
+    '''
+    Returns tag and the whole element (header with content) at the
+    current position or None if it is not complete in the buffer.
+    '''
+    buf, pos = self._buf, self._pos
+    if not _header_available(buf, pos):
+      return None
+    tag, length, content = fast_parser._read_header(buf, pos)
+    end = content + length
+    if end > len(buf):
+      return None
+    self._pos = end
+    return tag, buf[pos:end], content - pos
+
+  def _take_header(self):
+    '''
+    Consumes only the tag and length of the element at current position.
+    Returns tag, header bytes and length of content or None.
+    '''
+    buf, pos = self._buf, self._pos
+    if not _header_available(buf, pos):
+      return None
+    tag, length, content = fast_parser._read_header(buf, pos)
+    self._pos = content
+    return tag, buf[pos:content], length
+
+  def feed(self, data):
+    '''
+    Parses next chunk of CRL.
+    '''
+    if self._pos:
+      self._base += self._pos
+      self._buf = self._buf[self._pos:] + data
+      self._pos = 0
+    else:
+      self._buf += data
+    try:
+      self._parse()
+    except IndexError, ex:
+      raise ValueError("Malformed CRL: %s" % ex)
+
+  def close(self):
+    '''
+    Finishes parsing. Raises ValueError if the CRL is not complete.
+    '''
+    if self._state != _DONE:
+      raise ValueError("CRL stream ended unexpectedly")
+    if self._pos != len(self._buf):
+      logger.warning("Unexpected data after end of CRL")
+    self._buf = ''
+    self._pos = 0
+
+  def _parse(self):
+    while True:
+      state = self._state
+      if state == _OUTER:
+        res = self._take_header()
+        if res is None:
+          return
+        if res[0] != SEQUENCE_TAG:
+          raise ValueError("CRL has to start with sequence")
+        self._state = _TBS
+      elif state == _TBS:
+        res = self._take_header()
+        if res is None:
+          return
+        tag, header, length = res
+        if tag != SEQUENCE_TAG:
+          raise ValueError("tbsCertList sequence expected")
+        self._tbs_end = self._offset() + length
+        self._hash_update(header)
+        self._state = _TBS_FIELDS
+      elif state == _TBS_FIELDS:
+        if self._offset() >= self._tbs_end:
+          self._finish_tbs()
+          continue
+        if not _header_available(self._buf, self._pos):
+          return
+        tag = ord(self._buf[self._pos])
+        if tag == SEQUENCE_TAG and self.issuer is not None:
+          # revokedCertificates - parsed entry by entry
+          tag, header, length = self._take_header()
+          self._hash_update(header)
+          self._revoked_end = self._offset() + length
+          self._state = _REVOKED
+          continue
+        res = self._take_element()
+        if res is None:
+          return
+        tag, element, content_offset = res
+        self._hash_update(element)
+        self._tbs_field(tag, element, content_offset)
+      elif state == _REVOKED:
+        if not self._parse_revoked():
+          return
+        self._state = _TBS_FIELDS
+      elif state == _SIG_ALG:
+        res = self._take_element()
+        if res is None:
+          return
+        self.signature_algorithm = str(decoder.decode(res[1],
+                                       asn1Spec=AlgorithmIdentifier())[0])
+        self._state = _SIG_VALUE
+      elif state == _SIG_VALUE:
+        res = self._take_element()
+        if res is None:
+          return
+        tag, element, content_offset = res
+        if tag != BIT_STRING_TAG:
+          raise ValueError("Signature bit string expected")
+        # first octet of content is the number of unused bits
+        self.signature = element[content_offset+1:]
+        self._state = _DONE
+      else:
+        return
+
+  def _tbs_field(self, tag, element, content_offset):
+    '''
+    Handles one (small) component of tbsCertList.
+    '''
+    if tag == INTEGER_TAG:
+      # version
+      return
+    if tag == SEQUENCE_TAG:
+      if self.tbs_signature_algorithm is None:
+        alg = str(decoder.decode(element, asn1Spec=AlgorithmIdentifier())[0])
+        self.tbs_signature_algorithm = alg
+        self.digest_algorithm = crl_verifier.get_digest_algorithm(alg)
+        self._hash = new_digest(self.digest_algorithm)
+        for data in self._tbs_prefix:
+          self._hash.update(data)
+        self._tbs_prefix = None
+      else:
+        self.issuer = str(decoder.decode(element, asn1Spec=Name())[0])
+    elif tag == UTC_TIME_TAG or tag == GENERALIZED_TIME_TAG:
+      if self.this_update is None:
+        self.this_update = element[content_offset:]
+      else:
+        self.next_update = element[content_offset:]
+    elif tag == CRL_EXTENSIONS_TAG:
+      self.crl_extensions = element
+    else:
+      logger.warning("Unexpected component in tbsCertList: %x" % tag)
+
+  def _parse_revoked(self):
+    '''
+    Parses all complete revoked certificate entries in the buffer.
+    Returns True when the whole revoked list was parsed.
+    '''
+    buf = self._buf
+    start = pos = self._pos
+    end = self._revoked_end - self._base
+    on_revoked = self.on_revoked
+    reasons = self.reasons
+    count = 0
+    while pos < end:
+      if not _header_available(buf, pos):
+        break
+      tag, length, content = fast_parser._read_header(buf, pos)
+      if content + length > len(buf):
+        break
+      sn, date, pos = fast_parser._parse_entry(buf, pos, reasons)
+      on_revoked(sn, date)
+      count += 1
+    self.revoked_count += count
+    self._pos = pos
+    if pos > start:
+      self._hash_update(buf[start:pos])
+    return pos >= end
+
+  def _finish_tbs(self):
+    if self._hash is None:
+      raise ValueError("Signature algorithm of tbsCertList not found")
+    self.tbs_digest = self._hash.digest()
+    self._hash = None
+    self._state = _SIG_ALG
+
+  def get_extensions(self):
+    '''
+    Returns dictionary of CRL extensions (OID -> DER encoded value).
+    '''
+    if self.crl_extensions is None:
+      return {}
+    return crl_extensions.decode_crl_extensions(self.crl_extensions)
+
+  def verify(self, certificate):
+    '''
+    Verifies signature of the parsed CRL with issuer certificate.
+    '''
+    if self.signature_algorithm != self.tbs_signature_algorithm:
+      logger.error("Signature algorithm of CRL differs from the one in tbsCertList")
+      return False
+    return crl_verifier.verify_digest(self.tbs_digest, self.signature,
+                                      certificate)
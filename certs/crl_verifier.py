@@ -36,37 +36,70 @@ from dslib.pkcs7 import rsa_verifier
 
 # local imports
 from constants import *
+import fast_rev_cert_parser as fast_parser
 
 
-def verify_crl(crl, certificate):
+def get_digest_algorithm(sig_alg):
     '''
-    Checks if the signature of CRL is OK.
+    Returns name of the digest algorithm used by CRL signature
+    algorithm sig_alg (OID string).
     '''
-    tbs = crl.getComponentByName("tbsCertList")
-    # bad idea - encoding too time consuming
-    # try to keep the encoded version of tbsCertlist
-    tbs_encoded = encoder.encode(tbs)
-    
-    sig_alg = str(crl.getComponentByName("signatureAlgorithm"))
-    sa_name = oid_map[sig_alg]
-    
+    sa_name = oid_map.get(sig_alg)
     if (sa_name == SHA1RSA_NAME):
-        calculated_digest = calculate_digest(tbs_encoded, SHA1_NAME)
+        return SHA1_NAME
     elif (sa_name == SHA256RSA_NAME):
-        calculated_digest = calculate_digest(tbs_encoded, SHA256_NAME)
-    else:
-        logger.error("Unknown certificate signature algorithm: %s" % sig_alg)
-        raise Exception("Unknown certificate signature algorithm: %s" % sig_alg)
-    
+        return SHA256_NAME
+    logger.error("Unknown certificate signature algorithm: %s" % sig_alg)
+    raise Exception("Unknown certificate signature algorithm: %s" % sig_alg)
+
+
+def verify_digest(tbs_digest, signature, certificate):
+    '''
+    Checks if the signature of CRL matches digest of tbsCertList
+    calculated by the caller (e.g. while the CRL was downloaded).
+    '''
     alg, key_material = verifier._get_key_material(certificate)
-    
-    signature = crl.getComponentByName("signatureValue").toOctets()
-        
     # compare calculated hash and decrypted signature
     try:
-        res = rsa_verifier.rsa_verify(calculated_digest, signature, key_material)
+        res = rsa_verifier.rsa_verify(tbs_digest, signature, key_material)
     except:
         logger.error("RSA verification of CRL failed")
         return False
     
-    return res
\ No newline at end of file
+    return res
+
+
+def get_tbs_bytes(der_data):
+    '''
+    Returns DER encoded tbsCertList - the bytes covered by the signature -
+    taken directly from the encoded CRL der_data.
+    '''
+    tag, length, pos = fast_parser._read_header(der_data, 0)
+    if tag != fast_parser.SEQUENCE_TAG:
+        raise ValueError("CRL is not a SEQUENCE")
+    tag, length, content_pos = fast_parser._read_header(der_data, pos)
+    end = content_pos + length
+    if tag != fast_parser.SEQUENCE_TAG or end > len(der_data):
+        raise ValueError("Bad tbsCertList of CRL")
+    return der_data[pos:end]
+
+
+def verify_crl(crl, certificate, der_data=None):
+    '''
+    Checks if the signature of CRL is OK.
+    When the encoded CRL der_data is given, the signed bytes are taken
+    from it, otherwise the decoded tbsCertList is encoded again.
+    '''
+    if der_data is not None:
+        tbs_encoded = get_tbs_bytes(der_data)
+    else:
+        # encoding is time consuming, pass der_data when available
+        tbs = crl.getComponentByName("tbsCertList")
+        tbs_encoded = encoder.encode(tbs)
+    
+    sig_alg = str(crl.getComponentByName("signatureAlgorithm"))
+    calculated_digest = calculate_digest(tbs_encoded, get_digest_algorithm(sig_alg))
+    
+    signature = crl.getComponentByName("signatureValue").toOctets()
+    
+    return verify_digest(calculated_digest, signature, certificate)
@@ -18,118 +18,168 @@
 '''
 Fast revoked certificates numbers list parser.
 (Parsing big ammount of small objects with complex pyasn tool is too slow)
-Parses only the revoked certificates numbers, revocation
-dates and crl entry extensions are ignored
+Parses only the revoked certificates numbers and revocation
+dates, of crl entry extensions only the reason code is read on request
+(needed for delta CRLs)
+
+The parser walks the buffer by integer offsets - the revoked list is never
+sliced, only the bytes of the serial number and of the date are copied out.
+Buffer may be a string, a buffer, a bytearray or a memoryview.
 '''
 
 # standard library imports
 import logging
 logger = logging.getLogger('certs.fast_rev_cer_parser')
+from binascii import hexlify
+
+SEQUENCE_TAG = 0x30
+INTEGER_TAG = 0x02
+UTC_TIME_TAG = 0x17
+GENERALIZED_TIME_TAG = 0x18
+OID_TAG = 0x06
+BOOLEAN_TAG = 0x01
+OCTET_STRING_TAG = 0x04
+ENUMERATED_TAG = 0x0A
 
-# dslib imports
-from dslib.converters.bytes_converter import bytes_to_int
+# DER content of id-ce-cRLReasons OID (2.5.29.21)
+REASON_CODE_OID = '\x55\x1d\x15'
+# reason code of entries in delta CRL, which are no longer revoked
+REMOVE_FROM_CRL = 8
 
 
-def _decode_len(substrate):
+def _as_buffer(substrate):
   '''
-  Returns length of object and size of length string.
+  Returns object which can be indexed by single bytes (as characters).
   '''
-  first_byte = ord(substrate[0])
-  if first_byte == 128:
-    logger.error("Unexpected length of object, expecting definite length form")
-    return 0,0
+  if isinstance(substrate, bytearray):
+    return memoryview(substrate)
+  return substrate
+
+def _get_bytes(buf, start, end):
+  '''
+  Copies bytes between start and end out of the buffer as a string.
+  '''
+  res = buf[start:end]
+  if type(res) is not str:
+    res = res.tobytes()
+  return res
+
+def _read_header(buf, pos):
+  '''
+  Reads tag and length of the object starting at position pos.
+  Returns tag, length of the content and position of the content.
+  Raises ValueError on indefinite or truncated length.
+  '''
+  tag = ord(buf[pos])
+  first_byte = ord(buf[pos+1])
   if first_byte < 128:
-    return first_byte, 1
-  else:
-    size = first_byte & 0x7F    
-    length_str = substrate[1:size+1]
-    length = bytes_to_int(length_str)
-    return length, size
+    return tag, first_byte, pos + 2
+  if first_byte == 128:
+    raise ValueError("Unexpected length of object, expecting definite length form")
+  size = first_byte & 0x7F
+  length_start = pos + 2
+  if length_start + size > len(buf):
+    raise ValueError("Length of object exceeds the buffer")
+  length = int(hexlify(_get_bytes(buf, length_start, length_start + size)), 16)
+  return tag, length, length_start + size
 
-def _get_date(substrate):
+def _get_reason(buf, pos, end):
+  '''
+  Returns reason code from crl entry extensions between pos and end
+  or None, if there is no reason code extension.
   '''
-  Extracts date string from substrate. According to postsignum policy, this is UTCTime.
-  Added also GeneralizedTime (... just to be sure...)
+  tag, length, pos = _read_header(buf, pos)
+  if tag != SEQUENCE_TAG:
+    return None
+  while pos < end:
+    tag, length, ext_start = _read_header(buf, pos)
+    ext_end = ext_start + length
+    tag, oid_len, oid_start = _read_header(buf, ext_start)
+    if tag == OID_TAG and \
+       _get_bytes(buf, oid_start, oid_start + oid_len) == REASON_CODE_OID:
+      value_pos = oid_start + oid_len
+      tag, length, content = _read_header(buf, value_pos)
+      if tag == BOOLEAN_TAG:
+        # critical flag
+        tag, length, content = _read_header(buf, content + length)
+      if tag != OCTET_STRING_TAG:
+        return None
+      tag, length, content = _read_header(buf, content)
+      if tag != ENUMERATED_TAG or length == 0:
+        return None
+      return int(hexlify(_get_bytes(buf, content, content + length)), 16)
+    pos = ext_end
+  return None
+
+def _parse_entry(buf, pos, reasons=None):
   '''
-  date_tag = substrate[0]
-  if date_tag == chr(0x17) or chr(0x18):
-    date_len, size_of_len_str = _decode_len(substrate[1:])
-    # content starts after tag (+1) and the length specification (+size_of_len_str)
-    date_content_start = 1 + size_of_len_str
-    date = substrate[date_content_start : date_content_start + date_len]
-    return date
-  logger.warning("Date extraction from revoked cert list failed! Returning empty string.")
-  return ""
-  
-def _parse_one_serial(substrate):   
+  Parses one revoked certificate entry (sequence of serial number,
+  revocation date and optional entry extensions) starting at pos.
+  Returns serial number, revocation date and position of the next entry.
+  If dictionary reasons is given, reason code of the entry (if present)
+  is stored into it under the serial number.
+  Raises ValueError or IndexError when the entry is malformed.
   '''
-  Parses one integer at the beggining of sequence and date immediately after it.
-  Returns parsed serial number, date of revocation (UTC format, in string) and string starting at
-  the position of the next sequence with revoked certificate id.
-  ''' 
-  if substrate[0] == chr(0x30):
-    # ok, we are starting at sequence beginning    
-    object_len, size_of_len_str = _decode_len(substrate[1:])
-    if (object_len == 0):
-      logger.error("Error parsing sequence object length")
-    content_offset = 1+size_of_len_str
-    # position of next sequence object start (other revoked certificate id)
-    next_start = content_offset + object_len    
-    if substrate[content_offset] == chr(0x02):      
-      # ok - integer id first - certificate serial number
-      int_len, size_of_len_str = _decode_len(substrate[content_offset+1:])
-      if (int_len == 0):
-        logger.error("Error parsing integer object length")
-      # position of start of serial number
-      absolute_start_of_int = content_offset + size_of_len_str + 1
-      # psoition of end of serial number
-      absolute_end_of_int = absolute_start_of_int + int_len
-      sn_bytes = substrate[absolute_start_of_int:absolute_end_of_int]
-      sn = bytes_to_int(sn_bytes)      
-    
-      # continue with date immediately after the integer (spec says, that revocationTime is mandatory)
-      date_start = absolute_end_of_int
-      date = _get_date(substrate[date_start:])
-        
-      return sn, date, substrate[next_start:]   
-    else:
-      logger.error("Integer header expected (byte 0x2)")
-      return -1,'', ''
-      
-  else:
-    logger.error("Unexpected char: %x" % ord(substrate[0]))
-    # return empty string to stop the parsing process
-    return -1, '', ''
+  tag, length, content = _read_header(buf, pos)
+  if tag != SEQUENCE_TAG:
+    raise ValueError("Unexpected char: %x" % tag)
+  next_start = content + length
+  tag, int_len, int_start = _read_header(buf, content)
+  if tag != INTEGER_TAG or int_len == 0:
+    raise ValueError("Integer header expected (byte 0x2)")
+  int_end = int_start + int_len
+  sn = int(hexlify(_get_bytes(buf, int_start, int_end)), 16)
+  # revocationTime is mandatory and follows the serial number
+  date = ""
+  date_end = int_end
+  if int_end < next_start:
+    tag, date_len, date_start = _read_header(buf, int_end)
+    if tag == UTC_TIME_TAG or tag == GENERALIZED_TIME_TAG:
+      date = _get_bytes(buf, date_start, date_start + date_len)
+      date_end = date_start + date_len
+  if not date:
+    logger.warning("Date extraction from revoked cert list failed! Returning empty string.")
+  if reasons is not None and date and date_end < next_start:
+    reason = _get_reason(buf, date_end, next_start)
+    if reason is not None:
+      reasons[sn] = reason
+  return sn, date, next_start
 
-def _unwrap_cert_list(substrate):
+def iter_revoked(rev_cert_list, offset=0, reasons=None):
   '''
-  Removes the Set tag left because of Any type.
-  Returns the substrate ready to be parsed in _parse_one_serial.
+  Generator of (serial number, revocation date) tuples.
+  rev_cert_list is DER encoded SEQUENCE OF revoked certificates
+  starting at offset. Revocation date is returned as string
+  (UTCTime or GeneralizedTime content), empty string if it could not
+  be extracted. Reason codes are collected into dictionary reasons
+  (serial number -> code), if it is given.
   '''
-  if substrate[0] == chr(0x30):
-    object_len, size_of_len_str = _decode_len(substrate[1:])
-    if (object_len == 0):
-      logger.error("Error parsing sequence object length")
-    # 1 for tag, 1 for len specifier + size of length string  
-    content_offset = 2+size_of_len_str
-    return substrate[content_offset:]
-  else:
+  buf = _as_buffer(rev_cert_list)
+  if len(buf) <= offset:
+    return
+  try:
+    tag, length, pos = _read_header(buf, offset)
+  except (ValueError, IndexError), ex:
+    logger.error("Error parsing revoked certificates list header: %s" % ex)
+    return
+  if tag != SEQUENCE_TAG:
     logger.error('Unexpected char at the beginning of revCertList')
-    return ''
+    return
+  end = pos + length
+  if end > len(buf):
+    logger.error("Revoked certificates list is truncated")
+    end = len(buf)
+  while pos < end:
+    try:
+      sn, date, pos = _parse_entry(buf, pos, reasons)
+    except (ValueError, IndexError), ex:
+      logger.error("Error parsing revoked certificates list: %s" % ex)
+      return
+    yield sn, date
 
 def parse_all(rev_cert_list):
   '''
   Returns  list of revoked certificates serial numbers
+  (list of [serial number, revocation date] pairs)
   '''
-  substrate = rev_cert_list 
-  substrate = _unwrap_cert_list(substrate)
-  res = []  
-  while len(substrate) != 0:
-     sn, rev_date, substrate = _parse_one_serial(substrate)
-     #f.write('Parsed serial number: %x\n' % sn)
-     if sn == -1:
-       logger.error("Error parsing revoked certificates list") 
-     else:
-       res.append([sn, rev_date])
-  #f.close()
-  return res
\ No newline at end of file
+  return [[sn, rev_date] for sn, rev_date in iter_revoked(rev_cert_list)]
@@ -0,0 +1,411 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+OCSP client - asks responder of the certificate issuer for the status
+of a single certificate, which is much cheaper than downloading the
+whole CRL. Verified responses are cached until their nextUpdate.
+Requests carry no nonce, so responders may answer from pre-produced
+responses (and the answers may be cached). Responses without nextUpdate
+older than OCSP_MAX_AGE could be replayed, their status is unknown.
+'''
+
+# standard library imports
+import hashlib
+import time
+import threading
+import urllib2
+import logging
+logger = logging.getLogger('certs.ocsp_client')
+
+# dslib imports
+from pyasn1.codec.der import encoder, decoder
+from pyasn1.type import univ
+from dslib.pkcs7.asn1_models.ocsp import *
+from dslib.pkcs7.asn1_models.tools import tuple_to_OID
+from dslib.pkcs7.digest import calculate_digest
+from dslib.properties.properties import Properties as props
+
+# local imports
+import crl_verifier
+import timeutil
+from crl_store import issuer_key
+from cert_finder import _get_tbs_certificate, get_extension_value
+
+# certificate status
+GOOD = 'good'
+REVOKED = 'revoked'
+UNKNOWN = 'unknown'
+
+SHA1_OID = '1.3.14.3.2.26'
+OCSP_REQUEST_TYPE = 'application/ocsp-request'
+# seconds of tolerated difference of clocks of responder and ours
+CLOCK_SKEW = 300
+# timeout of the request (seconds)
+OCSP_TIMEOUT = 10
+# responses kept in the cache (expired ones are dropped first)
+OCSP_CACHE_SIZE = 10000
+
+
+def _generalized_to_seconds(value):
+    '''
+    Converts GeneralizedTime (YYYYMMDDHHMMSS[.fff]Z) to seconds since
+    the epoch.
+    '''
+    return timeutil.to_seconds_from_epoch(str(value))
+
+def get_ocsp_urls(certificate):
+    '''
+    Returns HTTP URLs of OCSP responders from authorityInfoAccess
+    extension of the certificate.
+    '''
+    value = get_extension_value(certificate, AUTHORITY_INFO_ACCESS_EXT_ID)
+    if value is None:
+        return []
+    urls = []
+    for access in decoder.decode(value, asn1Spec=AuthorityInfoAccess())[0]:
+        method = tuple_to_OID(access.getComponentByName('accessMethod'))
+        location = access.getComponentByName('accessLocation')
+        if method == OCSP_ACCESS_METHOD_ID and \
+           location.getName() == 'uniformResourceIdentifier':
+            url = str(location.getComponent())
+            if url.startswith('http://'):
+                urls.append(url)
+    return urls
+
+def issuer_hashes(issuer_cert):
+    '''
+    Returns SHA-1 hashes of name and public key of the issuer used
+    in CertID.
+    '''
+    tbs = _get_tbs_certificate(issuer_cert)
+    name_hash = hashlib.sha1(encoder.encode(tbs.getComponentByName('subject')))
+    key = tbs.getComponentByName('subjectPublicKeyInfo').\
+              getComponentByName('subjectPublicKey').toOctets()
+    return name_hash.digest(), hashlib.sha1(key).digest()
+
+def make_cert_id(issuer_cert, serial_number, hashes=None):
+    '''
+    Returns CertID of certificate with serial_number issued by
+    issuer_cert. hashes of the issuer may be passed when they are known.
+    '''
+    if hashes is None:
+        hashes = issuer_hashes(issuer_cert)
+    algorithm = AlgorithmIdentifier()
+    algorithm.setComponentByName('algorithm', univ.ObjectIdentifier(SHA1_OID))
+    algorithm.setComponentByName('parameters', univ.Null(''))
+    cert_id = CertID()
+    cert_id.setComponentByName('hashAlgorithm', algorithm)
+    cert_id.setComponentByName('issuerNameHash', hashes[0])
+    cert_id.setComponentByName('issuerKeyHash', hashes[1])
+    cert_id.setComponentByName('serialNumber', serial_number)
+    return cert_id
+
+def _cert_id_key(cert_id):
+    return (str(cert_id.getComponentByName('hashAlgorithm')),
+            str(cert_id.getComponentByName('issuerNameHash')),
+            str(cert_id.getComponentByName('issuerKeyHash')),
+            int(cert_id.getComponentByName('serialNumber')))
+
+def encode_request(cert_id):
+    '''
+    Returns DER encoded OCSP request for certificate cert_id.
+    '''
+    request = Request()
+    request.setComponentByName('reqCert', cert_id)
+    request_list = RequestList()
+    request_list.setComponentByPosition(0, request)
+    tbs_request = TBSRequest()
+    tbs_request.setComponentByName('requestList', request_list)
+    ocsp_request = OCSPRequest()
+    ocsp_request.setComponentByName('tbsRequest', tbs_request)
+    return encoder.encode(ocsp_request)
+
+def _signed_by(certificate, issuer_cert):
+    '''
+    Checks signature of certificate made by issuer_cert.
+    '''
+    tbs_encoded = encoder.encode(_get_tbs_certificate(certificate))
+    sig_alg = str(certificate.getComponentByName('signatureAlgorithm'))
+    digest = calculate_digest(tbs_encoded,
+                              crl_verifier.get_digest_algorithm(sig_alg))
+    signature = certificate.getComponentByName('signatureValue').toOctets()
+    return crl_verifier.verify_digest(digest, signature, issuer_cert)
+
+def _authorized_responder(certificate, issuer_cert):
+    '''
+    Checks that certificate of delegated responder was issued by the CA
+    for signing of OCSP responses and that it is valid now.
+    '''
+    value = get_extension_value(certificate, EXTENDED_KEY_USAGE_EXT_ID)
+    if value is None:
+        return False
+    purposes = [tuple_to_OID(purpose) for purpose in
+                decoder.decode(value, asn1Spec=KeyPurposes())[0]]
+    if OCSP_SIGNING_KEY_PURPOSE_ID not in purposes:
+        return False
+    validity = _get_tbs_certificate(certificate).getComponentByName('validity')
+    not_before = validity.getComponentByName('notBefore').getComponent()._value
+    not_after = validity.getComponentByName('notAfter').getComponent()._value
+    now = timeutil.to_seconds_from_epoch()
+    if not (timeutil.to_seconds_from_epoch(not_before) <= now <=
+            timeutil.to_seconds_from_epoch(not_after)):
+        return False
+    try:
+        return _signed_by(certificate, issuer_cert)
+    except Exception, ex:
+        logger.warning("Verification of responder certificate failed: %s" % ex)
+        return False
+
+def _is_responder(responder_id, certificate):
+    '''
+    Checks if ResponderID identifies the certificate.
+    '''
+    tbs = _get_tbs_certificate(certificate)
+    if responder_id.getName() == 'byName':
+        subject = str(tbs.getComponentByName('subject'))
+        return issuer_key(str(responder_id.getComponent())) == \
+               issuer_key(subject)
+    key = tbs.getComponentByName('subjectPublicKeyInfo').\
+              getComponentByName('subjectPublicKey').toOctets()
+    return str(responder_id.getComponent()) == hashlib.sha1(key).digest()
+
+def verify_response(basic_response, response_der, issuer_cert):
+    '''
+    Checks signature of BasicOCSPResponse. It has to be signed by
+    the issuer itself or by responder authorized by the issuer.
+    '''
+    tbs_encoded = crl_verifier.get_tbs_bytes(response_der)
+    sig_alg = str(basic_response.getComponentByName('signatureAlgorithm'))
+    digest = calculate_digest(tbs_encoded,
+                              crl_verifier.get_digest_algorithm(sig_alg))
+    signature = basic_response.getComponentByName('signature').toOctets()
+    responder_id = basic_response.getComponentByName('tbsResponseData').\
+                        getComponentByName('responderID')
+    if _is_responder(responder_id, issuer_cert):
+        return crl_verifier.verify_digest(digest, signature, issuer_cert)
+    certs = basic_response.getComponentByName('certs')
+    for certificate in certs or ():
+        if _is_responder(responder_id, certificate) and \
+           crl_verifier.verify_digest(digest, signature, certificate) and \
+           _authorized_responder(certificate, issuer_cert):
+            return True
+    return False
+
+
+class OCSP_status():
+    '''
+    Verified status of one certificate. Times are seconds since
+    the epoch, next_update is None when the responder does not say
+    when newer information will be available.
+    '''
+
+    def __init__(self, status, this_update, next_update=None,
+                 revocation_time=None):
+        self.status = status
+        self.this_update = this_update
+        self.next_update = next_update
+        self.revocation_time = revocation_time
+
+    def is_valid(self, now=None):
+        if self.next_update is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now < self.next_update
+
+
+class OCSP_cache():
+    '''
+    Cache of OCSP responses, keyed by CertID. Responses are used until
+    their nextUpdate.
+    '''
+
+    def __init__(self, size=OCSP_CACHE_SIZE):
+        self.size = size
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+    def get(self, cert_id):
+        status = self._statuses.get(_cert_id_key(cert_id))
+        if status is not None and status.is_valid():
+            return status
+        return None
+
+    def put(self, cert_id, status):
+        if not status.is_valid():
+            return
+        self._lock.acquire()
+        try:
+            if len(self._statuses) >= self.size:
+                self.__purge()
+            self._statuses[_cert_id_key(cert_id)] = status
+        finally:
+            self._lock.release()
+
+    def __purge(self):
+        now = time.time()
+        for key, status in self._statuses.items():
+            if not status.is_valid(now):
+                del self._statuses[key]
+        if len(self._statuses) >= self.size:
+            self._statuses.clear()
+
+    def __len__(self):
+        return len(self._statuses)
+
+
+class OCSP_client():
+    '''
+    Asks OCSP responders for status of certificates.
+    '''
+
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = OCSP_cache()
+        self.cache = cache
+        # id of issuer certificate -> (certificate, its hashes)
+        self._issuers = {}
+
+    def __issuer_hashes(self, issuer_cert):
+        entry = self._issuers.get(id(issuer_cert))
+        if entry is None or entry[0] is not issuer_cert:
+            entry = (issuer_cert, issuer_hashes(issuer_cert))
+            self._issuers[id(issuer_cert)] = entry
+        return entry[1]
+
+    def check_certificate(self, certificate, issuer_cert, urls=None):
+        '''
+        Returns OCSP_status of certificate issued by issuer_cert or None,
+        if no responder (urls, by default taken from the certificate)
+        gave a valid answer.
+        '''
+        serial_number = _get_tbs_certificate(certificate).\
+                             getComponentByName('serialNumber')._value
+        cert_id = make_cert_id(issuer_cert, serial_number,
+                               self.__issuer_hashes(issuer_cert))
+        status = self.cache.get(cert_id)
+        if status is not None:
+            logger.debug("OCSP status of %s taken from cache" % serial_number)
+            return status
+        if urls is None:
+            urls = get_ocsp_urls(certificate)
+        for url in urls:
+            status = self.query(url, cert_id, issuer_cert)
+            if status is not None:
+                self.cache.put(cert_id, status)
+                return status
+        return None
+
+    def query(self, url, cert_id, issuer_cert):
+        '''
+        Sends request for cert_id to responder at url and returns verified
+        OCSP_status or None.
+        '''
+        data = self.__post(url, encode_request(cert_id))
+        if data is None:
+            return None
+        try:
+            return self.__read_response(data, cert_id, issuer_cert)
+        except Exception, ex:
+            logger.warning("Bad OCSP response from %s: %s" % (url, ex))
+            return None
+
+    def __post(self, url, request_der):
+        # shared urlopener using proxy settings
+        from dslib.network import ProxyManager
+        opener = ProxyManager.get_opener()
+        request = urllib2.Request(url, request_der,
+                                  {'Content-Type': OCSP_REQUEST_TYPE})
+        try:
+            f = opener.open(request, timeout=OCSP_TIMEOUT)
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except Exception, ex:
+            logger.warning("OCSP request to %s failed: %s" % (url, ex))
+            return None
+
+    def __read_response(self, data, cert_id, issuer_cert):
+        response = decoder.decode(data, asn1Spec=OCSPResponse())[0]
+        response_status = int(response.getComponentByName('responseStatus'))
+        if response_status != 0:
+            logger.warning("OCSP responder refused the request (%d)" % \
+                           response_status)
+            return None
+        response_bytes = response.getComponentByName('responseBytes')
+        response_type = tuple_to_OID(response_bytes.\
+                                     getComponentByName('responseType'))
+        if response_type != OCSP_BASIC_RESPONSE_ID:
+            logger.warning("Unknown OCSP response type %s" % response_type)
+            return None
+        response_der = str(response_bytes.getComponentByName('response'))
+        basic_response = decoder.decode(response_der,
+                                        asn1Spec=BasicOCSPResponse())[0]
+        if not verify_response(basic_response, response_der, issuer_cert):
+            logger.warning("Verification of OCSP response failed")
+            return None
+        now = time.time()
+        data = basic_response.getComponentByName('tbsResponseData')
+        for single in data.getComponentByName('responses'):
+            if _cert_id_key(single.getComponentByName('certID')) != \
+               _cert_id_key(cert_id):
+                continue
+            this_update = _generalized_to_seconds(
+                                    single.getComponentByName('thisUpdate'))
+            next_update = single.getComponentByName('nextUpdate')
+            if next_update is not None:
+                next_update = _generalized_to_seconds(next_update)
+            if this_update > now + CLOCK_SKEW or \
+               (next_update is not None and next_update < now - CLOCK_SKEW):
+                logger.warning("OCSP response is not current")
+                return None
+            if next_update is None and \
+               this_update < now - props.OCSP_MAX_AGE - CLOCK_SKEW:
+                logger.warning("OCSP response without nextUpdate is too old")
+                return OCSP_status(UNKNOWN, this_update)
+            cert_status = single.getComponentByName('certStatus')
+            name = cert_status.getName()
+            if name == 'good':
+                return OCSP_status(GOOD, this_update, next_update)
+            if name == 'revoked':
+                revocation_time = cert_status.getComponent().\
+                                      getComponentByName('revocationTime')
+                return OCSP_status(REVOKED, this_update, next_update,
+                                   str(revocation_time))
+            return OCSP_status(UNKNOWN, this_update, next_update)
+        logger.warning("OCSP response does not contain the certificate")
+        return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    '''
+    Returns application wide OCSP client.
+    '''
+    global _client
+    if _client is None:
+        _client_lock.acquire()
+        try:
+            if _client is None:
+                _client = OCSP_client()
+        finally:
+            _client_lock.release()
+    return _client
@@ -0,0 +1,231 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of the OCSP client against a local responder - good, revoked
+and unknown certificates, forged responses, delegated responders and
+responses without nextUpdate. Run with python -m dslib.certs.ocsp_test
+'''
+
+# standard library imports
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+
+# dslib imports
+from pyasn1.codec.der import encoder, decoder
+from pyasn1.type import univ
+from dslib.pkcs7.asn1_models.X509_certificate import Certificate
+from dslib.pkcs7.asn1_models.ocsp import *
+from dslib.properties.properties import Properties as props
+
+# local imports
+import ocsp_client
+from crl_generator import Test_CA, SIGNATURE_ALGORITHM, _der, _der_seq, \
+                          _der_extension
+
+GOOD_SERIAL = 10
+REVOKED_SERIAL = 77
+UNKNOWN_SERIAL = 99
+
+
+def _oid(dotted):
+    '''
+    Returns content octets of the OID.
+    '''
+    return encoder.encode(univ.ObjectIdentifier(dotted))[2:]
+
+def _generalized_time(seconds):
+    return _der(0x18, time.strftime('%Y%m%d%H%M%SZ', time.gmtime(seconds)))
+
+def _decode_certificate(der_data):
+    return decoder.decode(der_data, asn1Spec=Certificate())[0]
+
+
+class _OCSP_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(self.headers['Content-Type'])
+        response = self.server.respond(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/ocsp-response')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class OCSP_responder(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Answers OCSP requests for certificates of the CA. The response is
+    signed by signer (the CA or a delegated responder, whose certificate
+    is sent with the response when signer_cert is set). this_update and
+    next_update are seconds relative to now, next_update may be None.
+    '''
+    daemon_threads = True
+
+    def __init__(self, ca):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _OCSP_handler)
+        self.ca = ca
+        self.signer = ca
+        self.signer_cert = None
+        self.known = set([GOOD_SERIAL, REVOKED_SERIAL])
+        self.revoked = set([REVOKED_SERIAL])
+        self.this_update = -10
+        self.next_update = 600
+        self.requests = []
+
+    def url(self):
+        return 'http://127.0.0.1:%d/ocsp' % self.server_address[1]
+
+    def respond(self, body):
+        request = decoder.decode(body, asn1Spec=OCSPRequest())[0]
+        cert_id = request.getComponentByName('tbsRequest').\
+                      getComponentByName('requestList')[0].\
+                      getComponentByName('reqCert')
+        serial = int(cert_id.getComponentByName('serialNumber'))
+        now = int(time.time())
+        if serial in self.revoked:
+            status = _der(0xa1, _generalized_time(now - 3600))
+        elif serial in self.known:
+            status = _der(0x80, '')
+        else:
+            status = _der(0x82, '')
+        single = encoder.encode(cert_id) + status + \
+                 _generalized_time(now + self.this_update)
+        if self.next_update is not None:
+            single += _der(0xa0, _generalized_time(now + self.next_update))
+        data = _der_seq(_der(0xa1, self.signer.name), _generalized_time(now),
+                        _der_seq(_der_seq(single)))
+        basic = data + SIGNATURE_ALGORITHM + \
+                _der(0x03, '\x00' + self.signer.sign(data))
+        if self.signer_cert is not None:
+            basic += _der(0xa0, _der_seq(self.signer_cert))
+        response_bytes = _der_seq(_der(0x06, _oid(OCSP_BASIC_RESPONSE_ID)),
+                                  _der(0x04, _der_seq(basic)))
+        return _der_seq('\x0a\x01\x00', _der(0xa0, response_bytes))
+
+
+class OCSP_client_test(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(OCSP_client_test, 'ca'):
+            OCSP_client_test.ca = Test_CA(bits=1024, seed=1)
+            OCSP_client_test.responder = Test_CA('Responder', bits=1024,
+                                                 seed=2)
+        self.ca_cert = self.ca.certificate()
+        self.server = OCSP_responder(self.ca)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = ocsp_client.OCSP_client()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def certificate(self, serial):
+        access = _der_seq(_der(0x06, _oid(OCSP_ACCESS_METHOD_ID)),
+                          _der(0x86, self.server.url()))
+        extension = _der_extension(_oid(AUTHORITY_INFO_ACCESS_EXT_ID),
+                                   _der_seq(access))
+        return _decode_certificate(self.ca.issue_certificate(serial, 'Leaf',
+                                                             extensions=extension))
+
+    def delegate(self, purposes):
+        extensions = ''
+        if purposes:
+            extensions = _der_extension(_oid(EXTENDED_KEY_USAGE_EXT_ID),
+                                        _der_seq(*[_der(0x06, _oid(purpose))
+                                                   for purpose in purposes]))
+        self.server.signer = self.responder
+        self.server.signer_cert = self.ca.issue_certificate(5, 'Responder',
+                                  (self.responder.modulus,
+                                   self.responder.exponent), extensions)
+
+    def check(self, serial):
+        return self.client.check_certificate(self.certificate(serial),
+                                             self.ca_cert)
+
+    def test_urls(self):
+        self.assertEqual(ocsp_client.get_ocsp_urls(self.certificate(1)),
+                         [self.server.url()])
+
+    def test_good(self):
+        status = self.check(GOOD_SERIAL)
+        self.assertEqual(status.status, ocsp_client.GOOD)
+        self.assertEqual(self.server.requests,
+                         [ocsp_client.OCSP_REQUEST_TYPE])
+        # the response is cached until its nextUpdate
+        self.assertEqual(self.check(GOOD_SERIAL).status, ocsp_client.GOOD)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_revoked(self):
+        status = self.check(REVOKED_SERIAL)
+        self.assertEqual(status.status, ocsp_client.REVOKED)
+        self.assert_(status.revocation_time)
+
+    def test_unknown(self):
+        self.assertEqual(self.check(UNKNOWN_SERIAL).status,
+                         ocsp_client.UNKNOWN)
+
+    def test_bad_signature(self):
+        # signed by a key the CA did not authorize
+        self.server.signer = self.responder
+        self.assertEqual(self.check(GOOD_SERIAL), None)
+
+    def test_delegated_responder(self):
+        self.delegate([OCSP_SIGNING_KEY_PURPOSE_ID])
+        self.assertEqual(self.check(REVOKED_SERIAL).status,
+                         ocsp_client.REVOKED)
+
+    def test_delegated_responder_without_eku(self):
+        self.delegate([])
+        self.assertEqual(self.check(GOOD_SERIAL), None)
+        # other purposes do not authorize the responder either
+        self.delegate(['1.3.6.1.5.5.7.3.2'])
+        self.assertEqual(self.check(GOOD_SERIAL), None)
+
+    def test_without_next_update(self):
+        self.server.next_update = None
+        self.assertEqual(self.check(GOOD_SERIAL).status, ocsp_client.GOOD)
+        # such responses are not cached
+        self.check(GOOD_SERIAL)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_old_response_without_next_update(self):
+        # e.g. a replayed response, it must not hide the revocation
+        self.server.next_update = None
+        self.server.this_update = -2 * props.OCSP_MAX_AGE
+        self.assertEqual(self.check(GOOD_SERIAL).status, ocsp_client.UNKNOWN)
+        self.server.this_update = -props.OCSP_MAX_AGE / 2
+        self.assertEqual(self.check(GOOD_SERIAL).status, ocsp_client.GOOD)
+
+    def test_expired_response(self):
+        self.server.this_update = -7200
+        self.server.next_update = -3600
+        self.assertEqual(self.check(GOOD_SERIAL), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
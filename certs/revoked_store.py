@@ -0,0 +1,514 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Compact storage of revoked certificates serial numbers.
+Serial numbers are kept sorted as fixed width big endian records in one
+string, revocation dates are packed separately as little endian signed
+64 bit seconds from epoch.
+Both buffers may also be read only views into a memory mapped file.
+Small stores are looked up in a dictionary. In larger ones a serial
+number is first checked in a filter of hashes of the stored serial
+numbers, so that most of the serial numbers which are not revoked are
+not searched for at all, the rest is searched for in its block found
+through an index of the first records of blocks.
+Many serial numbers are looked up at once by get_many, with the per
+serial work done by map and list comprehensions (the filter is used
+for large batches).
+'''
+
+# standard library imports
+import sys
+import calendar
+import time
+import struct
+import bisect
+import binascii
+from itertools import izip, repeat
+from operator import and_
+
+# revocation dates are stored as signed 64 bit seconds from epoch
+# (stores of older versions used unsigned 32 bit, see _widen_dates)
+DATE = struct.Struct('<q')
+DATE_SIZE = DATE.size
+_OLD_DATE_SIZE = 4
+UTC_TIME_FORMAT = '%y%m%d%H%M%SZ'
+GENERALIZED_TIME_FORMAT = '%Y%m%d%H%M%SZ'
+
+# number of records in a block of the index used by get_many
+BLOCK_SIZE = 32
+# stores with at most this many records are looked up in a dictionary
+# (about 100 bytes per record) instead of by binary search
+DICT_MAX_RECORDS = 4096
+# number of records split by one struct call
+_SPLIT_CHUNK = 1024
+# bytes of the membership filter per record (8 - 16 after rounding up
+# to a power of two, about 12 % of serial numbers pass it needlessly)
+FILTER_BYTES = 8
+# get_many uses the membership filter for at least this many serials
+FILTER_MIN_QUERIES = 256
+
+
+def _pack_date(date):
+  '''
+  Converts UTCTime or GeneralizedTime string into seconds from epoch.
+  Unknown dates are stored as 0.
+  '''
+  try:
+    if len(date) == 13:
+      year = int(date[0:2])
+      # RFC 5280 - UTCTime years 50 - 99 mean 19xx
+      if year >= 50:
+        year += 1900
+      else:
+        year += 2000
+      rest = date[2:12]
+    else:
+      year = int(date[0:4])
+      rest = date[4:14]
+    return calendar.timegm((year, int(rest[0:2]), int(rest[2:4]),
+                            int(rest[4:6]), int(rest[6:8]), int(rest[8:10])))
+  except (ValueError, TypeError):
+    return 0
+
+def _unpack_date(seconds):
+  '''
+  Converts seconds from epoch back into UTCTime string
+  (GeneralizedTime outside years 1950 - 2049).
+  '''
+  if not seconds:
+    return ''
+  t = time.gmtime(seconds)
+  if not 1950 <= t.tm_year < 2050:
+    return time.strftime(GENERALIZED_TIME_FORMAT, t)
+  return time.strftime(UTC_TIME_FORMAT, t)
+
+def _widen_dates(dates, count):
+  '''
+  Converts dates packed by older versions (unsigned 32 bit) to DATE.
+  '''
+  old = struct.unpack_from('<%dI' % count, dates)
+  return struct.pack('<%dq' % count, *old)
+
+def _byte_len(number):
+  return (len('%x' % number) + 1) // 2
+
+def _to_record(number, width):
+  return binascii.unhexlify('%0*x' % (2 * width, number))
+
+def _split_records(buf, width, count):
+  '''
+  Splits count records of width bytes from buf into list of strings.
+  '''
+  records = []
+  chunk = struct.Struct('%ds' % width * _SPLIT_CHUNK)
+  chunk_len = width * _SPLIT_CHUNK
+  full = count // _SPLIT_CHUNK
+  for i in xrange(full):
+    records.extend(chunk.unpack_from(buf, i * chunk_len))
+  rest = count - full * _SPLIT_CHUNK
+  if rest:
+    records.extend(struct.unpack_from('%ds' % width * rest, buf,
+                                      full * chunk_len))
+  return records
+
+def _to_records(numbers, width):
+  '''
+  Converts numbers to records of width bytes, numbers which do not fit
+  (or are negative) are converted to None.
+  '''
+  fmt = '%%0%dx' % (2 * width)
+  limit = 1 << (8 * width)
+  if not numbers:
+    return []
+  if min(numbers) >= 0 and max(numbers) < limit:
+    packed = binascii.unhexlify(''.join([fmt % sn for sn in numbers]))
+    return _split_records(packed, width, len(numbers))
+  return [_to_record(sn, width) if 0 <= sn < limit else None
+          for sn in numbers]
+
+
+class Revoked_store(object):
+  '''
+  Set of revoked certificates - serial numbers mapped to revocation dates.
+  Provides dict-like get, membership test, len and iteration over
+  (serial number, revocation date) pairs.
+  Changes build new buffers which replace the old ones at once,
+  so readers always see consistent data.
+  '''
+
+  def __init__(self, revoked=None):
+    # (serials, dates, count, width)
+    self._data = ('', '', 0, 0)
+    # (data, first records of blocks) - see _block_index
+    self._blocks = None
+    # (data, filter, mask) - see _membership_filter
+    self._filter = None
+    # (data, serial number -> date) of small stores - see _small_dict
+    self._dict = None
+    if revoked:
+      self.add_many(revoked)
+
+  @classmethod
+  def from_buffers(cls, serials, dates, count, width):
+    '''
+    Creates store over existing buffers (strings or buffers
+    into a memory mapped file) without copying them.
+    '''
+    store = cls()
+    store._data = (serials, dates, count, width)
+    return store
+
+  def get_buffers(self):
+    '''
+    Returns tuple (serials, dates, count, width) with packed data.
+    '''
+    return self._data
+
+  def __len__(self):
+    return self._data[2]
+
+  def __contains__(self, serial):
+    data = self._data
+    if data[2] <= DICT_MAX_RECORDS:
+      return serial in self._small_dict(data)
+    return self._maybe_stored(serial, data) and self._find(serial, data) >= 0
+
+  def __iter__(self):
+    return self._iter_data(self._data)
+
+  def _iter_data(self, data):
+    serials, dates, count, width = data
+    for i in xrange(count):
+      record = serials[i*width:(i+1)*width]
+      yield int(record.encode('hex'), 16), \
+            _unpack_date(DATE.unpack_from(dates, i*DATE_SIZE)[0])
+
+  def __sizeof__(self):
+    serials, dates, count, width = self._data
+    size = object.__sizeof__(self) + sys.getsizeof(serials) + \
+           sys.getsizeof(dates)
+    # lookup structures of the current data
+    if self._blocks is not None and self._blocks[0] is self._data:
+      size += sys.getsizeof(self._blocks[1]) + \
+              sum(map(sys.getsizeof, self._blocks[1]))
+    if self._filter is not None and self._filter[0] is self._data:
+      size += sys.getsizeof(self._filter[1])
+    return size
+
+  def _bisect(self, record, data):
+    '''
+    Returns index where the record is or would be inserted.
+    '''
+    serials, dates, count, width = data
+    lo, hi = 0, count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = mid * width
+      if serials[start:start+width] < record:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _find(self, serial, data):
+    '''
+    Returns index of serial number in data or -1.
+    '''
+    width = data[3]
+    if serial < 0 or _byte_len(serial) > width:
+      return -1
+    record = _to_record(serial, width)
+    if data[2] <= BLOCK_SIZE:
+      idx = self._bisect(record, data)
+      start = idx * width
+      if idx < data[2] and data[0][start:start+width] == record:
+        return idx
+      return -1
+    # the same as _find_records for one record
+    step = BLOCK_SIZE * width
+    num = bisect.bisect_right(self._block_index(data), record)
+    if not num:
+      return -1
+    start = (num - 1) * step
+    block = data[0][start:start+step]
+    pos = block.find(record)
+    while pos > 0 and pos % width:
+      pos = block.find(record, pos + 1)
+    if pos < 0:
+      return -1
+    return (start + pos) // width
+
+  def _maybe_stored(self, serial, data):
+    '''
+    Returns False if serial number is surely not stored (see
+    _membership_filter).
+    '''
+    marks, mask = self._membership_filter(data)
+    return marks[hash(serial) & mask] != 0
+
+  def get(self, serial, default=None):
+    '''
+    Returns revocation date of serial number or default.
+    '''
+    data = self._data
+    if data[2] <= DICT_MAX_RECORDS:
+      return self._small_dict(data).get(serial, default)
+    if not self._maybe_stored(serial, data):
+      return default
+    idx = self._find(serial, data)
+    if idx < 0:
+      return default
+    return _unpack_date(DATE.unpack_from(data[1], idx*DATE_SIZE)[0])
+
+  def _small_dict(self, data):
+    '''
+    Returns dictionary serial number -> revocation date of small store,
+    kept until the data change.
+    '''
+    cached = self._dict
+    if cached is not None and cached[0] is data:
+      return cached[1]
+    self._dict = (data, dict(self._iter_data(data)))
+    return self._dict[1]
+
+  def get_many(self, serials):
+    '''
+    Returns list of revocation dates (or None) of serial numbers in
+    the same order. Faster than calling get for each of them.
+    '''
+    data = self._data
+    if not data[2]:
+      return [None] * len(serials)
+    if len(serials) < FILTER_MIN_QUERIES:
+      return self._get_many(serials, data)
+    marks, mask = self._membership_filter(data)
+    flags = map(marks.__getitem__,
+                map(and_, map(hash, serials), repeat(mask, len(serials))))
+    candidates = [pos for pos, flag in enumerate(flags) if flag]
+    result = [None] * len(serials)
+    for pos, date in izip(candidates,
+                          self._get_many(map(serials.__getitem__, candidates),
+                                         data)):
+      result[pos] = date
+    return result
+
+  def _get_many(self, serials, data):
+    buf, dates, count, width = data
+    if not serials:
+      return []
+    records = _to_records(serials, width)
+    indexes = self._find_records(records, data)
+    result = [None] * len(records)
+    seen = {}
+    for pos in [pos for pos, idx in enumerate(indexes) if idx >= 0]:
+      seconds = DATE.unpack_from(dates, indexes[pos]*DATE_SIZE)[0]
+      date = seen.get(seconds)
+      if date is None:
+        date = seen[seconds] = _unpack_date(seconds)
+      result[pos] = date
+    return result
+
+  def _block_index(self, data):
+    '''
+    Returns list of the first records of blocks of BLOCK_SIZE records,
+    kept until the data change.
+    '''
+    blocks = self._blocks
+    if blocks is not None and blocks[0] is data:
+      return blocks[1]
+    buf, dates, count, width = data
+    step = BLOCK_SIZE * width
+    first = [buf[i:i+width] for i in xrange(0, count * width, step)]
+    self._blocks = (data, first)
+    return first
+
+  def _membership_filter(self, data):
+    '''
+    Returns (filter, mask) - bytearray with 1 at hash(serial) & mask of
+    every stored serial number, serial numbers with 0 are not stored.
+    It is built from the records (about 1 us per record) and kept until
+    the data change.
+    '''
+    cached = self._filter
+    if cached is not None and cached[0] is data:
+      return cached[1], cached[2]
+    buf, dates, count, width = data
+    size = 1
+    while size < FILTER_BYTES * count:
+      size <<= 1
+    mask = size - 1
+    marks = bytearray(size)
+    chunk_len = _SPLIT_CHUNK * width
+    for start in xrange(0, count * width, chunk_len):
+      chunk = binascii.hexlify(buf[start:start+chunk_len])
+      numbers = len(chunk) // (2 * width)
+      serials = map(int, _split_records(chunk, 2 * width, numbers),
+                    repeat(16, numbers))
+      for pos in map(and_, map(hash, serials), repeat(mask, numbers)):
+        marks[pos] = 1
+    self._filter = (data, marks, mask)
+    return marks, mask
+
+  def _find_records(self, records, data):
+    '''
+    Returns indexes of records in data (-1 for missing ones). Each record
+    is searched for in its block found by bisection of the block index.
+    '''
+    buf, dates, count, width = data
+    step = BLOCK_SIZE * width
+    first = self._block_index(data)
+    block_nums = map(bisect.bisect_right, repeat(first, len(records)),
+                     records)
+    starts = [(num - 1) * step for num in block_nums]
+    blocks = [buf[start:start+step] if start >= 0 else ''
+              for start in starts]
+    found = map(str.find, blocks, [record or '\x00' for record in records])
+    indexes = [-1 if pos < 0 else -2 if pos % width else (start + pos) // width
+               for start, pos in izip(starts, found)]
+    # the record may also be found across boundary of two records
+    for i in [i for i, idx in enumerate(indexes) if idx == -2]:
+      pos = found[i]
+      while pos > 0 and pos % width:
+        pos = blocks[i].find(records[i], pos + 1)
+      indexes[i] = -1 if pos < 0 else (starts[i] + pos) // width
+    return indexes
+
+  def _widened(self, data, width):
+    '''
+    Returns data with records padded to the new width.
+    '''
+    serials, dates, count, old_width = data
+    pad = '\x00' * (width - old_width)
+    serials = ''.join([pad + serials[i*old_width:(i+1)*old_width]
+                       for i in xrange(count)])
+    return serials, dates, count, width
+
+  def add_many(self, revoked, added=None):
+    '''
+    Adds revoked certificates from iterable of (serial number, date) pairs.
+    If list added is given, newly added pairs are appended to it.
+    Returns number of added certificates.
+    '''
+    data = self._data
+    if not data[2] and isinstance(revoked, Revoked_store):
+      # empty store takes the (sorted) records as they are
+      self._data = revoked.get_buffers()
+      if added is not None:
+        added.extend(revoked)
+      return len(revoked)
+    new = {}
+    for sn, date in revoked:
+      if sn < 0:
+        continue
+      if sn not in new and self._find(sn, data) < 0:
+        new[sn] = date
+    if not new:
+      return 0
+    if added is not None:
+      added.extend(new.iteritems())
+    width = max(_byte_len(sn) for sn in new)
+    if width > data[3]:
+      data = self._widened(data, width)
+    serials, dates, count, width = data
+    serial_parts = []
+    date_parts = []
+    prev = 0
+    for sn in sorted(new):
+      record = _to_record(sn, width)
+      idx = self._bisect(record, data)
+      serial_parts.append(serials[prev*width:idx*width])
+      serial_parts.append(record)
+      date_parts.append(dates[prev*DATE_SIZE:idx*DATE_SIZE])
+      date_parts.append(DATE.pack(_pack_date(new[sn])))
+      prev = idx
+    serial_parts.append(serials[prev*width:count*width])
+    date_parts.append(dates[prev*DATE_SIZE:count*DATE_SIZE])
+    self._data = (''.join(serial_parts), ''.join(date_parts),
+                  count + len(new), width)
+    return len(new)
+
+  def difference(self, other):
+    '''
+    Returns store with the records whose serial numbers are not in store
+    other (self, if there are none). Records are compared packed,
+    without converting them to numbers.
+    '''
+    data = self._data
+    other_data = other.get_buffers()
+    if not data[2] or not other_data[2]:
+      return self
+    width = max(data[3], other_data[3])
+    if other_data[3] < width:
+      other_data = self._widened(other_data, width)
+    compared = data
+    if data[3] < width:
+      compared = self._widened(data, width)
+    known = set(_split_records(other_data[0], width, other_data[2]))
+    records = _split_records(compared[0], width, data[2])
+    keep = [i for i, record in enumerate(records) if record not in known]
+    if len(keep) == data[2]:
+      return self
+    serials, dates, count, width = data
+    return Revoked_store.from_buffers(
+                    ''.join([serials[i*width:(i+1)*width] for i in keep]),
+                    ''.join([dates[i*DATE_SIZE:(i+1)*DATE_SIZE] for i in keep]),
+                    len(keep), width)
+
+  def discard_many(self, serials, removed=None):
+    '''
+    Removes serial numbers from the store. If list removed is given,
+    removed serial numbers are appended to it.
+    Returns number of removed certificates.
+    '''
+    data = self._data
+    indexes = {}
+    for sn in serials:
+      idx = self._find(sn, data)
+      if idx >= 0:
+        indexes[idx] = sn
+    if not indexes:
+      return 0
+    if removed is not None:
+      removed.extend(indexes.itervalues())
+    serials, dates, count, width = data
+    serial_parts = []
+    date_parts = []
+    prev = 0
+    for idx in sorted(indexes):
+      serial_parts.append(serials[prev*width:idx*width])
+      date_parts.append(dates[prev*DATE_SIZE:idx*DATE_SIZE])
+      prev = idx + 1
+    serial_parts.append(serials[prev*width:count*width])
+    date_parts.append(dates[prev*DATE_SIZE:count*DATE_SIZE])
+    self._data = (''.join(serial_parts), ''.join(date_parts),
+                  count - len(indexes), width)
+    return len(indexes)
+
+  def __getstate__(self):
+    serials, dates, count, width = self._data
+    return {'serials': str(serials), 'dates': str(dates),
+            'count': count, 'width': width, 'date_size': DATE_SIZE}
+
+  def __setstate__(self, state):
+    dates = state['dates']
+    if state.get('date_size', _OLD_DATE_SIZE) != DATE_SIZE:
+      dates = _widen_dates(dates, state['count'])
+    self._data = (state['serials'], dates, state['count'], state['width'])
+    self._blocks = None
+    self._filter = None
+    self._dict = None
@@ -0,0 +1,138 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of Revoked_store against a plain dictionary - lookups of single
+and many serial numbers in small stores (dictionary) and large ones
+(block index, membership filter), serial numbers of different widths,
+missing serial numbers and unknown revocation dates.
+Run with python -m dslib.certs.revoked_store_test
+'''
+
+# standard library imports
+import random
+import unittest
+
+# local imports
+from revoked_store import Revoked_store, DICT_MAX_RECORDS, \
+                          FILTER_MIN_QUERIES, BLOCK_SIZE
+
+DATES = ['120101000000Z', '491231235959Z', '19491231235959Z',
+         '21070101000000Z', '']
+
+
+class Revoked_store_test(unittest.TestCase):
+
+    def make(self, count, bits, seed=1):
+        '''
+        Returns store and dictionary with the same count serial numbers
+        of up to bits bits.
+        '''
+        rnd = random.Random(seed)
+        expected = {}
+        while len(expected) < count:
+            expected[rnd.getrandbits(bits)] = rnd.choice(DATES)
+        return Revoked_store(expected.iteritems()), expected
+
+    def queries(self, expected, count, bits, seed=2):
+        '''
+        Returns stored and missing serial numbers (also neighbours of the
+        stored ones, wider ones and negative ones).
+        '''
+        rnd = random.Random(seed)
+        stored = sorted(expected)
+        serials = [rnd.choice(stored) for i in xrange(count // 2)]
+        serials += [rnd.getrandbits(bits) for i in xrange(count // 4)]
+        serials += [sn + 1 for sn in stored[:count // 8]]
+        serials += [0, -1, -stored[0], 1 << (bits + 9), stored[0],
+                    stored[-1], stored[-1] + 1]
+        rnd.shuffle(serials)
+        return serials
+
+    def check(self, store, expected, serials):
+        reference = [expected.get(sn) for sn in serials]
+        self.assertEqual([store.get(sn) for sn in serials], reference)
+        self.assertEqual([store.get(sn, 'x') for sn in serials],
+                         [expected.get(sn, 'x') for sn in serials])
+        self.assertEqual([sn in store for sn in serials],
+                         [sn in expected for sn in serials])
+        self.assertEqual(store.get_many(serials), reference)
+        # below the size of batch filtered by hashes
+        small = serials[:FILTER_MIN_QUERIES - 1]
+        self.assertEqual(store.get_many(small), reference[:len(small)])
+
+    def check_sizes(self, bits):
+        for count in (1, BLOCK_SIZE + 1, DICT_MAX_RECORDS,
+                      DICT_MAX_RECORDS + 1, 20000):
+            store, expected = self.make(count, bits)
+            self.assertEqual(len(store), len(expected))
+            self.assertEqual(dict(store), expected)
+            self.check(store, expected, self.queries(expected, 2000, bits))
+
+    def test_narrow_serials(self):
+        self.check_sizes(16)
+
+    def test_wide_serials(self):
+        self.check_sizes(128)
+
+    def test_mixed_widths(self):
+        store, expected = self.make(DICT_MAX_RECORDS + 100, 20)
+        wide, wide_expected = self.make(300, 160, seed=3)
+        store.add_many(wide)
+        expected.update(wide_expected)
+        self.check(store, expected, self.queries(expected, 2000, 160) +
+                                    self.queries(expected, 1000, 20))
+
+    def test_changes(self):
+        # lookups do not use indexes of data before the change
+        store, expected = self.make(DICT_MAX_RECORDS + 10, 64)
+        serials = self.queries(expected, 1000, 64)
+        self.check(store, expected, serials)
+        removed = sorted(expected)[::2]
+        self.assertEqual(store.discard_many(removed), len(removed))
+        for sn in removed:
+            del expected[sn]
+        self.check(store, expected, serials)
+        # back to the dictionary
+        self.assert_(len(store) <= DICT_MAX_RECORDS)
+        added = [(sn + 1, '') for sn in removed[:50]]
+        self.assertEqual(store.add_many(added),
+                         len([1 for sn, d in added if sn not in expected]))
+        expected.update(added)
+        self.check(store, expected, serials + [sn for sn, d in added])
+
+    def test_unknown_date(self):
+        for count in (10, DICT_MAX_RECORDS + 10):
+            store = Revoked_store((sn, '') for sn in xrange(count))
+            self.assertEqual(store.get(5), '')
+            self.assert_(5 in store)
+            self.assertEqual(store.get(count), None)
+            serials = range(count - FILTER_MIN_QUERIES, count + 1)
+            self.assertEqual(store.get_many(serials),
+                             ['' if 0 <= sn < count else None
+                              for sn in serials])
+
+    def test_empty(self):
+        store = Revoked_store()
+        self.assertEqual(store.get(1), None)
+        self.failIf(1 in store)
+        self.assertEqual(store.get_many(range(FILTER_MIN_QUERIES)),
+                         [None] * FILTER_MIN_QUERIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,9 @@ databoxes into time structures.
 # standard library imports
 import time
 
+# dslib imports
+from dslib.converters import time_converter
+
 TIME_FORMAT = '%y%m%d%H%M%SZ'
 
 
@@ -37,8 +40,7 @@ def to_time(string_time):
   '''
   Converts time in string from databox to time struct 
   '''
-  res_time = time.strptime(string_time, TIME_FORMAT)
-  return res_time
+  return time_converter.to_struct_time(string_time)
 
 def to_seconds_from_epoch(string_time=None):
   '''
@@ -46,6 +48,12 @@ def to_seconds_from_epoch(string_time=None):
   If parameter is None, returns current time (seconds from epoch)
   '''
   if string_time is None:
-    return time.mktime(now())
-  return time.mktime(to_time(string_time))   
+    return time.time()
+  return time_converter.to_seconds(string_time)
+
+def passed(string_time):
+  '''
+  Checks if time from databox is in the past.
+  '''
+  return time.time() >= time_converter.to_seconds(string_time)
 
@@ -0,0 +1,442 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Store of trusted certificates (trust anchors) indexed by subject,
+subjectKeyIdentifier and authorityKeyIdentifier.
+The directory of trusted certificates can be compiled into a snapshot
+holding all data the store needs, so that processes do not parse the
+certificates at startup:
+python -m dslib.certs.trust_store trusted_certificates [snapshot_file]
+The snapshot is kept in the user cache directory unless its path is given
+(the directory of trusted certificates may be read only).
+'''
+
+# standard library imports
+import os
+import sys
+import marshal
+import hashlib
+import logging
+logger = logging.getLogger("certs.trust_store")
+
+# dslib imports
+from pyasn1.codec.der import decoder, encoder
+from pyasn1 import error
+from dslib.pkcs7.asn1_models.X509_certificate import Certificate
+from dslib.pkcs7.asn1_models.certificate_extensions import KeyId, SubjectKeyId
+from dslib.pkcs7 import verifier
+
+# local imports
+import timeutil
+import cert_loader
+from cert_finder import _get_tbs_certificate, get_extension_value, \
+                        get_validity
+from crl_store import issuer_key
+
+SUBJECT_KEY_ID_EXT_ID = '2.5.29.14'
+AUTHORITY_KEY_ID_EXT_ID = '2.5.29.35'
+
+# name of the snapshot of directory of trusted certificates in the user
+# cache directory (followed by hash of the path of that directory)
+SNAPSHOT_FILE = "trust_snapshot"
+# changed when the format of snapshot changes
+SNAPSHOT_VERSION = 2
+
+
+def get_subject_key_id(certificate):
+    '''
+    Returns subjectKeyIdentifier of the certificate or None.
+    '''
+    value = get_extension_value(certificate, SUBJECT_KEY_ID_EXT_ID)
+    if value is None:
+        return None
+    try:
+        return str(decoder.decode(value, asn1Spec=SubjectKeyId())[0])
+    except error.PyAsn1Error, e:
+        logger.warning("Bad subjectKeyIdentifier: %s" % e)
+        return None
+
+def get_authority_key_id(certificate):
+    '''
+    Returns keyIdentifier from authorityKeyIdentifier of the certificate
+    or None.
+    '''
+    value = get_extension_value(certificate, AUTHORITY_KEY_ID_EXT_ID)
+    if value is None:
+        return None
+    try:
+        key_id = decoder.decode(value, asn1Spec=KeyId())[0].\
+                                    getComponentByName("keyIdentifier")
+    except error.PyAsn1Error, e:
+        logger.warning("Bad authorityKeyIdentifier: %s" % e)
+        return None
+    if key_id is None:
+        return None
+    return str(key_id)
+
+class _Anchor(object):
+    '''
+    Trusted certificate with the data used for lookups. The pyasn1
+    certificate is decoded from der when it is needed first.
+    '''
+    __slots__ = ('der', 'subject', 'ski', 'aki', 'not_before', 'not_after',
+                 'key_material', '_certificate')
+
+    def __init__(self, der, subject, ski, aki, not_before, not_after,
+                 key_material, certificate=None):
+        self.der = der
+        self.subject = subject
+        self.ski = ski
+        self.aki = aki
+        self.not_before = not_before
+        self.not_after = not_after
+        # (algorithm, key material) as from verifier._get_key_material
+        self.key_material = key_material
+        self._certificate = certificate
+
+    @classmethod
+    def from_certificate(cls, certificate, der=None):
+        tbs = _get_tbs_certificate(certificate)
+        not_before, not_after = get_validity(certificate)
+        try:
+            key_material = verifier._get_key_material(certificate)
+        except Exception, e:
+            logger.warning("Key of trusted certificate not extracted: %s" % e)
+            key_material = None
+        return cls(der, issuer_key(str(tbs.getComponentByName("subject"))),
+                   get_subject_key_id(certificate),
+                   get_authority_key_id(certificate), not_before, not_after,
+                   key_material, certificate)
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*record)
+
+    def to_record(self):
+        '''
+        Returns tuple of basic types stored in the snapshot.
+        '''
+        if self.der is None:
+            self.der = encoder.encode(self._certificate)
+        return (self.der, self.subject, self.ski, self.aki, self.not_before,
+                self.not_after, self.key_material)
+
+    def certificate(self):
+        if self._certificate is None:
+            self._certificate = decoder.decode(self.der,
+                                               asn1Spec=Certificate())[0]
+        return self._certificate
+
+    def is_valid_at(self, seconds):
+        return self.not_before is not None and \
+               self.not_before <= seconds <= self.not_after
+
+
+def _file_hash(path):
+    f = open(path, "rb")
+    try:
+        return hashlib.sha256(f.read()).hexdigest()
+    finally:
+        f.close()
+
+def _trusted_files(dirname):
+    '''
+    Returns paths of files with trusted certificates in directory.
+    '''
+    try:
+        names = sorted(os.listdir(dirname))
+    except OSError:
+        return []
+    return [os.path.join(dirname, name) for name in names
+            if name.endswith(cert_loader.PEM_SUFFIX) or
+               name.endswith(cert_loader.CER_SUFFIX)]
+
+def _parse_file(path):
+    '''
+    Returns list of records of certificates in file (PEM file may
+    contain more of them).
+    '''
+    records = []
+    for der in cert_loader.read_certificate_file(path):
+        certificate = cert_loader._decode_certificate(der)
+        if certificate is None:
+            logger.warning("Bad certificate in %s" % path)
+            continue
+        records.append(_Anchor.from_certificate(certificate, der).to_record())
+    if not records:
+        logger.warning("No certificate in %s" % path)
+    return records
+
+def default_snapshot_path(dirname):
+    '''
+    Returns path of the snapshot of directory in the user cache directory
+    ($XDG_CACHE_HOME/dslib or ~/.cache/dslib).
+    '''
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or \
+                os.path.join(os.path.expanduser("~"), ".cache")
+    key = hashlib.sha1(os.path.abspath(dirname)).hexdigest()[:16]
+    return os.path.join(cache_dir, "dslib", "%s-%s" % (SNAPSHOT_FILE, key))
+
+def read_snapshot(path):
+    '''
+    Returns dictionary file content hash -> list of certificate records
+    from snapshot or empty dictionary, if it cannot be used.
+    '''
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return {}
+    try:
+        try:
+            version, records = marshal.load(f)
+        except (EOFError, ValueError, TypeError), e:
+            logger.warning("Snapshot %s is damaged: %s" % (path, e))
+            return {}
+    finally:
+        f.close()
+    if version != SNAPSHOT_VERSION:
+        return {}
+    return records
+
+def write_snapshot(path, records):
+    '''
+    Writes snapshot (file content hash -> list of records) atomically.
+    '''
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, "wb")
+    try:
+        marshal.dump((SNAPSHOT_VERSION, records), f)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def compile_snapshot(dirname, snapshot_path=None):
+    '''
+    Brings the snapshot of directory of trusted certificates up to date,
+    only files whose content changed are parsed.
+    Returns list of certificate records of the directory (certificates
+    found in more files are returned once).
+    '''
+    if snapshot_path is None:
+        snapshot_path = default_snapshot_path(dirname)
+    old_records = read_snapshot(snapshot_path)
+    records = {}
+    result = []
+    seen = set()
+    for path in _trusted_files(dirname):
+        content_hash = _file_hash(path)
+        if content_hash in old_records:
+            file_records = old_records[content_hash]
+        else:
+            logger.info("Parsing changed trusted certificate %s" % path)
+            file_records = _parse_file(path)
+        records[content_hash] = file_records
+        for record in file_records:
+            if record[0] not in seen:
+                seen.add(record[0])
+                result.append(record)
+    if records != old_records:
+        try:
+            snapshot_dir = os.path.dirname(snapshot_path)
+            if snapshot_dir and not os.path.isdir(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            write_snapshot(snapshot_path, records)
+        except (IOError, OSError), e:
+            logger.warning("Snapshot %s not written: %s" % (snapshot_path, e))
+    return result
+
+
+class Trust_store(object):
+    '''
+    Trusted certificates (pyasn1 Certificate objects) indexed when they
+    are added. Iterating over the store gives the certificates in the
+    order they were added, so it can be used where list of trusted
+    certificates is expected. The version is incremented by each change.
+    '''
+
+    def __init__(self, certificates=()):
+        self._anchors = []
+        # issuer_key(subject) -> list of anchors
+        self._by_subject = {}
+        # subjectKeyIdentifier -> list of anchors
+        self._by_ski = {}
+        # authorityKeyIdentifier -> list of anchors
+        self._by_aki = {}
+        # subjects of certificates with different keys
+        self._ambiguous = set()
+        # id(certificate) -> anchor of certificates already decoded
+        self._by_id = {}
+        # sha256 of DER of certificates, computed when needed
+        self._der_hashes = None
+        self.version = 0
+        for certificate in certificates:
+            self.add(certificate)
+
+    def _add_anchor(self, anchor):
+        same_subject = self._by_subject.setdefault(anchor.subject, [])
+        for other in same_subject:
+            if other.ski != anchor.ski:
+                self._ambiguous.add(anchor.subject)
+        same_subject.append(anchor)
+        if anchor.ski is not None:
+            self._by_ski.setdefault(anchor.ski, []).append(anchor)
+        if anchor.aki is not None:
+            self._by_aki.setdefault(anchor.aki, []).append(anchor)
+        self._anchors.append(anchor)
+        self._der_hashes = None
+        self.version += 1
+
+    def add(self, certificate):
+        '''
+        Adds certificate to the store and indexes it.
+        '''
+        anchor = _Anchor.from_certificate(certificate)
+        self._by_id[id(certificate)] = anchor
+        self._add_anchor(anchor)
+
+    # compatibility with the list of trusted certificates
+    append = add
+
+    def add_records(self, records):
+        '''
+        Adds certificates from snapshot records, they are decoded
+        only when they are used.
+        '''
+        for record in records:
+            self._add_anchor(_Anchor.from_record(record))
+
+    def add_dir(self, dirname, snapshot_path=None):
+        '''
+        Adds trusted certificates from directory using its snapshot
+        (which is updated when files in the directory changed).
+        '''
+        self.add_records(compile_snapshot(dirname, snapshot_path))
+
+    def _get_certificate(self, anchor):
+        if anchor._certificate is None:
+            self._by_id[id(anchor.certificate())] = anchor
+        return anchor._certificate
+
+    def __iter__(self):
+        return (self._get_certificate(anchor) for anchor in list(self._anchors))
+
+    def __len__(self):
+        return len(self._anchors)
+
+    def __getitem__(self, index):
+        return self._get_certificate(self._anchors[index])
+
+    def get_key_material(self, certificate):
+        '''
+        Returns (algorithm, key material) of trusted certificate extracted
+        when it was added or None for certificates not in the store.
+        '''
+        anchor = self._by_id.get(id(certificate))
+        if anchor is None or anchor._certificate is not certificate:
+            return None
+        return anchor.key_material
+
+    def get_der_hashes(self):
+        '''
+        Returns set of hex SHA-256 digests of DER of the certificates.
+        '''
+        der_hashes = self._der_hashes
+        if der_hashes is None:
+            der_hashes = frozenset(hashlib.sha256(anchor.to_record()[0]).
+                                   hexdigest() for anchor in self._anchors)
+            self._der_hashes = der_hashes
+        return der_hashes
+
+    def find_by_subject(self, subject):
+        '''
+        Returns the certificate with subject (string form of Name) or
+        None. When there are more of them, the one valid now is preferred.
+        '''
+        return self._choose(self._by_subject.get(issuer_key(subject), []))
+
+    def find_by_key_id(self, key_id):
+        '''
+        Returns the certificate with subjectKeyIdentifier key_id or None.
+        '''
+        return self._choose(self._by_ski.get(key_id, []))
+
+    def find_issued_by_key(self, key_id):
+        '''
+        Returns certificates with authorityKeyIdentifier key_id
+        (certificates issued with the key key_id).
+        '''
+        return [self._get_certificate(anchor)
+                for anchor in self._by_aki.get(key_id, [])]
+
+    def find_issuer(self, certificate, issuer=None):
+        '''
+        Returns the trusted certificate which issued certificate or None.
+        Candidates with the issuer subject (string form of issuer Name
+        of certificate, computed if not given) are narrowed by the
+        authorityKeyIdentifier of the certificate, so that CAs with the
+        same name and different keys are told apart.
+        '''
+        if issuer is None:
+            tbs = _get_tbs_certificate(certificate)
+            issuer = str(tbs.getComponentByName("issuer"))
+        issuer = issuer_key(issuer)
+        candidates = self._by_subject.get(issuer)
+        if not candidates:
+            return None
+        if issuer in self._ambiguous:
+            aki = get_authority_key_id(certificate)
+            if aki is not None:
+                matching = [anchor for anchor in candidates
+                            if anchor.ski == aki]
+                if not matching:
+                    # CAs without SKI may still be the issuer
+                    matching = [anchor for anchor in candidates
+                                if anchor.ski is None]
+                candidates = matching
+        return self._choose(candidates)
+
+    def _choose(self, candidates):
+        '''
+        Returns certificate of the first of candidates valid now or
+        of the first one.
+        '''
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            now = timeutil.to_seconds_from_epoch()
+            for anchor in candidates:
+                if anchor.is_valid_at(now):
+                    return self._get_certificate(anchor)
+        return self._get_certificate(candidates[0])
+
+
+USAGE = '''%s trusted_dir [snapshot_file]
+Compiles directory of trusted certificates into snapshot.'''
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print >> sys.stderr, USAGE % argv[0]
+        return 2
+    logging.basicConfig(level=logging.INFO)
+    snapshot_path = len(argv) == 3 and argv[2] or None
+    records = compile_snapshot(argv[1], snapshot_path)
+    print "%d trusted certificates in the snapshot" % len(records)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,95 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Bounded pool of worker threads used to download CRLs concurrently.
+Workers live as long as the pool, so HTTP connections kept by
+the threads (see network.KeepAliveHTTPHandler) are reused by later
+downloads.
+'''
+
+# standard library imports
+import threading
+import Queue
+import logging
+logger = logging.getLogger('certs.worker_pool')
+
+
+class Worker_pool(object):
+    '''
+    Runs submitted functions in at most workers threads.
+    '''
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, func, *args):
+        '''
+        Schedules func(*args). Result of the call is not kept, func
+        has to pass it on itself (e.g. into a Queue).
+        '''
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise ValueError("Worker pool is closed")
+            self._tasks.put((func, args))
+            # start new worker only when all running ones are busy
+            if len(self._threads) < self.workers and \
+               self._tasks.qsize() > self._idle_count():
+                self.__start_worker()
+        finally:
+            self._lock.release()
+
+    def _idle_count(self):
+        return len([t for t in self._threads if t.idle])
+
+    def __start_worker(self):
+        thread = threading.Thread(target=self.__work,
+                                  name="CRL worker %d" % len(self._threads))
+        thread.setDaemon(True)
+        thread.idle = False
+        self._threads.append(thread)
+        thread.start()
+
+    def __work(self):
+        thread = threading.currentThread()
+        while True:
+            thread.idle = True
+            func, args = self._tasks.get()
+            thread.idle = False
+            if func is None:
+                break
+            try:
+                func(*args)
+            except Exception, ex:
+                logger.error("Task of worker pool failed: %s" % ex)
+
+    def close(self):
+        '''
+        Stops the workers after they finish submitted tasks.
+        '''
+        self._lock.acquire()
+        try:
+            self._closed = True
+            for i in xrange(len(self._threads)):
+                self._tasks.put((None, None))
+        finally:
+            self._lock.release()
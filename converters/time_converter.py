@@ -0,0 +1,164 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Parsing of ASN.1 UTCTime and GeneralizedTime strings.
+Results are kept in a bounded cache, because the same times (validity
+of certificates, thisUpdate and nextUpdate of CRLs) are parsed again
+and again.
+'''
+
+# standard library imports
+import time
+import datetime
+
+# maximal number of cached times, the cache is emptied when it is full
+CACHE_SIZE = 10000
+
+# days before the first day of month (in a common year)
+_MONTH_DAYS = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365)
+
+# days from 0001-01-01 to 1970-01-01
+_EPOCH_DAYS = 719162
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_cache = {}
+
+
+def _is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def _days_since_epoch(year, month, day):
+    '''
+    Number of days from 1970-01-01 to the given date (proleptic
+    Gregorian calendar).
+    '''
+    if month < 1 or month > 12:
+        raise ValueError("Bad month %d" % month)
+    leap = _is_leap(year)
+    month_days = _MONTH_DAYS[month] - _MONTH_DAYS[month - 1]
+    if month == 2 and leap:
+        month_days += 1
+    if day < 1 or day > month_days:
+        raise ValueError("Bad day %d" % day)
+    y = year - 1
+    days = y * 365 + y // 4 - y // 100 + y // 400 - _EPOCH_DAYS
+    if month > 2 and leap:
+        days += 1
+    return days + _MONTH_DAYS[month - 1] + day - 1
+
+def _parse(time_string):
+    '''
+    Returns (seconds since the epoch, microseconds) of UTCTime
+    (YYMMDDHHMM[SS]) or GeneralizedTime (YYYYMMDDHHMMSS[.fff]) followed
+    by Z or by the offset from UTC (+hhmm or -hhmm). GeneralizedTime
+    without the zone is taken as UTC time.
+    '''
+    value = time_string.strip()
+    offset = 0
+    if value.endswith('Z'):
+        value = value[:-1]
+    elif len(value) > 5 and value[-5] in '+-':
+        zone = value[-4:]
+        if not zone.isdigit():
+            raise ValueError("Bad time zone of %r" % time_string)
+        offset = (int(zone[:2]) * 60 + int(zone[2:])) * 60
+        if value[-5] == '-':
+            offset = -offset
+        value = value[:-5]
+    micro = 0
+    for separator in '.,':
+        if separator in value:
+            value, fraction = value.split(separator, 1)
+            if not fraction.isdigit():
+                raise ValueError("Bad fraction of second in %r" % time_string)
+            # truncated, rounding could give 1000000 microseconds
+            micro = int((fraction + '00000')[:6])
+            break
+    if not value.isdigit():
+        raise ValueError("Bad time %r" % time_string)
+    size = len(value)
+    if size in (10, 12):
+        # UTCTime
+        year = int(value[:2])
+        year += 1900 if year >= 50 else 2000
+        value = value[2:]
+    elif size == 14:
+        year = int(value[:4])
+        value = value[4:]
+    else:
+        raise ValueError("Bad time %r" % time_string)
+    month = int(value[:2])
+    day = int(value[2:4])
+    hour = int(value[4:6])
+    minute = int(value[6:8])
+    second = int(value[8:10] or 0)
+    if hour > 23 or minute > 59 or second > 60:
+        raise ValueError("Bad time %r" % time_string)
+    seconds = _days_since_epoch(year, month, day) * 86400 + \
+              hour * 3600 + minute * 60 + second - offset
+    return seconds, micro
+
+def _lookup(time_string):
+    try:
+        return _cache[time_string]
+    except KeyError:
+        pass
+    res = _parse(time_string)
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[time_string] = res
+    return res
+
+def to_seconds(time_string):
+    '''
+    Converts UTCTime or GeneralizedTime string to seconds since
+    the epoch (float when it has fraction of second).
+    Raises ValueError for invalid time.
+    '''
+    seconds, micro = _lookup(time_string)
+    if micro:
+        return seconds + micro / 1e6
+    return seconds
+
+def to_struct_time(time_string):
+    '''
+    Converts UTCTime or GeneralizedTime string to time struct in UTC.
+    '''
+    return time.gmtime(_lookup(time_string)[0])
+
+def to_datetime(time_string):
+    '''
+    Converts UTCTime or GeneralizedTime string to naive datetime in UTC.
+    '''
+    seconds, micro = _lookup(time_string)
+    return _EPOCH + datetime.timedelta(seconds=seconds, microseconds=micro)
+
+def to_local_datetime(time_string):
+    '''
+    Converts UTCTime or GeneralizedTime string to naive datetime in
+    the local time zone (with daylight saving time in effect at that
+    moment).
+    '''
+    seconds, micro = _lookup(time_string)
+    return datetime.datetime.fromtimestamp(seconds).replace(microsecond=micro)
+
+def clear_cache():
+    '''
+    Empties the cache of parsed times.
+    '''
+    _cache.clear()
@@ -0,0 +1,152 @@
+#*    dslib - Python library for Datove schranky
+#*    Copyright (C) 2009-2012  CZ.NIC, z.s.p.o. (http://www.nic.cz)
+#*
+#*    This library is free software; you can redistribute it and/or
+#*    modify it under the terms of the GNU Library General Public
+#*    License as published by the Free Software Foundation; either
+#*    version 2 of the License, or (at your option) any later version.
+#*
+#*    This library is distributed in the hope that it will be useful,
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#*    Library General Public License for more details.
+#*
+#*    You should have received a copy of the GNU Library General Public
+#*    License along with this library; if not, write to the Free
+#*    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#*
+'''
+Tests of parsing of UTCTime and GeneralizedTime - compared with
+calendar.timegm of the same date, fractions of second, time zones,
+the UTCTime century pivot and invalid times.
+Run with python -m dslib.converters.time_converter_test
+'''
+
+# standard library imports
+import calendar
+import datetime
+import random
+import time
+import unittest
+
+# local imports
+import time_converter
+
+
+def _timegm(year, month, day, hour=0, minute=0, second=0):
+    return calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+
+
+class Time_converter_test(unittest.TestCase):
+
+    def setUp(self):
+        time_converter.clear_cache()
+
+    def test_utc_time(self):
+        self.assertEqual(time_converter.to_seconds('120131235958Z'),
+                         _timegm(2012, 1, 31, 23, 59, 58))
+        # seconds are optional
+        self.assertEqual(time_converter.to_seconds('1201312359Z'),
+                         _timegm(2012, 1, 31, 23, 59))
+        self.assertEqual(time_converter.to_struct_time('120229120000Z')[:6],
+                         (2012, 2, 29, 12, 0, 0))
+
+    def test_utc_time_pivot(self):
+        self.assertEqual(time_converter.to_seconds('491231235959Z'),
+                         _timegm(2049, 12, 31, 23, 59, 59))
+        self.assertEqual(time_converter.to_seconds('500101000000Z'),
+                         _timegm(1950, 1, 1))
+        self.assertEqual(time_converter.to_seconds('000101000000Z'),
+                         _timegm(2000, 1, 1))
+        self.assertEqual(time_converter.to_seconds('991231235959Z'),
+                         _timegm(1999, 12, 31, 23, 59, 59))
+
+    def test_generalized_time(self):
+        self.assertEqual(time_converter.to_seconds('20120131235958Z'),
+                         _timegm(2012, 1, 31, 23, 59, 58))
+        self.assertEqual(time_converter.to_seconds('19491231235959Z'),
+                         _timegm(1949, 12, 31, 23, 59, 59))
+        self.assertEqual(time_converter.to_seconds('21070101000000Z'),
+                         _timegm(2107, 1, 1))
+        # local time without zone is taken as UTC
+        self.assertEqual(time_converter.to_seconds('20120131235958'),
+                         _timegm(2012, 1, 31, 23, 59, 58))
+
+    def test_random_dates(self):
+        rnd = random.Random(1)
+        for i in xrange(2000):
+            seconds = rnd.randint(_timegm(1900, 1, 1), _timegm(2999, 1, 1))
+            t = time.gmtime(seconds)
+            self.assertEqual(time_converter.to_seconds(
+                             time.strftime('%Y%m%d%H%M%SZ', t)), seconds)
+            if 1950 <= t.tm_year < 2050:
+                self.assertEqual(time_converter.to_seconds(
+                                 time.strftime('%y%m%d%H%M%SZ', t)), seconds)
+
+    def test_fraction(self):
+        base = _timegm(2012, 1, 31, 23, 59, 58)
+        self.assertEqual(time_converter.to_seconds('20120131235958.5Z'),
+                         base + 0.5)
+        self.assertEqual(time_converter.to_seconds('20120131235958,25Z'),
+                         base + 0.25)
+        self.assertEqual(time_converter.to_seconds('20120131235958.000Z'),
+                         base)
+        self.assertEqual(time_converter.to_datetime('20120131235958.123456Z'),
+                         datetime.datetime(2012, 1, 31, 23, 59, 58, 123456))
+        # digits beyond microseconds are truncated
+        for value in ('20120131235958.9999995Z', '20120131235958.99999999Z'):
+            self.assertEqual(time_converter.to_datetime(value),
+                             datetime.datetime(2012, 1, 31, 23, 59, 58,
+                                               999999))
+            self.assertEqual(time_converter.to_local_datetime(value).\
+                             microsecond, 999999)
+            self.assertEqual(int(time_converter.to_seconds(value)), base)
+
+    def test_offset(self):
+        utc = _timegm(2012, 1, 31, 22, 29, 58)
+        self.assertEqual(time_converter.to_seconds('20120131235958+0130'), utc)
+        self.assertEqual(time_converter.to_seconds('20120131145958-0730'), utc)
+        self.assertEqual(time_converter.to_seconds('1201312359+0130'),
+                         utc - 58)
+        self.assertEqual(time_converter.to_seconds('20120131235958.5+0130'),
+                         utc + 0.5)
+        self.assertEqual(time_converter.to_seconds('20120101003000+0100'),
+                         _timegm(2011, 12, 31, 23, 30))
+
+    def test_local_datetime(self):
+        value = '20120131235958.25Z'
+        expected = datetime.datetime.fromtimestamp(
+                                _timegm(2012, 1, 31, 23, 59, 58))
+        self.assertEqual(time_converter.to_local_datetime(value),
+                         expected.replace(microsecond=250000))
+
+    def test_invalid(self):
+        for value in ('', 'Z', '120131235', '2012013123595Z',
+                      '120132000000Z', '121301000000Z', '120001000000Z',
+                      '110229000000Z', '19000229000000Z', '120131240000Z',
+                      '120131236000Z', '20120131235958.Z', '20120131235958.5xZ',
+                      '20120131235958+01a0', 'abcdefghijklZ'):
+            self.assertRaises(ValueError, time_converter.to_seconds, value)
+        self.assertEqual(time_converter.to_seconds('20000229000000Z'),
+                         _timegm(2000, 2, 29))
+
+    def test_cache(self):
+        size = time_converter.CACHE_SIZE
+        time_converter.CACHE_SIZE = 10
+        try:
+            values = ['1201010000%02dZ' % i for i in xrange(25)]
+            for value in values:
+                time_converter.to_seconds(value)
+            self.assert_(len(time_converter._cache) <= 10)
+            self.assertEqual([time_converter.to_seconds(value)
+                              for value in values],
+                             [_timegm(2012, 1, 1, 0, 0, i)
+                              for i in xrange(25)])
+        finally:
+            time_converter.CACHE_SIZE = size
+        time_converter.clear_cache()
+        self.assertEqual(time_converter._cache, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,9 @@
 #*
 
 import urllib2
+import httplib
+import socket
+import threading
 import re
 
 class Proxy(object):
@@ -79,10 +82,98 @@ class Proxy(object):
     #  return urllib2.ProxyBasicAuthHandler(pass_man)
 
 
+class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+  """HTTP handler keeping connections to servers open between requests.
+  Connections are kept per thread, so that the handler may be shared
+  by threads."""
+
+  def __init__(self):
+    urllib2.HTTPHandler.__init__(self)
+    self._local = threading.local()
+
+  def _get_connections(self):
+    if not hasattr(self._local, 'connections'):
+      self._local.connections = {}
+    return self._local.connections
+
+  def close_connections(self):
+    """closes connections opened by the current thread"""
+    connections = self._get_connections()
+    for conn in connections.values():
+      conn.close()
+    connections.clear()
+
+  def http_open(self, req):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError('no host given')
+    connections = self._get_connections()
+    headers = dict(req.unredirected_hdrs)
+    headers.update(req.headers)
+    headers['Connection'] = 'keep-alive'
+    conn = connections.get(host)
+    try:
+      if conn is not None:
+        try:
+          resp = self._request(conn, req, headers)
+        except (socket.error, httplib.HTTPException):
+          # the server closed the kept connection, open a new one
+          conn.close()
+          conn = None
+      if conn is None:
+        conn = httplib.HTTPConnection(host, timeout=req.timeout)
+        connections[host] = conn
+        resp = self._request(conn, req, headers)
+    except (socket.error, httplib.HTTPException), err:
+      conn.close()
+      del connections[host]
+      raise urllib2.URLError(err)
+    if resp.will_close:
+      del connections[host]
+    # wrap the response the same way as urllib2 does
+    resp.recv = resp.read
+    fp = socket._fileobject(resp, close=True)
+    result = urllib2.addinfourl(fp, resp.msg, req.get_full_url())
+    result.code = resp.status
+    result.msg = resp.reason
+    return result
+
+  def _request(self, conn, req, headers):
+    conn.request(req.get_method(), req.get_selector(), req.data, headers)
+    return conn.getresponse(buffering=True)
+
+
 class ProxyManager(object):
   HTTP_PROXY = Proxy(None, method='http')
   HTTPS_PROXY = Proxy(None, method='https')
   
+  # openers created by get_opener (proxy settings -> opener)
+  _openers = {}
+  _openers_lock = threading.Lock()
+
+  @classmethod
+  def get_opener(cls, proxy=None):
+    """returns opener using proxy (HTTP_PROXY by default) that keeps
+    connections open; openers are shared, one per proxy settings"""
+    if proxy is None:
+      proxy = cls.HTTP_PROXY
+    key = (proxy.method, proxy.hostname, proxy.username, proxy.password)
+    cls._openers_lock.acquire()
+    try:
+      opener = cls._openers.get(key)
+      if opener is None:
+        opener = urllib2.build_opener(KeepAliveHTTPHandler())
+        prox_hand = proxy.create_proxy_handler()
+        if prox_hand:
+          opener.add_handler(prox_hand)
+        prox_auth_hand = proxy.create_proxy_auth_handler()
+        if prox_auth_hand:
+          opener.add_handler(prox_auth_hand)
+        cls._openers[key] = opener
+      return opener
+    finally:
+      cls._openers_lock.release()
+
 
 
 class NoPostRedirectionHTTPRedirectHandler(urllib2.HTTPRedirectHandler):
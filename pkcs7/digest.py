@@ -29,9 +29,10 @@ SHA256_NAME = "SHA-256"
 SHA384_NAME = "SHA-384"
 SHA512_NAME = "SHA-512"
 
-def calculate_digest(data, alg):    
+def new_digest(alg):
     '''
-    Calculates digest according to algorithm
+    Returns new hash object for algorithm (for incremental hashing)
+    or None if the algorithm is unknown
     '''
     digest_alg = None
     if (alg == SHA1_NAME):
@@ -48,6 +49,14 @@ def calculate_digest(data, alg):
     
     if digest_alg is None:
         logger.error("Unknown digest algorithm : %s" % alg)
+    return digest_alg
+
+def calculate_digest(data, alg):    
+    '''
+    Calculates digest according to algorithm
+    '''
+    digest_alg = new_digest(alg)
+    if digest_alg is None:
         return None
     
     digest_alg.update(data)   
@@ -29,6 +29,7 @@ from pkcs7.asn1_models.X509_certificate import *
 from pkcs7.asn1_models.certificate_extensions import *
 from pkcs7.debug import *
 from certs.cert_manager import CertificateManager
+from converters import time_converter
 import datetime, time
 try:
   from dslib.properties.properties import Properties
@@ -113,15 +114,7 @@ class ValidityInterval():
       it also adjusts the time according to local timezone, so that it is
       compatible with other parts of the library
       """
-      year = 2000 + int(date[:2])
-      month = int(date[2:4])
-      day = int(date[4:6])
-      hour = int(date[6:8])
-      minute = int(date[8:10])
-      second = int(date[10:12])
-      tz_delta = datetime.timedelta(seconds=time.daylight and time.altzone
-                                    or time.timezone)
-      return datetime.datetime(year, month, day, hour, minute, second) - tz_delta
+      return time_converter.to_local_datetime(date)
 
 class PublicKeyInfo():
     '''
@@ -420,6 +413,8 @@ class X509Certificate():
         self.tbsCertificate = Certificate(tbsCert)   
         self.verification_results = None
         self.raw_der_data = "" # raw der data for storage are kept here by cert_manager
+        # string form of issuer Name as used by the CRL cache (set by cert_manager)
+        self.issuer_name = None
     
     def is_verified(self, ignore_missing_crl_check=False):
       '''
@@ -624,17 +619,4 @@ class TimeStampToken():
       it also adjusts the time according to local timezone, so that it is
       compatible with other parts of the library
       """
-      year = int(self.genTime[:4])
-      month = int(self.genTime[4:6])
-      day = int(self.genTime[6:8])
-      hour = int(self.genTime[8:10])
-      minute = int(self.genTime[10:12])
-      second = int(self.genTime[12:14])
-      rest = self.genTime[14:].strip("Z")
-      if rest:
-        micro = int(float(rest)*1e6)
-      else:
-        micro = 0
-      tz_delta = datetime.timedelta(seconds=time.daylight and time.altzone
-                                    or time.timezone)
-      return datetime.datetime(year, month, day, hour, minute, second, micro) - tz_delta
+      return time_converter.to_local_datetime(self.genTime)
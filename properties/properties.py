@@ -29,16 +29,67 @@ class Properties(object):
   VERIFY_CERTIFICATE = True
   CHECK_CRL = True
   FORCE_CRL_DOWNLOAD = False
+  STREAM_CRL_DOWNLOAD = False
+  # refresh CRLs in background thread instead of during verification
+  CRL_REFRESH_SCHEDULER = False
+  # seconds before nextUpdate when the background refresh starts
+  CRL_REFRESH_AHEAD = 3600
+  # maximal random delay (seconds) added to the planned refresh
+  CRL_REFRESH_JITTER = 600
+  # seconds between attempts when the refresh failed
+  CRL_REFRESH_RETRY = 300
+  # seconds after nextUpdate during which cached CRL is still accepted
+  CRL_STALE_GRACE = 86400
+  # wait for CRL refresh running in another thread instead of using
+  # the cached CRLs
+  CRL_REFRESH_WAIT = True
+  # number of threads downloading CRLs concurrently
+  CRL_FETCH_WORKERS = 4
+  # storage of CRL cache - file (index and journal) or sqlite (database
+  # shared by processes)
+  CRL_CACHE_BACKEND = "file"
+  # number of processes decoding large CRLs (0 - decode in the thread
+  # which downloaded the CRL)
+  CRL_DECODE_PROCESSES = 0
+  # ask OCSP responder of the issuer before checking CRLs
+  CHECK_OCSP = False
+  # seconds after thisUpdate during which OCSP response without nextUpdate
+  # is accepted
+  OCSP_MAX_AGE = 3600
+  # limits of the cache of parsed certificates - number of certificates,
+  # total length of their DER in bytes (not the memory of the parsed
+  # certificates, which is much larger) and seconds they are kept
+  # (0 - no limit)
+  CERT_CACHE_SIZE = 1000
+  CERT_CACHE_MAX_BYTES = 4194304
+  CERT_CACHE_TTL = 0
+  # comma separated files (PEM or DER) with certificates which are never
+  # dropped from the cache, e.g. the current signing certificates of ISDS
+  PINNED_CERTIFICATES = ""
+  # snapshot of the directory of trusted certificates (empty - file
+  # in the user cache directory, see trust_store)
+  TRUST_SNAPSHOT_FILE = ""
+  # number of cached results of certificate verification
+  VERIFICATION_CACHE_SIZE = 1000
   
   # these properties are expected boolean
   _boolean_values = [
                      "VERIFY_MESSAGE", "VERIFY_TIMESTAMP",
                      "VERIFY_CERTIFICATE", "CHECK_CRL", 
-                     "FORCE_CRL_DOWNLOAD"
+                     "FORCE_CRL_DOWNLOAD", "STREAM_CRL_DOWNLOAD",
+                     "CRL_REFRESH_SCHEDULER", "CRL_REFRESH_WAIT",
+                     "CHECK_OCSP"
                      ]
   
   # these properties are expected as integers/longs
-  _integer_values = []
+  _integer_values = [
+                     "CRL_REFRESH_AHEAD", "CRL_REFRESH_JITTER",
+                     "CRL_REFRESH_RETRY", "CRL_STALE_GRACE",
+                     "CRL_FETCH_WORKERS", "CRL_DECODE_PROCESSES",
+                     "CERT_CACHE_SIZE", "CERT_CACHE_MAX_BYTES",
+                     "CERT_CACHE_TTL", "VERIFICATION_CACHE_SIZE",
+                     "OCSP_MAX_AGE"
+                     ]
   
   # name of the section in the config file that contains security props
   SECURITY_SECTION_NAME = "security"